@@ -1,4 +1,10 @@
-import autoeval.managers
-import autoeval.utilities
+import importlib
 
-__all__ = [ "managers", "utilities" ]
\ No newline at end of file
+__all__ = [ "managers", "utilities" ]
+
+
+def __getattr__(name: str):
+    # Subpackages are imported on first use, so the command line interface starts without loading the pipeline
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
@@ -1,4 +1,12 @@
-from .data import prepare_data
-from .configfiles import prepare_configfile
+import importlib
 
-__all__ = ['prepare_data', 'prepare_configfile']
\ No newline at end of file
+__all__ = ['prepare_data', 'prepare_configfile']
+
+# Module of every public name, imported on first use
+_modules = {'prepare_data': '.data', 'prepare_configfile': '.configfiles'}
+
+
+def __getattr__(name: str):
+    if name in _modules:
+        return getattr(importlib.import_module(_modules[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from ..utilities.locking import temporary_name
+
+logger = logging.getLogger(__name__)
+
+# Bump when the content of the prepared files changes for the same inputs, so old entries are not reused
+PREPARED_DATA_VERSION = 1
+
+# ioctl request to clone a file (reflink) on filesystems supporting it (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+# Digests of the source files already computed, by (path, size, modification time)
+_digests = {}
+
+
+def file_digest(path: str) -> str:
+    """
+    Computes the sha256 digest of a file. Digests are memoized while the size and modification time of the file
+    do not change.
+
+    :param path: path to the file
+    :return: the hexadecimal digest of the content of the file.
+    """
+    stat = os.stat(path)
+    memo_key = (str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(1024 * 1024), b''):
+                digest.update(chunk)
+        _digests[memo_key] = digest.hexdigest()
+
+    return _digests[memo_key]
+
+
+def prepared_data_key(sources: List[str], parameters: Dict[str, any]) -> str:
+    """
+    Computes the key of some prepared data from the content of its source files and the filtering parameters.
+
+    :param sources: paths to the source files of the split
+    :param parameters: parameters used to filter the source files (protocol, min_size, ...)
+    :return: the hexadecimal key of the prepared data.
+    """
+    content = {
+        'version': PREPARED_DATA_VERSION,
+        'sources': [file_digest(source) for source in sources],
+        'parameters': parameters
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def link_file(source: str, destination: str):
+    """
+    Makes a file available in a new path without copying its content if possible: hardlink first, then reflink,
+    falling back to a regular copy. The destination is replaced if it exists.
+
+    Files linked from the cache share their content with it. They must be replaced (e.g. with os.replace or after
+    removing them) instead of being modified in place.
+
+    :param source: path to the file to link
+    :param destination: path where the file must be available
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+
+    try:
+        import fcntl
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return
+    except (ImportError, OSError):
+        if os.path.lexists(destination):
+            os.remove(destination)
+
+    shutil.copyfile(source, destination)
+
+
+def fetch_prepared_data(cache_dir: Path, key: str, working_dir: Path) -> Optional[List[str]]:
+    """
+    Links the prepared files of a cache entry into the working directory.
+
+    :param cache_dir: path to the prepared data cache
+    :param key: key of the prepared data
+    :param working_dir: path to the working directory
+    :return: the names of the linked files, or None if the entry is not in the cache.
+    """
+    entry = cache_dir / key
+    manifest = entry / 'manifest.json'
+    files = []
+    try:
+        with open(manifest, 'r') as mfile:
+            files = json.load(mfile)['files']
+        for file_name in files:
+            link_file(str(entry / file_name), str(working_dir / file_name))
+        # Mark the entry as recently used
+        os.utime(manifest)
+    except (OSError, ValueError, KeyError):
+        # Entry missing or evicted while linking it. Do not leave files sharing content with the cache behind
+        for file_name in files:
+            if os.path.lexists(working_dir / file_name):
+                os.remove(working_dir / file_name)
+        return None
+
+    logger.info('Prepared data found in cache ({}).'.format(entry))
+    return files
+
+
+def store_prepared_data(cache_dir: Path, key: str, working_dir: Path, files: List[str], max_size: int):
+    """
+    Stores prepared files of the working directory in the cache and evicts old entries if needed.
+
+    :param cache_dir: path to the prepared data cache
+    :param key: key of the prepared data
+    :param working_dir: path to the working directory with the prepared files
+    :param files: names of the prepared files to store
+    :param max_size: maximum size in bytes of the cache
+    """
+    entry = cache_dir / key
+    if entry.is_dir():
+        return
+
+    # Entries are filled in a temporary directory and renamed, so concurrent runs never see partial entries
+    temporary_entry = cache_dir / temporary_name(key)
+    os.makedirs(temporary_entry, exist_ok=True)
+    try:
+        for file_name in files:
+            link_file(str(working_dir / file_name), str(temporary_entry / file_name))
+        with open(temporary_entry / 'manifest.json', 'w') as mfile:
+            json.dump({'files': files, 'created': time.time()}, mfile)
+        os.rename(temporary_entry, entry)
+        logger.info('Prepared data stored in cache ({}).'.format(entry))
+    except OSError as e:
+        logger.warning('Prepared data could not be stored in cache: {}'.format(e))
+        shutil.rmtree(temporary_entry, ignore_errors=True)
+
+    evict_prepared_data(cache_dir, max_size)
+
+
+def evict_prepared_data(cache_dir: Path, max_size: int):
+    """
+    Removes the least recently used entries of the cache until its size is below max_size.
+
+    :param cache_dir: path to the prepared data cache
+    :param max_size: maximum size in bytes of the cache
+    """
+    entries = []
+    for entry in cache_dir.iterdir():
+        manifest = entry / 'manifest.json'
+        try:
+            size = sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+            entries.append((manifest.stat().st_mtime, size, entry))
+        except OSError:
+            # Temporary entry or entry removed by a concurrent run
+            continue
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total_size <= max_size:
+            break
+        logger.info('Evicting prepared data from cache ({}).'.format(entry))
+        shutil.rmtree(entry, ignore_errors=True)
+        total_size -= size
@@ -1,32 +1,295 @@
+import os
+import copy
 import yaml
-import shutil
+import itertools
 
-from typing import Dict
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
 
 import logging
 
+from .cache import file_digest
+from ..utilities.checkpoints import fingerprint, file_stamp
+from ..utilities.settings import protocols
+
 logger = logging.getLogger(__name__)
 
+# Types of the biotrainer options that can be overridden. Other options are passed to biotrainer as they are
+CONFIG_OPTION_TYPES = {
+    'protocol': str,
+    'model_choice': str,
+    'optimizer_choice': str,
+    'loss_choice': str,
+    'num_epochs': int,
+    'use_class_weights': bool,
+    'learning_rate': float,
+    'batch_size': int,
+    'patience': int,
+    'epsilon': float,
+    'seed': int,
+    'device': str,
+    'embedder_name': str,
+    'embeddings_file': str,
+    'cross_validation_config': dict,
+    'auto_resume': bool,
+    'save_split_ids': bool,
+    'ignore_file_inconsistencies': bool,
+    'sanity_check': bool,
+}
+
+# Cross validation methods of biotrainer and the integer parameters each one needs
+CROSS_VALIDATION_METHODS = {'hold_out': (), 'k_fold': ('k',), 'leave_p_out': ('p',)}
+
+# Options with paths to FASTA files, fingerprinted by their content. Embeddings files can be large, so they are
+# fingerprinted by their size and modification time
+_FILE_OPTIONS = ('sequence_file', 'labels_file', 'mask_file')
+
+# Options not changing the results of a run, left out of its fingerprint
+_RUN_OPTIONS = ('auto_resume', 'output_dir', 'device')
+
+# Losses of every kind of protocol
+_CLASS_PROTOCOLS = ('residue_to_class', 'residues_to_class', 'sequence_to_class')
+_LOSSES = {'class': ('cross_entropy_loss',), 'value': ('mean_squared_error',)}
+
+# Parsed configuration files, by path, with the size and modification time they were read with
+_parsed_configs: Dict[str, Tuple[List[int], Dict[str, any]]] = {}
+
+# Fingerprints of the configurations already validated
+_valid_configs = set()
+
+
+def read_configfile(config_file: str) -> Dict[str, any]:
+    """
+    Reads a biotrainer config file.
+
+    :param config_file: path to the config file
+    :return: the configuration as a dictionary.
+    """
+    with open(config_file, 'r') as cfile:
+        return yaml.load(cfile, Loader=yaml.FullLoader)
+
+
+def load_configfile(config_file: str) -> Dict[str, any]:
+    """
+    Reads a configuration file of the configurations bank (or any biotrainer config file) once per process. The
+    parsed configuration is kept while the file does not change.
+
+    :param config_file: path to the config file
+    :return: a copy of the configuration, that can be modified.
+    """
+    path = str(Path(config_file).resolve())
+    stamp = file_stamp(path)
+    if path not in _parsed_configs or _parsed_configs[path][0] != stamp:
+        _parsed_configs[path] = (stamp, read_configfile(path))
+
+    return copy.deepcopy(_parsed_configs[path][1])
+
+
+def _coerce(option: str, value: any) -> any:
+    # Value of an option as its type, e.g. 1e-3 (read as a string by PyYAML) as a float
+    expected = CONFIG_OPTION_TYPES.get(option)
+    if expected is None or value is None or isinstance(value, expected) and not \
+            (expected is int and isinstance(value, bool)):
+        return value
+    try:
+        if expected is bool and isinstance(value, str) and value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        if expected is int and float(value).is_integer() and not isinstance(value, bool):
+            return int(float(value))
+        if expected in (float, str):
+            return expected(value)
+    except (TypeError, ValueError):
+        pass
+    raise Exception(f"Invalid value {value!r} for {option} ({expected.__name__} expected).")
 
-def prepare_configfile(working_dir: str, config_file: str, sequences: str, labels: str, args: Dict[str, any]):
+
+def parse_overrides(overrides: List[str]) -> Dict[str, any]:
     """
-    Copies the config file to the working directory, replaces the paths to the sequences and labels files,
-    and modifies the different biotrainer input parameters as indicated in the execution arguments.
+    Parses overrides given as KEY=VALUE, e.g. learning_rate=1e-4 or cross_validation_config.method=k_fold.
+    Values are read as YAML scalars.
 
-    :param working_dir: path to the working diretory where the config file will be copied to
-    :param config_file: path to the config file to copy and modify
+    :param overrides: the overrides
+    :return: a dictionary of the overridden options, with the dotted keys as nested dictionaries.
+    """
+    parsed = {}
+    for override in overrides:
+        key, separator, value = override.partition('=')
+        if not separator or not key:
+            raise Exception(f"Invalid override {override}. Overrides must be given as KEY=VALUE.")
+        *parents, option = key.strip().split('.')
+        target = parsed
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[option] = yaml.safe_load(value) if value.strip() else None
+
+    return parsed
+
+
+def parse_grid(options: List[str]) -> Dict[str, List[any]]:
+    """
+    Parses a grid of options given as KEY=VALUE1,VALUE2,..., e.g. learning_rate=1e-3,1e-4 or batch_size=64,128.
+    Values are read as YAML scalars.
+
+    :param options: the options of the grid
+    :return: a dictionary of the values of every option, by (dotted) option name.
+    """
+    grid = {}
+    for option in options:
+        key, separator, values = option.partition('=')
+        if not separator or not key or not values:
+            raise Exception(f"Invalid grid option {option}. Grid options must be given as KEY=VALUE1,VALUE2,...")
+        grid[key.strip()] = [yaml.safe_load(value) for value in values.split(',')]
+
+    return grid
+
+
+def apply_overrides(config: Dict[str, any], overrides: Dict[str, any]) -> Dict[str, any]:
+    """
+    Applies overrides to a configuration. Dictionary options (e.g. cross_validation_config) are merged, the rest
+    are replaced, and values are converted to the type of their option. Setting an embedder unsets the
+    embeddings file and vice versa.
+
+    :param config: biotrainer configuration. It is not modified
+    :param overrides: overridden options
+    :return: the new configuration.
+    """
+    config = dict(config)
+    for option, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(option), dict):
+            value = {**config[option], **value}
+        config[option] = _coerce(option, value)
+        if option == 'embedder_name' and value is not None:
+            config.pop('embeddings_file', None)
+        if option == 'embeddings_file' and value is not None:
+            config.pop('embedder_name', None)
+
+    return config
+
+
+def config_fingerprint(config: Dict[str, any]) -> str:
+    """
+    Computes the fingerprint of a configuration to detect runs that would train the same model: options that do
+    not change the results are left out, values are compared as their types and FASTA files by their content.
+
+    :param config: biotrainer configuration
+    :return: the hexadecimal fingerprint.
+    """
+    normalized = {}
+    for option, value in config.items():
+        if option in _RUN_OPTIONS:
+            continue
+        if option in _FILE_OPTIONS and isinstance(value, str) and os.path.isfile(value):
+            value = file_digest(value)
+        elif option == 'embeddings_file' and isinstance(value, str) and os.path.exists(value):
+            value = [value, file_stamp(value)]
+        normalized[option] = _coerce(option, value) if option in CONFIG_OPTION_TYPES else value
+
+    return fingerprint(normalized)
+
+
+def validate_config(config: Dict[str, any]) -> str:
+    """
+    Checks that the options of a configuration have valid values and can be used with its protocol: losses and
+    class weights of the kind of protocol, masks only for per-residue protocols, positive learning rates, batch
+    sizes and epochs, valid cross validation methods and only one of embedder_name and embeddings_file.
+    Configurations already validated are not checked again.
+
+    :param config: biotrainer configuration
+    :return: the fingerprint of the configuration.
+    """
+    config_id = config_fingerprint(config)
+    if config_id in _valid_configs:
+        return config_id
+
+    options = {option: _coerce(option, value) for option, value in config.items()}
+    protocol = options.get('protocol')
+    if protocol not in protocols:
+        raise Exception(f"Invalid protocol ({protocol}).")
+    kind = 'class' if protocol in _CLASS_PROTOCOLS else 'value'
+    if options.get('loss_choice') is not None and options['loss_choice'] not in _LOSSES[kind]:
+        raise Exception(f"Loss {options['loss_choice']} cannot be used with protocol {protocol}.")
+    if options.get('use_class_weights') and kind != 'class':
+        raise Exception(f"Class weights cannot be used with protocol {protocol}.")
+    if options.get('mask_file') not in (None, 'None') and not protocol.startswith('residue_to_'):
+        raise Exception(f"Masks cannot be used with protocol {protocol}.")
+    for option in ('learning_rate', 'batch_size', 'num_epochs', 'patience', 'epsilon'):
+        if options.get(option) is not None and options[option] <= 0:
+            raise Exception(f"{option} must be positive.")
+    if options.get('embedder_name') not in (None, 'None') and options.get('embeddings_file') not in (None, 'None'):
+        raise Exception("embedder_name and embeddings_file are mutually exclusive.")
+
+    cross_validation = options.get('cross_validation_config') or {}
+    method = cross_validation.get('method', 'hold_out')
+    if method not in CROSS_VALIDATION_METHODS:
+        raise Exception(f"Invalid cross validation method ({method}).")
+    for parameter in CROSS_VALIDATION_METHODS[method]:
+        value = cross_validation.get(parameter)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise Exception(f"Cross validation method {method} needs a positive integer {parameter}.")
+
+    _valid_configs.add(config_id)
+    return config_id
+
+
+def config_grid(config: Dict[str, any], grid: Dict[str, List[any]]) -> Iterator[Tuple[str, Dict[str, any]]]:
+    """
+    Generates the configurations of a grid of options, e.g. {'learning_rate': [1e-3, 1e-4], 'batch_size': [128]}.
+    Every configuration is validated, and configurations identical to a previous one (e.g. 1e-3 and 0.001) are
+    skipped.
+
+    :param config: base biotrainer configuration
+    :param grid: values of every option of the grid. Dotted options (cross_validation_config.method) are nested
+    :return: an iterator of the fingerprints and configurations of the grid.
+    """
+    options = list(grid)
+    seen = set()
+    for values in itertools.product(*(grid[option] for option in options)):
+        overrides = {}
+        for option, value in zip(options, values):
+            *parents, name = option.split('.')
+            target = overrides
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[name] = value
+        candidate = apply_overrides(config, overrides)
+        config_id = validate_config(candidate)
+        if config_id in seen:
+            logger.info('Configuration {} already generated. Skipped.'.format(overrides))
+            continue
+        seen.add(config_id)
+        yield config_id, candidate
+
+
+def write_configfile(working_dir: str, config: Dict[str, any]):
+    """
+    Writes a biotrainer configuration to the config.yml of the working directory.
+
+    :param working_dir: path to the working directory
+    :param config: biotrainer configuration
+    """
+    with open(working_dir / 'config.yml', 'w') as cfile:
+        yaml.dump(config, cfile)
+
+
+def prepare_configfile(working_dir: str, config_file: str, sequences: str, labels: str, args: Dict[str, any]) -> \
+        Dict[str, any]:
+    """
+    Writes the config file to the working directory, replacing the paths to the sequences and labels files and
+    the different biotrainer input parameters as indicated in the execution arguments, including the overrides
+    (--override KEY=VALUE). The configuration is validated before it is written. The paths set by autoeval are
+    absolute, so biotrainer can be run from any directory.
+
+    :param working_dir: path to the working diretory where the config file will be written to
+    :param config_file: path to the config file to modify
     :param sequences: path to a valid FASTA file with the sequences
     :param labels: path to a valid FASTA file with the labels
     :param args: execution arguments
+    :return: the modified configuration, as written to config.yml.
     """
-    
-    # Create copy of the configuration file
-    shutil.copyfile(config_file, working_dir / 'config.yml')
-    logger.info('Configuration file copied from {} to the working directory.'.format(config_file))
 
-    # Modify copy of the config file with correct data of the selected split and configuration
-    with open(working_dir / 'config.yml', 'r') as cfile:
-        config = yaml.load(cfile, Loader=yaml.FullLoader)
+    # Start from the parsed configuration, read once per process
+    config = load_configfile(config_file)
+    logger.info('Configuration loaded from {}.'.format(config_file))
 
     # Check mutually exclusion between embedder_name and embedder_file arguments
     if args.embedder and args.embeddingsfile:
@@ -37,10 +300,10 @@ def prepare_configfile(working_dir: str, config_file: str, sequences: str, label
     # Modify configuration file
     if config["sequence_file"] == "None":
         logger.info('Modifying config file with sequence file: {}'.format(sequences))
-        config["sequence_file"] = str(sequences).split('/')[-1]
+        config["sequence_file"] = str(Path(sequences).resolve())
     if labels is not None and config["labels_file"] == "None":
         logger.info('Modifying config file with labels file: {}'.format(labels))
-        config["labels_file"] = str(labels).split('/')[-1]
+        config["labels_file"] = str(Path(labels).resolve())
     if args.embedder is not None:
         logger.info('Embedder changed to {}'.format(args.embedder))
         config["embedder_name"] = args.embedder
@@ -53,8 +316,10 @@ def prepare_configfile(working_dir: str, config_file: str, sequences: str, label
         logger.info('Config file uses {} model. Changed to {}'.format(config["model_choice"], args.model))
         config["model_choice"] = args.model
     if args.mask:
-        logger.info('Config file does not use a mask. Changed to use {}'.format(working_dir / args.mask))
-        config["mask_file"] = args.mask
+        # The mask of the split is always prepared as mask.fasta in the working directory
+        logger.info('Config file does not use a mask. Changed to use {}'.format(working_dir / 'mask.fasta'))
+        config["mask_file"] = str((working_dir / 'mask.fasta').resolve())
+    config.setdefault("output_dir", str((working_dir / 'output').resolve()))
 
     # Keep only embedder_name or embeddings_file
     if "embedder_name" in config and config["embedder_name"] is None:
@@ -62,5 +327,12 @@ def prepare_configfile(working_dir: str, config_file: str, sequences: str, label
     if "embeddings_file" in config and config["embeddings_file"] is None:
         del config["embeddings_file"]
 
-    with open(working_dir / 'config.yml', 'w') as cfile:
-        yaml.dump(config, cfile)
\ No newline at end of file
+    overrides = parse_overrides(getattr(args, 'override', None) or [])
+    if overrides:
+        logger.info('Configuration options overridden: {}'.format(overrides))
+        config = apply_overrides(config, overrides)
+    validate_config(config)
+
+    write_configfile(working_dir, config)
+
+    return config
\ No newline at end of file
@@ -1,15 +1,63 @@
 import os
 import logging
-import shutil
+import multiprocessing
 
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from concurrent.futures import ProcessPoolExecutor
 
-from ..utilities.settings import splits, split_dict
-from ..utilities.FASTA import read_FASTA, overwrite_FASTA, delete_entries_FASTA
+from .cache import prepared_data_key, fetch_prepared_data, store_prepared_data, link_file
+from .splitindex import extract_split_files, indexed_entries
+from ..utilities.FLIP import FLIP_DATASETS
+from ..utilities.settings import splits, split_dict, prepared_cache_max_size
+from ..utilities.instrumentation import RunManifest, Stage
+from ..utilities.FASTA import FASTAEntry, iterate_FASTA, read_FASTA, read_FASTA_ids, delete_entries_FASTA, \
+    filter_FASTA
 
 logger = logging.getLogger(__name__)
 
+# Sequences of the datasets parsed once by prepare_splits, by source path. Worker processes started with fork
+# inherit them instead of reading the files again
+_parsed_sequences: Dict[str, List[FASTAEntry]] = {}
+
+
+def size_predicate(min_size: int, max_size: int) -> Callable[[FASTAEntry], bool]:
+    """
+    Creates a predicate that keeps FASTA entries depending on the minimum and maximum size.
+
+    :param min_size: minimum size of the FASTA entry
+    :param max_size: maximum size of the FASTA entry
+    :return: a function returning True for the entries to keep.
+    """
+    def predicate(entry: FASTAEntry) -> bool:
+        return (min_size is not None and len(entry.seq) > min_size) or \
+            (max_size is not None and len(entry.seq) < max_size)
+
+    return predicate
+
+
+def valid_set_predicate(entry: FASTAEntry) -> bool:
+    """
+    Predicate that keeps FASTA entries whose set is valid, i.e. SET=nan is not in the description.
+
+    :param entry: a FASTA entry
+    :return: True if the entry must be kept.
+    """
+    return "SET=nan" not in entry.description
+
+
+def ids_predicate(ids: Set[str]) -> Callable[[FASTAEntry], bool]:
+    """
+    Creates a predicate that keeps FASTA entries whose id is in the given set.
+
+    :param ids: ids of the entries to keep
+    :return: a function returning True for the entries to keep.
+    """
+    def predicate(entry: FASTAEntry) -> bool:
+        return entry.id in ids
+
+    return predicate
+
 
 def filter_fasta_enties_size(fasta_entries: List[any], min_size: int, max_size: int) -> Tuple[List[any], List[any]]:
     """
@@ -21,10 +69,11 @@ def filter_fasta_enties_size(fasta_entries: List[any], min_size: int, max_size:
     :return: a tuple of two lists: filtered FASTA entries and filtered FASTA entry ids
     """
     ids_deleted_proteins = []
+    keep = size_predicate(min_size, max_size)
 
     new_fasta_entries = []
     for entry in fasta_entries:
-        if (min_size is not None and len(entry.seq) > min_size) or (max_size is not None and len(entry.seq) < max_size):
+        if keep(entry):
             new_fasta_entries.append(entry)
         else:
             logger.info('Deleted protein {}'.format(entry.id))
@@ -43,7 +92,7 @@ def filter_fasta_invalid_entries(fasta_entries: List[any]) -> Tuple[List[any], L
     
     new_fasta_entries = []
     for entry in fasta_entries:
-        if "SET=nan" in entry.description:
+        if not valid_set_predicate(entry):
             logger.info('Deleted entry with protein {}'.format(entry.id))
             ids_deleted_entries.append(entry.id)
         else:
@@ -60,19 +109,76 @@ def equilibrate_sequences(destination_sequences_dir: str, destination_labels_dir
     :return: path to the sequences.fasta file and path to the labels.fasta file.
     """
     sequences_entries = read_FASTA(destination_sequences_dir)
-    labels_entries = read_FASTA(destination_labels_dir)
-
-    sequences_ids = set([entry.id for entry in sequences_entries])
-    labels_ids = set([entry.id for entry in labels_entries])
+    labels_ids = read_FASTA_ids(destination_labels_dir)
 
-    sequence_ids_to_delete = sequences_ids.difference(labels_ids)
+    sequence_ids_to_delete = set([entry.id for entry in sequences_entries]).difference(labels_ids)
     delete_entries_FASTA(sequence_ids_to_delete, destination_sequences_dir)
 
-def prepare_data(split: str, protocol: str, working_dir: Path, min_size: int, max_size: int, mask: str) -> \
-        Tuple[str, str]:
+def filter_split(sequences_source: str, labels_source: str, destination_sequences_dir: str,
+                 destination_labels_dir: str, min_size: int, max_size: int,
+                 stage: Optional[Stage] = None, sequences: Optional[Iterable[FASTAEntry]] = None) -> \
+        Dict[str, Set[str]]:
+    """
+    Streams the FASTA files of a split to the working directory applying all the filters in a single pass:
+    size (min_size and max_size), ids available in the labels file (if any) and invalid sets (SET=nan).
+    The entries deleted from the sequences are also deleted from the labels.
+
+    :param sequences_source: path to the FASTA file with the sequences of the split.
+    :param labels_source: path to the FASTA file with the labels of the split, or None if there is none.
+    :param destination_sequences_dir: path to write the filtered sequences to.
+    :param destination_labels_dir: path to write the filtered labels to, or None if there are no labels.
+    :param min_size: minimum size of the proteins to be kept.
+    :param max_size: maximum size of the proteins to be kept.
+    :param stage: if set, the number of entries kept and deleted by each filter are recorded on it.
+    :param sequences: entries of sequences_source if already parsed. If None, they are read from the file.
+    :return: a dictionary with the ids deleted by each filter.
+    """
+    predicates = {}
+    if min_size is not None or max_size is not None:
+        logger.info('Filtering proteins by criteria: minsize = {} and maxsize = {}.'.format(min_size, max_size))
+        predicates['size'] = size_predicate(min_size, max_size)
+    # Splits with labels.fasta have a sequences.fasta with all the sequences in the datasets.
+    # Those not in labels.fasta must be removed from sequences.fasta.
+    if labels_source is not None:
+        logger.info(
+            'Equilibrating sequences.fasta according to labels.fasta as needed for biotrainer protocols with '
+            'labels.fasta as input.')
+        predicates['labels'] = ids_predicate(read_FASTA_ids(labels_source))
+    # Some dataset include invalid entrie (set=nan) that must be deleted
+    predicates['invalid'] = valid_set_predicate
+
+    logger.info("Filtering sequences.fasta.")
+    kept_sequences, deleted = filter_FASTA(sequences if sequences is not None else sequences_source,
+                                           destination_sequences_dir, predicates)
+    for entry_id in deleted.get('size', ()):
+        logger.info('Deleted protein {}'.format(entry_id))
+    for entry_id in deleted['invalid']:
+        logger.info('Deleted entry with protein {}'.format(entry_id))
+
+    # Filter labels.fasta if exists
+    if labels_source is not None:
+        logger.info("Filtering labels.fasta.")
+        ids_to_delete = deleted.get('size', set()) | deleted['invalid']
+        kept_labels, _ = filter_FASTA(labels_source, destination_labels_dir,
+                                      {'deleted': lambda entry: entry.id not in ids_to_delete})
+    logger.info('Proteins filtered.')
+
+    if stage is not None:
+        stage.record(sequences=kept_sequences, **{'deleted_' + name: len(ids) for name, ids in deleted.items()})
+        if labels_source is not None:
+            stage.record(labels=kept_labels)
+
+    return deleted
+
+def prepare_data(split: str, protocol: str, working_dir: Path, min_size: int, max_size: int, mask: str,
+                 cache_dir: Optional[Path] = None, cache_max_size: int = prepared_cache_max_size,
+                 manifest: Optional[RunManifest] = None,
+                 parsed_sequences: Optional[Dict[str, List[FASTAEntry]]] = None) -> Tuple[str, str]:
     """
-    Copies the data files from FLIP to the working directory depending on the selected split and protocol. 
-    The data files are then filtered according to the min_size and max_size parameters.
+    Copies the data files from FLIP to the working directory depending on the selected split and protocol.
+    The data files are filtered according to the min_size and max_size parameters while being copied.
+    If a cache directory is given, data already prepared with the same source files and parameters is linked
+    from the cache instead.
 
     :param split: valid FLIP split name.
     :param protocol: valid biotrainer protocol.
@@ -80,80 +186,200 @@ def prepare_data(split: str, protocol: str, working_dir: Path, min_size: int, ma
     :param min_size: minimum size of the proteins to be kept.
     :param max_size: maximum size of the proteins to be kept.
     :param mask: whether to mask the sequences or not.
+    :param cache_dir: path to the prepared data cache. If None, the cache is not used.
+    :param cache_max_size: maximum size in bytes of the prepared data cache.
+    :param manifest: run manifest to record the stages of the preparation on.
+    :param parsed_sequences: entries of the source files already parsed, by path. Other files are read.
     :return: path to the sequences.fasta file and path to the labels.fasta file.
     """
+    manifest = manifest or RunManifest()
+    parsed_sequences = parsed_sequences or {}
     destination_sequences_dir = str(working_dir / 'sequences.fasta')
     destination_labels_dir = str(working_dir / 'labels.fasta')
     destination_masks_dir = str(working_dir / 'mask.fasta')
 
-    # Check if the splits of the dataset are unzipped. If not, unzip them
-    if not os.path.isdir(splits / split_dict[split][0] / 'splits'):
-        logger.info('Splits of the dataset are not unzipped. Unzipping them.')
-        shutil.unpack_archive(splits / split_dict[split][0] / 'splits.zip', splits / split_dict[split][0],
-                              "zip")
-        logger.info('Splits of the dataset unzipped.')
+    # Extract only the files of the split that are not extracted yet
+    required_files = [f'{split_dict[split][1]}.fasta']
+    if protocol == 'residue_to_class':
+        required_files.append('sequences.fasta')
+    if mask:
+        required_files.append(mask)
+    with manifest.stage('extract') as stage:
+        extract_split_files(split_dict[split][0], required_files)
+        stage.record(files=required_files)
 
     # Check if the required FASTA files are available
     # sequence_to_value, sequence_to_class, residues_to_class: SPLIT_NAME.fasta
     # residue_to_class: sequences.fasta + SPLIT_NAME.fasta
+    split_files = splits / split_dict[split][0] / 'splits'
     if protocol in ('sequence_to_value', 'sequence_to_class', 'residues_to_class'):
-        if os.path.exists(splits / split_dict[split][0] / 'splits' / f'{split_dict[split][1]}.fasta'):
-            shutil.copyfile(splits / split_dict[split][0] / 'splits' / f'{split_dict[split][1]}.fasta',
-                            destination_sequences_dir)
-        else:
+        if not os.path.exists(split_files / f'{split_dict[split][1]}.fasta'):
             raise Exception(f"Required files for protocol {protocol} not available.")
+        sequences_source = str(split_files / f'{split_dict[split][1]}.fasta')
+        labels_source = None
         destination_labels_dir = None
     elif protocol in 'residue_to_class':
-        if (not os.path.exists(splits / split_dict[split][0] / 'splits' / f'{split_dict[split][1]}.fasta')
-                and not os.path.exists(splits / split_dict[split][0] / 'splits' / 'sequences.fasta')):
+        if (not os.path.exists(split_files / f'{split_dict[split][1]}.fasta')
+                and not os.path.exists(split_files / 'sequences.fasta')):
             raise Exception(f"Required files for protocol {protocol} not available.")
-
-        shutil.copyfile(splits / split_dict[split][0] / 'splits' / 'sequences.fasta', destination_sequences_dir)
-        shutil.copyfile(splits / split_dict[split][0] / 'splits' / (split_dict[split][1] + '.fasta'),
-                        destination_labels_dir)
+        sequences_source = str(split_files / 'sequences.fasta')
+        labels_source = str(split_files / (split_dict[split][1] + '.fasta'))
     else:
         raise Exception(f"Invalid protocol ({protocol}).")
 
-    # Check whether the mask file exist and copy it, if it was requested
+    # Check whether the mask file exist, if it was requested
+    if mask and not os.path.exists(split_files / f'{mask}'):
+        raise Exception(f"Use of a mask has been requested but file {mask} is not available.")
+
+    prepared_files = [name for name, destination in (('sequences.fasta', destination_sequences_dir),
+                                                      ('labels.fasta', destination_labels_dir),
+                                                      ('mask.fasta', destination_masks_dir if mask else None))
+                      if destination is not None]
+    # Files linked from the cache by a previous run must not be overwritten in place
+    for file_name in prepared_files:
+        if os.path.lexists(working_dir / file_name):
+            os.remove(working_dir / file_name)
+
+    # Reuse the prepared data of a previous run if available
+    if cache_dir is not None:
+        key = _split_key(sequences_source, labels_source, str(split_files / f'{mask}') if mask else None, protocol,
+                         min_size, max_size)
+        os.makedirs(cache_dir, exist_ok=True)
+        with manifest.stage('cache_lookup') as stage:
+            hit = fetch_prepared_data(cache_dir, key, working_dir) is not None
+            stage.record(hit=hit, key=key)
+        if hit:
+            return destination_sequences_dir, destination_labels_dir
+
+    # Link the mask file, if it was requested. Masks are shared by all the splits of the dataset
     if mask:
-        if os.path.exists(splits / split_dict[split][0] / 'splits' / f'{mask}'):
-            shutil.copyfile(splits / split_dict[split][0] / 'splits' / f'{mask}', destination_masks_dir)
-        else:
-            raise Exception(f"Use of a mask has been requested but file {mask} is not available.")
+        with manifest.stage('copy_mask') as stage:
+            link_file(str(split_files / f'{mask}'), destination_masks_dir)
+            stage.record_file('mask_bytes', destination_masks_dir)
 
-    # Data already in FASTA format. Let's filter by minsize and maxsize
-    if min_size is not None or max_size is not None:
-        logger.info('Filtering proteins by criteria: minsize = {} and maxsize = {}.'.format(min_size, max_size))
+    # Data already in FASTA format. Stream it to the working directory applying all the filters at once
+    with manifest.stage('filter') as stage:
+        # The sequences.fasta of residue-level splits has the sequences of the whole dataset. If the dataset is
+        # indexed, only the sequences of the split are read from it
+        sequences = parsed_sequences.get(sequences_source)
+        if sequences is None and labels_source is not None:
+            sequences = indexed_entries(split_dict[split][0], 'sequences.fasta', read_FASTA_ids(labels_source))
+            stage.record(indexed=sequences is not None)
+        filter_split(sequences_source, labels_source, destination_sequences_dir, destination_labels_dir,
+                     min_size, max_size, stage, sequences)
+        stage.record_file('source_sequences_bytes', sequences_source)
+        stage.record_file('sequences_bytes', destination_sequences_dir)
+        stage.record_file('labels_bytes', destination_labels_dir)
 
-        # Filter sequence.fasta
-        logger.info("Filtering proteins from sequences.fasta.")
-        fasta_sequences_entries = read_FASTA(destination_sequences_dir)
-        new_fasta_entries, ids_deleted_proteins = filter_fasta_enties_size(fasta_sequences_entries, min_size, max_size)
-        overwrite_FASTA(new_fasta_entries, destination_sequences_dir)
+    if cache_dir is not None:
+        with manifest.stage('cache_store'):
+            store_prepared_data(cache_dir, key, working_dir, prepared_files, cache_max_size)
 
-        # Filter labels.fasta if exists
-        if destination_labels_dir is not None:
-            logger.info("Filtering proteins from labels.fasta.")
-            # fasta_sequences_entries = read_FASTA(destination_labels_dir)
-            delete_entries_FASTA(ids_deleted_proteins, destination_labels_dir)
+    return destination_sequences_dir, destination_labels_dir
 
-        logger.info('Proteins filtered.')
 
-    # Splits with labels.fasta have a sequences.fasta with all the sequences in the datasets.
-    # Those not in labels.fasta must be removed from sequences.fasta.
-    if destination_labels_dir is not None:
-        logger.info(
-            'Equilibrating sequences.fasta according to labels.fasta as needed for biotrainer protocols with '
-            'labels.fasta as input.')
-        equilibrate_sequences(destination_sequences_dir, destination_labels_dir)
+def _split_key(sequences_source: str, labels_source: Optional[str], mask_source: Optional[str], protocol: str,
+               min_size: int, max_size: int) -> str:
+    # Key of the prepared data of a split in the prepared data cache
+    sources = [source for source in (sequences_source, labels_source, mask_source) if source is not None]
+    return prepared_data_key(sources, {'protocol': protocol, 'min_size': min_size, 'max_size': max_size,
+                                       'mask': mask_source is not None})
 
-    # Some dataset include invalid entrie (set=nan) that must be deleted
-    logger.info("Filtering invalid FASTA entries.")
-    fasta_sequences_entries = read_FASTA(destination_sequences_dir)
-    new_fasta_entries, ids_deleted_proteins = filter_fasta_invalid_entries(fasta_sequences_entries)
-    overwrite_FASTA(new_fasta_entries, destination_sequences_dir)
-    if destination_labels_dir is not None:
-        delete_entries_FASTA(ids_deleted_proteins, destination_labels_dir)
-    logger.info('Invalid FASTA entries filtered.')
 
-    return destination_sequences_dir, destination_labels_dir
+def _is_cached(split: str, min_size: int, max_size: int, mask: str, cache_dir: Optional[Path]) -> bool:
+    # Whether the prepared data of a residue-level split is in the cache, so preparing it reads no sequences
+    split_files = splits / split_dict[split][0] / 'splits'
+    sequences_source = str(split_files / 'sequences.fasta')
+    labels_source = str(split_files / f'{split_dict[split][1]}.fasta')
+    mask_source = str(split_files / mask) if mask else None
+    sources = [source for source in (sequences_source, labels_source, mask_source) if source is not None]
+    if cache_dir is None or not all(os.path.exists(source) for source in sources):
+        return False
+    key = _split_key(sequences_source, labels_source, mask_source, 'residue_to_class', min_size, max_size)
+    return os.path.exists(Path(cache_dir) / key / 'manifest.json')
+
+
+def _prepare_split_job(split: str, protocol: str, working_dir: Path, min_size: int, max_size: int, mask: str,
+                       cache_dir: Optional[Path], cache_max_size: int) -> Tuple[Tuple[str, str], List[Dict[str, any]]]:
+    # Runs in the workers of prepare_splits, with the sequences parsed by the parent process
+    manifest = RunManifest(split=split)
+    os.makedirs(working_dir, exist_ok=True)
+    prepared = prepare_data(split, protocol, working_dir, min_size, max_size, mask, cache_dir, cache_max_size,
+                            manifest, _parsed_sequences)
+    return prepared, manifest.stages
+
+
+def prepare_splits(working_dirs: Dict[str, Path], protocol: Optional[str] = None, min_size: int = None,
+                   max_size: int = None, mask: str = None, cache_dir: Optional[Path] = None,
+                   cache_max_size: int = prepared_cache_max_size, workers: int = 1,
+                   manifest: Optional[RunManifest] = None) -> Dict[str, Tuple[str, str]]:
+    """
+    Prepares many splits at once, e.g. all the splits of a dataset. The files of every dataset are extracted
+    once and the sequences.fasta shared by the residue-level splits of a dataset is parsed only once; then the
+    splits are filtered into their working directories by a pool of workers. Each split is prepared as in
+    prepare_data, so splits already in the prepared data cache are linked from it.
+
+    :param working_dirs: working directory of every split to prepare, by split name
+    :param protocol: valid biotrainer protocol. If None, the protocol of the dataset of each split is used
+    :param min_size: minimum size of the proteins to be kept.
+    :param max_size: maximum size of the proteins to be kept.
+    :param mask: whether to mask the sequences or not.
+    :param cache_dir: path to the prepared data cache. If None, the cache is not used.
+    :param cache_max_size: maximum size in bytes of the prepared data cache.
+    :param workers: maximum number of splits prepared at the same time.
+    :param manifest: run manifest to record the stages of the preparation on.
+    :return: path to the sequences.fasta file and path to the labels.fasta file of every split, by split name.
+    """
+    manifest = manifest or RunManifest()
+    protocols = {split: protocol or FLIP_DATASETS[split_dict[split][0]]['protocol'] for split in working_dirs}
+    datasets = {}
+    for split in working_dirs:
+        datasets.setdefault(split_dict[split][0], []).append(split)
+
+    with manifest.stage('extract') as stage:
+        for dataset, dataset_splits in datasets.items():
+            required_files = {f'{split_dict[split][1]}.fasta' for split in dataset_splits}
+            if any(protocols[split] == 'residue_to_class' for split in dataset_splits):
+                required_files.add('sequences.fasta')
+            if mask:
+                required_files.add(mask)
+            extract_split_files(dataset, sorted(required_files))
+        stage.record(datasets=len(datasets), splits=len(working_dirs))
+
+    # Only the sequences shared by several splits are worth keeping in memory. Splits already in the prepared data
+    # cache are linked from it without reading them
+    with manifest.stage('parse') as stage:
+        cached = 0
+        for dataset, dataset_splits in datasets.items():
+            sequences_source = splits / dataset / 'splits' / 'sequences.fasta'
+            shared = [split for split in dataset_splits if protocols[split] == 'residue_to_class']
+            missing = [split for split in shared if not _is_cached(split, min_size, max_size, mask, cache_dir)]
+            cached += len(shared) - len(missing)
+            if len(missing) > 1 and os.path.exists(sequences_source):
+                _parsed_sequences[str(sequences_source)] = list(iterate_FASTA(str(sequences_source)))
+        stage.record(files=len(_parsed_sequences), cached=cached,
+                     sequences=sum(len(entries) for entries in _parsed_sequences.values()))
+
+    results, manifests = {}, {}
+    try:
+        with manifest.stage('prepare') as stage:
+            arguments = {split: (split, protocols[split], Path(working_dir), min_size, max_size, mask, cache_dir,
+                                 cache_max_size) for split, working_dir in working_dirs.items()}
+            workers = max(1, min(workers, len(arguments)))
+            if workers == 1:
+                for split, split_arguments in arguments.items():
+                    results[split], manifests[split] = _prepare_split_job(*split_arguments)
+            else:
+                # Fork shares the parsed sequences with the workers. Other start methods read the files again
+                context = multiprocessing.get_context('fork') \
+                    if 'fork' in multiprocessing.get_all_start_methods() else None
+                with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                    futures = {split: pool.submit(_prepare_split_job, *split_arguments)
+                               for split, split_arguments in arguments.items()}
+                    for split, future in futures.items():
+                        results[split], manifests[split] = future.result()
+            stage.record(workers=workers, splits=manifests)
+    finally:
+        _parsed_sequences.clear()
+
+    return results
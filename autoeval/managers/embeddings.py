@@ -0,0 +1,383 @@
+import os
+import re
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+
+from .landscape import landscape_batches
+from ..utilities.FASTA import iterate_FASTA
+from ..utilities.locking import file_lock
+
+logger = logging.getLogger(__name__)
+
+# Protocols trained on one embedding per protein. The rest use one embedding per residue
+PER_SEQUENCE_PROTOCOLS = ('sequence_to_class', 'sequence_to_value')
+
+# Map of the ids of a split to the keys of their sequences, written next to its embeddings file
+SEQUENCE_MAP_FILE = 'sequence_map.tsv'
+
+# Embedding services already loaded in this process, by embedder name
+_embedding_services = {}
+
+
+class ShardingOptions(NamedTuple):
+    """
+    How to split the sequences to embed into shards of similar lengths.
+
+    - boundaries: sorted upper length limits of the shards. Longer sequences go to a last shard
+    - max_residues: residues per embedding batch. Shards of sequences longer than this are embedded one by one
+    - workers: number of shards embedded at the same time, each in its own process
+    - strategy: one of the embedding_strategies of the settings. With landscape, boundaries and workers are not used
+    """
+    boundaries: List[int]
+    max_residues: int
+    workers: int = 1
+    strategy: str = 'length'
+
+
+def sequence_hash(sequence: str) -> str:
+    """
+    Computes the key of a sequence in the embedding stores.
+
+    :param sequence: protein sequence
+    :return: the hexadecimal sha256 digest of the sequence.
+    """
+    return hashlib.sha256(sequence.encode()).hexdigest()
+
+
+def deduplicate_sequences(sequences_file: str) -> Tuple[List[Tuple[str, str]], Dict[str, str]]:
+    """
+    Finds the unique sequences of a FASTA file. Identical sequences under different ids share the same key.
+
+    :param sequences_file: path to a valid FASTA file with the sequences
+    :return: the list of (id, key) of every entry, in the order of the file, and a dictionary of the keys to the
+        unique sequences.
+    """
+    ids_to_keys, unique = [], {}
+    for entry in iterate_FASTA(sequences_file):
+        key = sequence_hash(entry.seq)
+        ids_to_keys.append((entry.id, key))
+        unique.setdefault(key, entry.seq)
+
+    if len(unique) < len(ids_to_keys):
+        logger.info('{} unique sequences out of {} ({:.1%} duplicated).'.format(
+            len(unique), len(ids_to_keys), 1 - len(unique) / len(ids_to_keys)))
+
+    return ids_to_keys, unique
+
+
+def write_sequence_map(map_file: str, ids_to_keys: List[Tuple[str, str]]):
+    """
+    Writes the map of ids to sequence keys of a split as a tab-separated file.
+
+    :param map_file: path to the file to write
+    :param ids_to_keys: list of (id, key), as returned by deduplicate_sequences
+    """
+    with open(map_file, 'w') as mfile:
+        mfile.write('id\tsequence_hash\n')
+        for seq_id, key in ids_to_keys:
+            mfile.write('{}\t{}\n'.format(seq_id, key))
+
+
+def read_sequence_map(map_file: str) -> Dict[str, str]:
+    """
+    Reads the map of ids to sequence keys of a split.
+
+    :param map_file: path to a file written by write_sequence_map
+    :return: a dictionary of ids to sequence keys.
+    """
+    with open(map_file, 'r') as mfile:
+        next(mfile)
+        return dict(line.rstrip('\n').split('\t') for line in mfile)
+
+
+def _entries_by_key(ids_to_keys: List[Tuple[str, str]]) -> Dict[str, List[Tuple[str, str]]]:
+    # Datasets (index in the split, id) of the embeddings file that get the embedding of every sequence key
+    entries = {}
+    for idx, (seq_id, key) in enumerate(ids_to_keys):
+        entries.setdefault(key, []).append((str(idx), seq_id))
+    return entries
+
+
+def embedding_store_file(store_dir: Path, dataset: str, embedder_name: str, protocol: str) -> Path:
+    """
+    Path to the embedding store of a dataset and an embedder. Per-protein and per-residue embeddings are kept
+    in different stores.
+
+    :param store_dir: path to the directory with all the embedding stores
+    :param dataset: FLIP dataset name
+    :param embedder_name: name of the embedder
+    :param protocol: biotrainer protocol the embeddings are computed for
+    :return: the path to the h5 file of the store.
+    """
+    reduction = 'per_sequence' if protocol in PER_SEQUENCE_PROTOCOLS else 'per_residue'
+    return Path(store_dir) / dataset / '{}_{}.h5'.format(re.sub(r'[^A-Za-z0-9_.-]+', '_', embedder_name), reduction)
+
+
+def _get_embedding_service(embedder_name: str):
+    if embedder_name not in _embedding_services:
+        from biotrainer.embedders import get_embedding_service
+        logger.info('Loading embedder {}.'.format(embedder_name))
+        _embedding_services[embedder_name] = get_embedding_service(embeddings_file_path=None,
+                                                                   embedder_name=embedder_name,
+                                                                   custom_tokenizer_config=None,
+                                                                   use_half_precision=False, device=None)
+    return _embedding_services[embedder_name]
+
+
+def _get_embedder(embedder_name: str):
+    # biotrainer has no public accessor for the embedder of an embedding service. Its embedder is reached through
+    # the service, so a biotrainer release changing it fails here with a clear error instead of deep in a run
+    service = _get_embedding_service(embedder_name)
+    embedder = getattr(service, 'embedder', None) or getattr(service, '_embedder', None)
+    if not all(callable(getattr(embedder, method, None)) for method in ('embed_many', 'reduce_per_protein')):
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            installed = version('biotrainer')
+        except PackageNotFoundError:
+            installed = 'unknown'
+        raise Exception(f"The embedding service of biotrainer {installed} does not provide an embedder with "
+                        f"embed_many and reduce_per_protein. AutoEval needs the biotrainer version of its "
+                        f"pyproject.toml (develop branch), whose EmbeddingService keeps the embedder it loads.")
+    return embedder
+
+
+def _to_numpy(embedding) -> np.ndarray:
+    if hasattr(embedding, 'cpu'):
+        embedding = embedding.cpu().numpy()
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def compute_embeddings(sequences: Dict[str, str], embedder_name: str, reduce: bool,
+                       batch_size: Optional[int] = None) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Embeds sequences with a biotrainer embedder. The embedder is loaded once per process and reused afterwards.
+
+    :param sequences: dictionary of keys to protein sequences
+    :param embedder_name: name of the embedder
+    :param reduce: whether to reduce the embeddings to one embedding per protein
+    :param batch_size: maximum number of residues per batch. If None, the default of the embedder is used
+    :return: an iterator of (key, embedding) tuples, in the order of the dictionary.
+    """
+    embedder = _get_embedder(embedder_name)
+    keys = list(sequences.keys())
+    for key, embedding in zip(keys, embedder.embed_many([sequences[key] for key in keys], batch_size)):
+        if reduce:
+            embedding = embedder.reduce_per_protein(embedding)
+        yield key, _to_numpy(embedding)
+
+
+def shard_sequences(sequences: Dict[str, str], boundaries: List[int]) -> List[Dict[str, str]]:
+    """
+    Splits sequences into shards by length: one shard per boundary with the sequences not longer than it
+    (and longer than the previous one), plus a last shard with the longer sequences. Empty shards are dropped.
+
+    :param sequences: dictionary of keys to protein sequences
+    :param boundaries: upper length limits of the shards
+    :return: the list of shards, from the shortest to the longest sequences.
+    """
+    boundaries = sorted(boundaries)
+    shards = [{} for _ in range(len(boundaries) + 1)]
+    for key, sequence in sequences.items():
+        shards[int(np.searchsorted(boundaries, len(sequence)))][key] = sequence
+
+    return [shard for shard in shards if shard]
+
+
+def _embed_shard(shard: Dict[str, str], embedder_name: str, reduce: bool, batch_size: int, output_file: str):
+    import h5py
+
+    with h5py.File(output_file, 'w') as output:
+        for key, embedding in compute_embeddings(shard, embedder_name, reduce, batch_size):
+            output.create_dataset(key, data=embedding)
+
+
+def compute_embeddings_sharded(sequences: Dict[str, str], embedder_name: str, reduce: bool,
+                               sharding: ShardingOptions) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Embeds sequences shard by shard, grouping them by length so short sequences are batched together and long
+    ones do not raise the peak memory of the whole run. Each shard is embedded with batches of at most
+    sharding.max_residues residues (or one sequence at a time if they are longer). With more than one worker,
+    shards are embedded in parallel processes, each loading the embedder once, and merged afterwards.
+
+    :param sequences: dictionary of keys to protein sequences
+    :param embedder_name: name of the embedder
+    :param reduce: whether to reduce the embeddings to one embedding per protein
+    :param sharding: how to split the sequences into shards
+    :return: an iterator of (key, embedding) tuples.
+    """
+    import h5py
+
+    shards = shard_sequences(sequences, sharding.boundaries)
+    batch_sizes = [max(sharding.max_residues, max(len(sequence) for sequence in shard.values()))
+                   for shard in shards]
+    logger.info('Embedding {} sequences in {} shards of sizes {}.'.format(
+        len(sequences), len(shards), [len(shard) for shard in shards]))
+
+    if sharding.workers <= 1:
+        for shard, batch_size in zip(shards, batch_sizes):
+            yield from compute_embeddings(shard, embedder_name, reduce, batch_size)
+        return
+
+    shards_dir = tempfile.mkdtemp(prefix='autoeval-shards-')
+    try:
+        shard_files = [os.path.join(shards_dir, 'shard_{}.h5'.format(i)) for i in range(len(shards))]
+        # Longest shards first, so they do not end up alone at the end
+        with ProcessPoolExecutor(max_workers=sharding.workers) as pool:
+            futures = [pool.submit(_embed_shard, shards[i], embedder_name, reduce, batch_sizes[i], shard_files[i])
+                       for i in reversed(range(len(shards)))]
+            for future in futures:
+                future.result()
+
+        for shard_file in shard_files:
+            with h5py.File(shard_file, 'r') as shard:
+                for key in shard:
+                    yield key, shard[key][()]
+    finally:
+        shutil.rmtree(shards_dir, ignore_errors=True)
+
+
+def compute_embeddings_landscape(sequences: Dict[str, str], embedder_name: str, reduce: bool,
+                                 max_residues: int) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Embeds the variants of a mutational landscape (e.g. aav or gb1) in batches of sequences with the same length
+    and similar edit patterns from the detected wild type, so no residue is spent on padding.
+
+    :param sequences: dictionary of keys to protein sequences
+    :param embedder_name: name of the embedder
+    :param reduce: whether to reduce the embeddings to one embedding per protein
+    :param max_residues: maximum number of residues per batch
+    :return: an iterator of (key, embedding) tuples.
+    """
+    for batch in landscape_batches(sequences, max_residues):
+        yield from compute_embeddings({key: sequences[key] for key in batch}, embedder_name, reduce,
+                                      len(batch) * len(sequences[batch[0]]))
+
+
+def _embed(sequences: Dict[str, str], embedder_name: str, reduce: bool,
+           sharding: Optional[ShardingOptions]) -> Iterator[Tuple[str, np.ndarray]]:
+    if sharding is None:
+        return compute_embeddings(sequences, embedder_name, reduce)
+    if sharding.strategy == 'landscape':
+        return compute_embeddings_landscape(sequences, embedder_name, reduce, sharding.max_residues)
+    return compute_embeddings_sharded(sequences, embedder_name, reduce, sharding)
+
+
+def write_embeddings(sequences_file: str, embeddings_file: str, embedder_name: str, protocol: str,
+                     sharding: Optional[ShardingOptions] = None) -> int:
+    """
+    Embeds the sequences of a FASTA file into an embeddings file for biotrainer, reusing the embedder already
+    loaded in this process if any. Identical sequences are embedded once and their embedding is written for
+    all their ids. The map of ids to sequences is written next to the embeddings file.
+
+    :param sequences_file: path to a valid FASTA file with the sequences
+    :param embeddings_file: path to the h5 embeddings file to write
+    :param embedder_name: name of the embedder
+    :param protocol: biotrainer protocol the embeddings are computed for
+    :param sharding: if set, embed the sequences in shards by length
+    :return: the number of sequences embedded.
+    """
+    import h5py
+
+    ids_to_keys, unique = deduplicate_sequences(sequences_file)
+    write_sequence_map(str(Path(embeddings_file).with_name(SEQUENCE_MAP_FILE)), ids_to_keys)
+    entries = _entries_by_key(ids_to_keys)
+
+    with h5py.File(embeddings_file, 'w') as output:
+        for key, embedding in _embed(unique, embedder_name, protocol in PER_SEQUENCE_PROTOCOLS, sharding):
+            for idx, seq_id in entries[key]:
+                output.create_dataset(idx, data=embedding)
+                output[idx].attrs["original_id"] = seq_id
+
+    return len(unique)
+
+
+def _store_lock(store_file: Path):
+    # Lock of a store, held to write it and to read it: HDF5 refuses to open a file for reading while another
+    # process has it open for writing, so readers must wait for the writers too
+    return file_lock(Path(str(store_file) + '.lock'))
+
+
+def update_embedding_store(store_file: Path, sequences_file: str, embedder_name: str, protocol: str,
+                           sharding: Optional[ShardingOptions] = None) -> int:
+    """
+    Adds to an embedding store the sequences of a FASTA file that are not in it yet.
+
+    :param store_file: path to the h5 file of the store
+    :param sequences_file: path to a valid FASTA file with the sequences
+    :param embedder_name: name of the embedder
+    :param protocol: biotrainer protocol the embeddings are computed for
+    :param sharding: if set, embed the missing sequences in shards by length
+    :return: the number of sequences embedded.
+    """
+    import h5py
+
+    # Concurrent runs on the same dataset wait for each other instead of embedding the same sequences twice
+    with _store_lock(store_file):
+        with h5py.File(store_file, 'a') as store:
+            _, unique = deduplicate_sequences(sequences_file)
+            missing = {key: sequence for key, sequence in unique.items() if key not in store}
+
+            if missing:
+                logger.info('Embedding {} sequences missing from the store {}.'.format(len(missing), store_file))
+                for key, embedding in _embed(missing, embedder_name, protocol in PER_SEQUENCE_PROTOCOLS, sharding):
+                    store.create_dataset(key, data=embedding)
+            else:
+                logger.info('All sequences already in the store {}.'.format(store_file))
+
+    return len(missing)
+
+
+def write_split_embeddings(store_file: Path, sequences_file: str, embeddings_file: str):
+    """
+    Writes the embeddings of the sequences of a FASTA file from a store to an embeddings file for biotrainer,
+    and the map of ids to sequences next to it. The embedding of every unique sequence is read once. The store is
+    read holding its lock, so runs updating it at the same time do not make it fail.
+
+    :param store_file: path to the h5 file of the store
+    :param sequences_file: path to a valid FASTA file with the sequences
+    :param embeddings_file: path to the h5 embeddings file to write
+    """
+    import h5py
+
+    ids_to_keys, _ = deduplicate_sequences(sequences_file)
+    write_sequence_map(str(Path(embeddings_file).with_name(SEQUENCE_MAP_FILE)), ids_to_keys)
+    with _store_lock(store_file), h5py.File(store_file, 'r') as store, h5py.File(embeddings_file, 'w') as output:
+        for key, entries in _entries_by_key(ids_to_keys).items():
+            embedding = store[key][()]
+            for idx, seq_id in entries:
+                output.create_dataset(idx, data=embedding)
+                output[idx].attrs["original_id"] = seq_id
+
+
+def prepare_embeddings(sequences_file: str, working_dir: Path, store_dir: Path, dataset: str, embedder_name: str,
+                       protocol: str, sharding: Optional[ShardingOptions] = None) -> str:
+    """
+    Computes the embeddings of the prepared sequences missing from the store of the dataset, and writes the
+    embeddings of the prepared sequences to the working directory.
+
+    :param sequences_file: path to the prepared sequences.fasta file
+    :param working_dir: path to the working directory
+    :param store_dir: path to the directory with all the embedding stores
+    :param dataset: FLIP dataset name
+    :param embedder_name: name of the embedder
+    :param protocol: biotrainer protocol the embeddings are computed for
+    :param sharding: if set, embed the missing sequences in shards by length
+    :return: the path to the embeddings file in the working directory.
+    """
+    store_file = embedding_store_file(store_dir, dataset, embedder_name, protocol)
+    store_file.parent.mkdir(parents=True, exist_ok=True)
+    update_embedding_store(store_file, sequences_file, embedder_name, protocol, sharding)
+
+    embeddings_file = str(Path(working_dir) / 'embeddings.h5')
+    write_split_embeddings(store_file, sequences_file, embeddings_file)
+    logger.info('Embeddings of the split written to {}.'.format(embeddings_file))
+
+    return embeddings_file
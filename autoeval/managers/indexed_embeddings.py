@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import argparse
+import logging
+
+import numpy as np
+
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from ..utilities.FASTA import iterate_FASTA
+
+logger = logging.getLogger(__name__)
+
+# Files of an indexed embeddings directory
+EMBEDDINGS_ARRAY = 'embeddings.npy'
+OFFSETS_ARRAY = 'offsets.npy'
+IDS_FILE = 'ids.txt'
+METADATA_FILE = 'metadata.json'
+
+
+class IndexedEmbeddings:
+    """
+    Read-only view of an indexed embeddings directory: all the embeddings concatenated in one contiguous float
+    array, memory-mapped, plus the offset of the first row of every sequence id. Only the rows of the ids
+    accessed are read from disk.
+    """
+
+    def __init__(self, path: str):
+        path = Path(path)
+        with open(path / METADATA_FILE, 'r') as mfile:
+            self.metadata = json.load(mfile)
+        with open(path / IDS_FILE, 'r') as ifile:
+            self.ids = ifile.read().split('\n') if self.metadata['count'] else []
+        self.offsets = np.load(path / OFFSETS_ARRAY)
+        self.embeddings = np.load(path / EMBEDDINGS_ARRAY, mmap_mode='r')
+        self._positions = {seq_id: position for position, seq_id in enumerate(self.ids)}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, seq_id: str) -> bool:
+        return seq_id in self._positions
+
+    def __getitem__(self, seq_id: str) -> np.ndarray:
+        position = self._positions[seq_id]
+        embedding = self.embeddings[self.offsets[position]:self.offsets[position + 1]]
+        # Per-protein embeddings are stored as one row
+        return embedding[0] if self.metadata['reduced'] else embedding
+
+
+def is_indexed_embeddings(path: str) -> bool:
+    """
+    Checks whether a path is an indexed embeddings directory.
+
+    :param path: path to check
+    :return: True if it is an indexed embeddings directory.
+    """
+    return os.path.isfile(Path(path) / METADATA_FILE) and os.path.isfile(Path(path) / EMBEDDINGS_ARRAY)
+
+
+def build_indexed_embeddings(embeddings_file: str, output_dir: str):
+    """
+    Converts an h5 embeddings file into an indexed embeddings directory. Embeddings are copied one at a time,
+    so the h5 file is never loaded fully in memory.
+
+    :param embeddings_file: path to an h5 embeddings file. Sequence ids are read from the original_id attribute
+        of each dataset if available, and from its name otherwise
+    :param output_dir: path to the indexed embeddings directory to create
+    """
+    import h5py
+
+    output_dir = Path(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    with h5py.File(embeddings_file, 'r') as h5_file:
+        keys = list(h5_file.keys())
+        if not keys:
+            raise Exception(f"No embeddings in {embeddings_file}.")
+        shapes = [h5_file[key].shape for key in keys]
+        reduced = len(shapes[0]) == 1
+        rows = np.array([1 if reduced else shape[0] for shape in shapes], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(rows)))
+
+        embeddings = np.lib.format.open_memmap(output_dir / EMBEDDINGS_ARRAY, mode='w+', dtype=np.float32,
+                                               shape=(int(offsets[-1]), shapes[0][-1]))
+        ids = []
+        for position, key in enumerate(keys):
+            dataset = h5_file[key]
+            embeddings[offsets[position]:offsets[position + 1]] = dataset[()].reshape(rows[position], -1)
+            ids.append(dataset.attrs.get("original_id", key))
+        embeddings.flush()
+        del embeddings
+
+    np.save(output_dir / OFFSETS_ARRAY, offsets)
+    with open(output_dir / IDS_FILE, 'w') as ifile:
+        ifile.write('\n'.join(ids))
+    with open(output_dir / METADATA_FILE, 'w') as mfile:
+        json.dump({'count': len(ids), 'dimension': int(shapes[0][-1]), 'reduced': reduced,
+                   'source': str(embeddings_file)}, mfile)
+    logger.info('Indexed {} embeddings from {} in {}.'.format(len(ids), embeddings_file, output_dir))
+
+
+def write_indexed_embeddings_subset(indexed_dir: str, ids: Iterable[str], embeddings_file: str):
+    """
+    Writes the embeddings of some sequence ids from an indexed embeddings directory to an h5 embeddings file
+    for biotrainer. Only the rows of the requested ids are read.
+
+    :param indexed_dir: path to the indexed embeddings directory
+    :param ids: sequence ids to write
+    :param embeddings_file: path to the h5 embeddings file to write
+    """
+    import h5py
+
+    indexed = IndexedEmbeddings(indexed_dir)
+    missing = []
+    with h5py.File(embeddings_file, 'w') as output:
+        idx = 0
+        for seq_id in ids:
+            if seq_id not in indexed:
+                missing.append(seq_id)
+                continue
+            output.create_dataset(str(idx), data=np.asarray(indexed[seq_id]))
+            output[str(idx)].attrs["original_id"] = seq_id
+            idx += 1
+
+    if missing:
+        logger.warning('{} sequences have no embedding in {}: {}'.format(len(missing), indexed_dir,
+                                                                         ', '.join(missing[:10])))
+
+
+def prepare_indexed_embeddings(indexed_dir: str, sequences_file: str, working_dir: Path) -> str:
+    """
+    Writes the embeddings of the prepared sequences from an indexed embeddings directory to the working directory.
+
+    :param indexed_dir: path to the indexed embeddings directory
+    :param sequences_file: path to the prepared sequences.fasta file
+    :param working_dir: path to the working directory
+    :return: the path to the embeddings file in the working directory.
+    """
+    embeddings_file = str(Path(working_dir) / 'embeddings.h5')
+    write_indexed_embeddings_subset(indexed_dir, (entry.id for entry in iterate_FASTA(sequences_file)),
+                                    embeddings_file)
+    logger.info('Embeddings of the split written to {}.'.format(embeddings_file))
+
+    return embeddings_file
+
+
+def main(args: Optional[List[str]] = None):
+    """
+    Entry point to build an indexed embeddings directory from an h5 embeddings file
+    """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Build an indexed, memory-mapped embeddings directory from an h5 embeddings file.")
+    parser.add_argument("embeddings_file", type=str, help="The path to the h5 embeddings file.")
+    parser.add_argument("output_dir", type=str, help="The path to the indexed embeddings directory to create.")
+    arguments = parser.parse_args(args)
+
+    build_indexed_embeddings(arguments.embeddings_file, arguments.output_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import logging
+
+import numpy as np
+
+from collections import Counter
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Rows of sequences compared with the wild type at once, to bound the memory of the comparisons
+_CHUNK_ROWS = 8192
+
+
+def _as_array(sequences: List[str], length: int) -> np.ndarray:
+    # Sequences of the same length as a (sequences, length) array of bytes
+    return np.frombuffer(''.join(sequences).encode(), dtype=np.uint8).reshape(len(sequences), length)
+
+
+def detect_wild_type(sequences: List[str]) -> str:
+    """
+    Detects the parent sequence of a mutational landscape: the consensus of the sequences with the most common
+    length, i.e. the most frequent residue at every position.
+
+    :param sequences: protein sequences of the landscape
+    :return: the wild type sequence.
+    """
+    length = Counter(len(sequence) for sequence in sequences).most_common(1)[0][0]
+    same_length = [sequence for sequence in sequences if len(sequence) == length]
+    counts = np.zeros(length * 256, dtype=np.int64)
+    columns = np.arange(length, dtype=np.int64) * 256
+    for start in range(0, len(same_length), _CHUNK_ROWS):
+        residues = _as_array(same_length[start:start + _CHUNK_ROWS], length)
+        counts += np.bincount((residues + columns).ravel(), minlength=length * 256)
+
+    return bytes(counts.reshape(length, 256).argmax(axis=1).astype(np.uint8)).decode()
+
+
+def edit_patterns(sequences: Dict[str, str], wild_type: str) -> Dict[str, Tuple[int, ...]]:
+    """
+    Computes the positions where every sequence differs from the wild type. Sequences with insertions or
+    deletions are compared up to the shortest length.
+
+    :param sequences: dictionary of keys to protein sequences
+    :param wild_type: the wild type sequence
+    :return: a dictionary of keys to the mutated positions of their sequence.
+    """
+    by_length = {}
+    for key, sequence in sequences.items():
+        by_length.setdefault(len(sequence), []).append(key)
+
+    patterns = {}
+    for length, keys in by_length.items():
+        compared = min(length, len(wild_type))
+        reference = np.frombuffer(wild_type[:compared].encode(), dtype=np.uint8)
+        for start in range(0, len(keys), _CHUNK_ROWS):
+            chunk = keys[start:start + _CHUNK_ROWS]
+            residues = _as_array([sequences[key][:compared] for key in chunk], compared)
+            rows, positions = np.nonzero(residues != reference)
+            splits = np.searchsorted(rows, np.arange(1, len(chunk)))
+            for key, mutated in zip(chunk, np.split(positions, splits)):
+                patterns[key] = tuple(mutated.tolist())
+
+    return patterns
+
+
+def landscape_batches(sequences: Dict[str, str], max_residues: int) -> List[List[str]]:
+    """
+    Groups the variants of a mutational landscape into embedding batches. Variants are sorted by length and edit
+    pattern (number and positions of the mutations from the wild type), and every batch only has sequences of the
+    same length, so batches need no padding and variants mutated at the same positions are embedded together.
+
+    :param sequences: dictionary of keys to protein sequences
+    :param max_residues: maximum number of residues per batch. Longer sequences are embedded one at a time
+    :return: the list of batches, as lists of keys.
+    """
+    if not sequences:
+        return []
+    wild_type = detect_wild_type(list(sequences.values()))
+    patterns = edit_patterns(sequences, wild_type)
+    order = sorted(sequences, key=lambda key: (len(sequences[key]), len(patterns[key]), patterns[key]))
+
+    batches, current = [], []
+    for key in order:
+        if current and (len(sequences[key]) != len(sequences[current[0]])
+                        or (len(current) + 1) * len(sequences[key]) > max_residues):
+            batches.append(current)
+            current = []
+        current.append(key)
+    batches.append(current)
+
+    mutations = np.array([len(pattern) for pattern in patterns.values()])
+    logger.info('Mutational landscape of {} variants of a wild type of length {}: {:.1f} mutations on average, '
+                '{} lengths, {} batches.'.format(len(sequences), len(wild_type), mutations.mean(),
+                                                  len(set(len(sequence) for sequence in sequences.values())),
+                                                  len(batches)))
+    if np.median(mutations) > len(wild_type) / 10:
+        logger.warning('The sequences do not look like variants of a single wild type. The landscape strategy '
+                       'only groups them by length.')
+
+    return batches
@@ -0,0 +1,295 @@
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import logging
+
+import numpy as np
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from ..utilities.FASTA import FASTAEntry, iterate_FASTA, write_FASTA_entry
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout of the prepared split changes
+PREPARED_SPLIT_VERSION = 1
+
+# Name of the prepared split directory in the working directory
+PREPARED_SPLIT_DIR = 'prepared_split'
+METADATA_FILE = 'metadata.json'
+
+# Text columns, stored as one array of bytes plus the offsets of every row
+TEXT_COLUMNS = ('ids', 'descriptions', 'sequences', 'label_descriptions', 'labels', 'masks')
+
+# Residue columns stored as bits when they only have 0 and 1, as binding labels and masks do
+BINARY_COLUMNS = ('labels', 'masks')
+
+_SET_PATTERN = re.compile(r'SET=(\S+)')
+_VALIDATION_PATTERN = re.compile(r'VALIDATION=(\S+)')
+_TARGET_PATTERN = re.compile(r'TARGET=(\S+)')
+
+
+def _pack(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    # Strings as one contiguous array of bytes and the offsets of every string, as uint32 if they fit
+    encoded = [string.encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    if offsets[-1] <= np.iinfo(np.uint32).max:
+        offsets = offsets.astype(np.uint32)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _header(seq_id: str, description: str) -> str:
+    # Headers are stored without the id they start with, as most of them do. The rest are marked with a NUL
+    return description[len(seq_id):] if description.startswith(seq_id) else '\0' + description
+
+
+def _restore_header(seq_id: str, header: str) -> str:
+    return header[1:] if header.startswith('\0') else seq_id + header
+
+
+def _save(output_dir: Path, name: str, array: np.ndarray):
+    np.save(output_dir / f'{name}.npy', array)
+
+
+def _parse_targets(values: List[Optional[str]]) -> Tuple[np.ndarray, Optional[List[str]]]:
+    # Numeric targets as floats (nan if missing), the rest as codes of their classes (-1 if missing)
+    try:
+        return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64), None
+    except ValueError:
+        classes = sorted(set(value for value in values if value is not None))
+        positions = {target_class: code for code, target_class in enumerate(classes)}
+        return np.array([positions.get(value, -1) for value in values], dtype=np.int32), classes
+
+
+def write_prepared_split(output_dir: Path, sequences_file: str, labels_file: Optional[str] = None,
+                         mask_file: Optional[str] = None, protocol: Optional[str] = None):
+    """
+    Writes a prepared split as a columnar directory: ids, headers, sequences, per-residue labels and masks as
+    arrays of bytes with offsets (labels and masks of 0 and 1 packed as bits), and the set, validation flag and
+    target of every entry as arrays. Rows follow
+    the order of sequences.fasta, and labels and masks are aligned to them by id. The directory is written to a
+    temporary name and renamed, so it is never read partially written.
+
+    :param output_dir: path to the prepared split directory to create
+    :param sequences_file: path to the prepared sequences.fasta
+    :param labels_file: path to the prepared labels.fasta, if any
+    :param mask_file: path to the mask.fasta, if any. Only the masks of the sequences are kept
+    :param protocol: biotrainer protocol of the split
+    """
+    entries = list(iterate_FASTA(sequences_file))
+    positions = {entry.id: position for position, entry in enumerate(entries)}
+    labels, label_descriptions, masks = [''] * len(entries), [''] * len(entries), [''] * len(entries)
+    if labels_file is not None:
+        for entry in iterate_FASTA(labels_file):
+            if entry.id in positions:
+                labels[positions[entry.id]] = entry.seq
+                label_descriptions[positions[entry.id]] = entry.description
+    if mask_file is not None:
+        for entry in iterate_FASTA(mask_file):
+            if entry.id in positions:
+                masks[positions[entry.id]] = entry.seq
+
+    # Sets and targets are in the headers of labels.fasta if there is one, and of sequences.fasta otherwise
+    headers = label_descriptions if labels_file is not None else [entry.description for entry in entries]
+    matches = [_SET_PATTERN.search(header) for header in headers]
+    split_sets = [match.group(1) if match else '' for match in matches]
+    sets = sorted(set(split_sets))
+    validation = [_VALIDATION_PATTERN.search(header) for header in headers]
+    targets = [_TARGET_PATTERN.search(header) for header in headers]
+    targets, target_classes = _parse_targets([target.group(1) if target else None for target in targets])
+
+    output_dir = Path(output_dir)
+    temporary_dir = output_dir.with_name('{}.tmp-{}'.format(output_dir.name, os.getpid()))
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    os.makedirs(temporary_dir)
+    # Headers with just the id, as in most sequences.fasta files, are stored empty
+    columns = {'ids': [entry.id for entry in entries],
+               'descriptions': [_header(entry.id, entry.description) for entry in entries],
+               'sequences': [entry.seq for entry in entries],
+               'label_descriptions': [_header(entry.id, description)
+                                      for entry, description in zip(entries, label_descriptions)],
+               'labels': labels, 'masks': masks}
+    packed = []
+    for name, strings in columns.items():
+        data, offsets = _pack(strings)
+        if name in BINARY_COLUMNS and len(data) and np.isin(data, (ord('0'), ord('1'))).all():
+            data = np.packbits(data == ord('1'))
+            packed.append(name)
+        _save(temporary_dir, name, data)
+        _save(temporary_dir, f'{name}_offsets', offsets)
+    _save(temporary_dir, 'sets', np.array([sets.index(split_set) for split_set in split_sets], dtype=np.uint8))
+    _save(temporary_dir, 'validation', np.array([int(match is not None and match.group(1) == 'True')
+                                                 for match in validation], dtype=np.uint8))
+    _save(temporary_dir, 'targets', targets)
+    with open(temporary_dir / METADATA_FILE, 'w') as mfile:
+        json.dump({'version': PREPARED_SPLIT_VERSION, 'count': len(entries), 'protocol': protocol, 'sets': sets,
+                   'target_classes': target_classes, 'labels': labels_file is not None,
+                   'masks': mask_file is not None, 'packed': packed}, mfile)
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(temporary_dir, output_dir)
+    logger.info('Prepared split with {} entries written to {}.'.format(len(entries), output_dir))
+
+
+def is_prepared_split(path: str) -> bool:
+    """
+    Checks whether a path is a prepared split directory.
+
+    :param path: path to check
+    :return: True if it is a prepared split directory.
+    """
+    return os.path.isfile(Path(path) / METADATA_FILE) and os.path.isfile(Path(path) / 'sequences.npy')
+
+
+class PreparedSplit:
+    """
+    Read-only view of a prepared split directory. Arrays are memory-mapped, so only the rows accessed are read
+    from disk, except for the binary columns stored as bits, which are unpacked when loaded. Residue strings
+    (sequences, labels, masks) are returned as arrays of bytes without decoding.
+    """
+
+    def __init__(self, path: str):
+        path = Path(path)
+        with open(path / METADATA_FILE, 'r') as mfile:
+            self.metadata = json.load(mfile)
+        if self.metadata['version'] != PREPARED_SPLIT_VERSION:
+            raise Exception(f"Unsupported version of the prepared split {path}.")
+        self._columns = {}
+        for name in TEXT_COLUMNS:
+            data, offsets = np.load(path / f'{name}.npy', mmap_mode='r'), np.load(path / f'{name}_offsets.npy')
+            offsets = offsets.astype(np.int64)
+            if name in self.metadata['packed']:
+                data = np.unpackbits(data, count=int(offsets[-1])) + np.uint8(ord('0'))
+            self._columns[name] = (data, offsets)
+        self.sets = np.load(path / 'sets.npy')
+        self.validation = np.load(path / 'validation.npy').astype(bool)
+        self.targets = np.load(path / 'targets.npy')
+        self.ids = [seq_id.decode() for seq_id in self._split('ids')]
+
+    def __len__(self) -> int:
+        return self.metadata['count']
+
+    def _split(self, column: str) -> List[bytes]:
+        data, offsets = self._columns[column]
+        data = bytes(data)
+        return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    def column(self, column: str, position: int) -> np.ndarray:
+        """
+        :param column: one of TEXT_COLUMNS
+        :param position: row of the entry
+        :return: the bytes of the column for the entry, as an array of uint8.
+        """
+        data, offsets = self._columns[column]
+        return data[offsets[position]:offsets[position + 1]]
+
+    def arrays(self, column: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param column: one of TEXT_COLUMNS
+        :return: the contiguous bytes of all the rows of the column and their offsets.
+        """
+        return self._columns[column]
+
+    def lengths(self, column: str = 'sequences') -> np.ndarray:
+        """
+        :param column: one of TEXT_COLUMNS
+        :return: the length of the column for every row.
+        """
+        return np.diff(self._columns[column][1])
+
+    def set_names(self) -> np.ndarray:
+        """
+        :return: the SET= value of every row.
+        """
+        return np.array(self.metadata['sets'], dtype=object)[self.sets]
+
+    def select(self, split_set: Optional[str] = None, validation: Optional[bool] = None) -> np.ndarray:
+        """
+        :param split_set: value of SET= of the rows to select
+        :param validation: value of VALIDATION= of the rows to select
+        :return: the positions of the rows matching all the given criteria.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if split_set is not None:
+            if split_set not in self.metadata['sets']:
+                return np.array([], dtype=np.int64)
+            mask &= self.sets == self.metadata['sets'].index(split_set)
+        if validation is not None:
+            mask &= self.validation == validation
+        return np.flatnonzero(mask)
+
+    def entries(self, column: str = 'sequences') -> Iterator[FASTAEntry]:
+        """
+        :param column: sequences, labels or masks
+        :return: an iterator of the FASTA entries of the column, with the headers of the original files.
+        """
+        if column == 'masks':
+            # Masks are written with just the id as header
+            for seq_id, residues in zip(self.ids, self._split(column)):
+                if residues:
+                    yield FASTAEntry(seq_id, seq_id, residues.decode())
+            return
+        descriptions = 'descriptions' if column == 'sequences' else 'label_descriptions'
+        for seq_id, header, residues in zip(self.ids, self._split(descriptions), self._split(column)):
+            yield FASTAEntry(seq_id, _restore_header(seq_id, header.decode()), residues.decode())
+
+
+def write_FASTA_from_prepared_split(split_dir: str, output_dir: str) -> Dict[str, str]:
+    """
+    Converts a prepared split directory back to the FASTA files biotrainer reads.
+
+    :param split_dir: path to the prepared split directory
+    :param output_dir: path to the directory to write sequences.fasta, labels.fasta and mask.fasta to
+    :return: a dictionary with the paths to the files written, by column.
+    """
+    prepared = PreparedSplit(split_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    files = {'sequences': 'sequences.fasta'}
+    if prepared.metadata['labels']:
+        files['labels'] = 'labels.fasta'
+    if prepared.metadata['masks']:
+        files['masks'] = 'mask.fasta'
+
+    written = {}
+    for column, file_name in files.items():
+        written[column] = str(Path(output_dir) / file_name)
+        with open(written[column], 'w') as handle:
+            for entry in prepared.entries(column):
+                write_FASTA_entry(handle, entry)
+
+    return written
+
+
+def main(args: Optional[List[str]] = None):
+    """
+    Entry point to convert prepared splits between FASTA and the columnar format
+    """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Convert prepared splits between FASTA files and the columnar format.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Build a prepared split directory from FASTA files.")
+    build.add_argument("sequences_file", type=str, help="The path to the prepared sequences.fasta.")
+    build.add_argument("output_dir", type=str, help="The path to the prepared split directory to create.")
+    build.add_argument("-l", "--labels", type=str, default=None, help="The path to the prepared labels.fasta.")
+    build.add_argument("-mask", "--mask", type=str, default=None, help="The path to the mask.fasta.")
+    build.add_argument("-p", "--protocol", type=str, default=None, help="The protocol of the split.")
+    to_fasta = subparsers.add_parser("to-fasta", help="Write the FASTA files of a prepared split directory.")
+    to_fasta.add_argument("split_dir", type=str, help="The path to the prepared split directory.")
+    to_fasta.add_argument("output_dir", type=str, help="The path to the directory to write the FASTA files to.")
+    arguments = parser.parse_args(args)
+
+    if arguments.command == "build":
+        write_prepared_split(Path(arguments.output_dir), arguments.sequences_file, arguments.labels, arguments.mask,
+                             arguments.protocol)
+    else:
+        for path in write_FASTA_from_prepared_split(arguments.split_dir, arguments.output_dir).values():
+            logger.info('Written {}.'.format(path))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,312 @@
+import os
+import re
+import sys
+import json
+import argparse
+import zipfile
+import hashlib
+import logging
+
+import numpy as np
+
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Set
+
+from .cache import file_digest
+from ..utilities.FASTA import FASTAEntry, parse_FASTA_entry
+from ..utilities.FLIP import FLIP_DATASETS
+from ..utilities.locking import file_lock, temporary_name
+from ..utilities.settings import splits, cache_dir
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout of the index changes, so old indexes are built again
+SPLIT_INDEX_VERSION = 1
+
+# One row per FASTA entry of the dataset
+INDEX_DTYPE = np.dtype([
+    ('member', np.uint16),      # position of the FASTA file in the members of the index
+    ('set', np.uint8),          # position of the SET= value in the sets of the index
+    ('validation', np.uint8),   # 1 if VALIDATION=True
+    ('length', np.uint32),      # length of the sequence
+    ('offset', np.uint64),      # offset of the entry in the uncompressed FASTA file
+    ('size', np.uint32),        # size in bytes of the entry, header included
+])
+
+_SET_PATTERN = re.compile(rb'SET=(\S+)')
+_VALIDATION_PATTERN = re.compile(rb'VALIDATION=(\S+)')
+
+
+def _zip_members(archive: zipfile.ZipFile) -> dict:
+    # FASTA files of the archive, by file name. The splits are in a splits/ folder inside the archive
+    return {Path(info.filename).name: info.filename for info in archive.infolist()
+            if info.filename.endswith('.fasta') and not info.is_dir()}
+
+
+def extract_split_files(dataset: str, file_names: Iterable[str]):
+    """
+    Extracts only the given FASTA files of a dataset from its splits.zip, if they are not extracted yet.
+    Files are extracted to a temporary name and renamed, so other runs never read a partial file, while holding
+    the extraction lock of the dataset, so concurrent runs extract every file only once. Extracted files are
+    read-only: they are shared (and linked into the working directories) by all the runs of the host.
+
+    :param dataset: FLIP dataset name
+    :param file_names: names of the files to extract, e.g. sequences.fasta
+    """
+    split_files = splits / dataset / 'splits'
+    missing = [file_name for file_name in file_names if not os.path.exists(split_files / file_name)]
+    if not missing or not os.path.exists(splits / dataset / 'splits.zip'):
+        return
+
+    with file_lock(split_files / '.extract.lock'):
+        # Files extracted by another run while waiting for the lock
+        missing = [file_name for file_name in missing if not os.path.exists(split_files / file_name)]
+        if not missing:
+            return
+        with zipfile.ZipFile(splits / dataset / 'splits.zip') as archive:
+            members = _zip_members(archive)
+            for file_name in missing:
+                if file_name not in members:
+                    continue
+                logger.info('Extracting {} from the splits of {}.'.format(file_name, dataset))
+                temporary_file = split_files / temporary_name(file_name)
+                with archive.open(members[file_name]) as source, open(temporary_file, 'wb') as destination:
+                    while chunk := source.read(1024 * 1024):
+                        destination.write(chunk)
+                os.chmod(temporary_file, 0o444)
+                os.replace(temporary_file, split_files / file_name)
+
+
+def _scan_FASTA(handle: BinaryIO) -> Iterator[tuple]:
+    # Yields (offset, size, header, sequence length) for every entry of a binary FASTA stream
+    offset, position, header, length = None, 0, None, 0
+    for line in handle:
+        if line[:1] == b'>':
+            if header is not None:
+                yield offset, position - offset, header, length
+            offset, header, length = position, line, 0
+        elif header is not None:
+            length += len(line.translate(None, b' \t\r\n'))
+        position += len(line)
+    if header is not None:
+        yield offset, position - offset, header, length
+
+
+class SplitIndex:
+    """
+    Index of all the FASTA entries of a FLIP dataset: id, sequence length, set, validation flag and position in
+    its FASTA file. It allows to select entries without parsing the FASTA files, and to read only the selected
+    ones from the extracted files or directly from splits.zip.
+    """
+
+    def __init__(self, dataset: str, path: Path):
+        self.dataset = dataset
+        with np.load(path) as index:
+            metadata = json.loads(index['metadata'].tobytes().decode())
+            self.entries = index['entries']
+            id_offsets = index['id_offsets']
+            id_blob = index['ids'].tobytes().decode()
+        self.members = metadata['members']
+        self.sets = metadata['sets']
+        self.ids = np.array([id_blob[id_offsets[i]:id_offsets[i + 1]] for i in range(len(self.entries))],
+                            dtype=object)
+
+    def select(self, file_name: str, split_set: Optional[str] = None, validation: Optional[bool] = None,
+               min_length: Optional[int] = None, max_length: Optional[int] = None,
+               ids: Optional[Set[str]] = None) -> np.ndarray:
+        """
+        Selects the entries of a FASTA file of the dataset matching all the given criteria.
+
+        :param file_name: name of the FASTA file, e.g. one_vs_many.fasta
+        :param split_set: value of SET= in the header, e.g. test
+        :param validation: value of VALIDATION= in the header
+        :param min_length: minimum length of the sequences, inclusive
+        :param max_length: maximum length of the sequences, inclusive
+        :param ids: ids of the entries to select
+        :return: the positions of the selected entries in the index.
+        """
+        if file_name not in self.members:
+            raise Exception(f"{file_name} is not a FASTA file of the dataset {self.dataset}.")
+        if split_set is not None and split_set not in self.sets:
+            return np.array([], dtype=np.int64)
+        mask = self.entries['member'] == self.members.index(file_name)
+        if split_set is not None:
+            mask &= self.entries['set'] == self.sets.index(split_set)
+        if validation is not None:
+            mask &= self.entries['validation'] == int(validation)
+        if min_length is not None:
+            mask &= self.entries['length'] >= min_length
+        if max_length is not None:
+            mask &= self.entries['length'] <= max_length
+        if ids is not None:
+            mask &= np.fromiter((entry_id in ids for entry_id in self.ids), dtype=bool, count=len(self.ids))
+
+        return np.flatnonzero(mask)
+
+    def select_ids(self, file_name: str, **criteria) -> List[str]:
+        """
+        Same as select, returning the ids of the selected entries.
+        """
+        return list(self.ids[self.select(file_name, **criteria)])
+
+    def read_entries(self, positions: Iterable[int]) -> Iterator[FASTAEntry]:
+        """
+        Reads the selected entries, in the order of their FASTA files, from the extracted files if available or
+        from splits.zip otherwise. Only the selected entries are read from the extracted files.
+
+        :param positions: positions of the entries in the index, as returned by select
+        :return: an iterator of FASTAEntry objects.
+        """
+        positions = np.sort(np.asarray(list(positions), dtype=np.int64))
+        for member in np.unique(self.entries['member'][positions]):
+            selected = positions[self.entries['member'][positions] == member]
+            file_name = self.members[member]
+            extracted = splits / self.dataset / 'splits' / file_name
+            if os.path.exists(extracted):
+                with open(extracted, 'rb') as handle:
+                    yield from self._read(handle, selected)
+            else:
+                with zipfile.ZipFile(splits / self.dataset / 'splits.zip') as archive:
+                    with archive.open(_zip_members(archive)[file_name]) as handle:
+                        yield from self._read(handle, selected)
+
+    def _read(self, handle: BinaryIO, positions: np.ndarray) -> Iterator[FASTAEntry]:
+        for position in positions:
+            handle.seek(int(self.entries['offset'][position]))
+            yield parse_FASTA_entry(handle.read(int(self.entries['size'][position])).decode())
+
+
+def split_index_file(dataset: str) -> Path:
+    """
+    Path to the index of a dataset. Indexes are keyed by the content of the splits, so an updated FLIP
+    checkout gets new indexes.
+
+    :param dataset: FLIP dataset name
+    :return: the path to the index file.
+    """
+    archive = splits / dataset / 'splits.zip'
+    if os.path.exists(archive):
+        digest = file_digest(str(archive))
+    else:
+        split_files = sorted((splits / dataset / 'splits').glob('*.fasta'))
+        digest = hashlib.sha256(''.join(file_digest(str(f)) for f in split_files).encode()).hexdigest()
+
+    return cache_dir / 'index' / '{}-{}-v{}.npz'.format(dataset, digest[:16], SPLIT_INDEX_VERSION)
+
+
+def build_split_index(dataset: str) -> Path:
+    """
+    Builds the index of a dataset by scanning its FASTA files once, from splits.zip if available or from the
+    extracted files otherwise, without extracting anything.
+
+    :param dataset: FLIP dataset name
+    :return: the path to the index file.
+    """
+    if not os.path.exists(splits / dataset / 'splits.zip') and not os.path.isdir(splits / dataset / 'splits'):
+        raise Exception(f"Splits of the dataset {dataset} not available.")
+    index_file = split_index_file(dataset)
+    if os.path.exists(index_file):
+        return index_file
+    # Concurrent runs wait for the index being built instead of scanning the dataset again
+    with file_lock(index_file.with_suffix('.lock')):
+        if not os.path.exists(index_file):
+            _write_split_index(dataset, index_file)
+
+    return index_file
+
+
+def _write_split_index(dataset: str, index_file: Path):
+    # Scans the FASTA files of the dataset and writes the index to a temporary file renamed when complete
+
+    members, sets, rows, ids = [], [], [], []
+
+    def scan(file_name: str, handle: BinaryIO):
+        members.append(file_name)
+        for offset, size, header, length in _scan_FASTA(handle):
+            split_set = _SET_PATTERN.search(header)
+            split_set = split_set.group(1).decode() if split_set else ''
+            if split_set not in sets:
+                sets.append(split_set)
+            validation = _VALIDATION_PATTERN.search(header)
+            words = header[1:].split(None, 1)
+            ids.append(words[0].decode() if words else '')
+            rows.append((len(members) - 1, sets.index(split_set),
+                         int(validation is not None and validation.group(1) == b'True'), length, offset, size))
+
+    logger.info('Building the split index of {}.'.format(dataset))
+    if os.path.exists(splits / dataset / 'splits.zip'):
+        with zipfile.ZipFile(splits / dataset / 'splits.zip') as archive:
+            for file_name, member in sorted(_zip_members(archive).items()):
+                with archive.open(member) as handle:
+                    scan(file_name, handle)
+    else:
+        for path in sorted((splits / dataset / 'splits').glob('*.fasta')):
+            with open(path, 'rb') as handle:
+                scan(path.name, handle)
+
+    encoded_ids = [seq_id.encode() for seq_id in ids]
+    id_offsets = np.concatenate(([0], np.cumsum([len(seq_id) for seq_id in ids]))).astype(np.int64)
+    os.makedirs(index_file.parent, exist_ok=True)
+    temporary_file = index_file.with_name(temporary_name(index_file.stem) + '.npz')
+    np.savez_compressed(temporary_file,
+                        entries=np.array(rows, dtype=INDEX_DTYPE),
+                        ids=np.frombuffer(b''.join(encoded_ids), dtype=np.uint8),
+                        id_offsets=id_offsets,
+                        metadata=np.frombuffer(json.dumps({'members': members, 'sets': sets}).encode(),
+                                               dtype=np.uint8))
+    os.replace(temporary_file, index_file)
+    logger.info('Split index of {} with {} entries saved in {}.'.format(dataset, len(rows), index_file))
+
+
+def load_split_index(dataset: str) -> SplitIndex:
+    """
+    Loads the index of a dataset, building it first if needed.
+
+    :param dataset: FLIP dataset name
+    :return: the SplitIndex of the dataset.
+    """
+    return SplitIndex(dataset, build_split_index(dataset))
+
+
+def indexed_entries(dataset: str, file_name: str, ids: Set[str]) -> Optional[Iterator[FASTAEntry]]:
+    """
+    Reads only the entries of a FASTA file of the dataset with the given ids, in the order of the file, if the
+    index of the dataset was already built. The index is never built here, as building it scans the whole dataset.
+
+    :param dataset: FLIP dataset name
+    :param file_name: name of the FASTA file, e.g. sequences.fasta
+    :param ids: ids of the entries to read
+    :return: an iterator of FASTAEntry objects, or None if the dataset is not indexed.
+    """
+    index_file = split_index_file(dataset)
+    if not os.path.exists(index_file):
+        return None
+    index = SplitIndex(dataset, index_file)
+    if file_name not in index.members:
+        return None
+
+    return index.read_entries(index.select(file_name, ids=ids))
+
+
+def main(args: Optional[List[str]] = None):
+    """
+    Entry point to build the split indexes of FLIP datasets
+    """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Build the split indexes of FLIP datasets.")
+    # Datasets are checked after parsing: argparse checks the empty list of an optional positional argument
+    # against its choices, so choices would reject running without datasets
+    parser.add_argument("datasets", nargs="*", metavar="DATASET",
+                        help="The datasets to index, among {}. By default, all of them.".format(
+                            ', '.join(FLIP_DATASETS.keys())))
+    arguments = parser.parse_args(args)
+    unknown = [dataset for dataset in arguments.datasets if dataset not in FLIP_DATASETS]
+    if unknown:
+        parser.error("invalid dataset: {} (choose from {})".format(', '.join(unknown), ', '.join(FLIP_DATASETS.keys())))
+
+    for dataset in arguments.datasets or list(FLIP_DATASETS.keys()):
+        build_split_index(dataset)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
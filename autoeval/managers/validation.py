@@ -0,0 +1,190 @@
+import os
+import logging
+
+import numpy as np
+
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from ..utilities.FASTA import iterate_FASTA, filter_FASTA
+
+logger = logging.getLogger(__name__)
+
+# Characters accepted in protein sequences: the 20 standard amino acids, U, O and the ambiguity codes
+SEQUENCE_ALPHABET = 'ACDEFGHIKLMNPQRSTVWYUOXBZJ'
+
+# Characters accepted in masks: 1 for the residues to use, 0 for the ones to ignore
+MASK_ALPHABET = '01'
+
+
+class ResidueArrays(NamedTuple):
+    """
+    Per-residue strings of a FASTA file as one contiguous byte array: the residues of the entry i are
+    data[offsets[i]:offsets[i + 1]].
+    """
+    ids: List[str]
+    data: np.ndarray
+    offsets: np.ndarray
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+
+def read_residue_arrays(path: str) -> ResidueArrays:
+    """
+    Reads a FASTA file into contiguous residue arrays.
+
+    :param path: path to a valid FASTA file
+    :return: the ResidueArrays of the file.
+    """
+    ids, chunks = [], []
+    for entry in iterate_FASTA(path):
+        ids.append(entry.id)
+        chunks.append(entry.seq.encode())
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    np.cumsum([len(chunk) for chunk in chunks], out=offsets[1:])
+
+    return ResidueArrays(ids, np.frombuffer(b''.join(chunks), dtype=np.uint8), offsets)
+
+
+def _invalid_counts(arrays: ResidueArrays, alphabet: str) -> np.ndarray:
+    # Number of residues of every entry that are not in the alphabet
+    allowed = np.zeros(256, dtype=bool)
+    allowed[np.frombuffer(alphabet.encode(), dtype=np.uint8)] = True
+    return _sum_by_entry(~allowed[arrays.data], arrays.offsets)
+
+
+def _sum_by_entry(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    # Sums of the values of every entry. Unlike np.add.reduceat, it handles empty entries
+    cumulative = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    return cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+
+def _align(arrays: ResidueArrays, reference: Dict[str, int]) -> np.ndarray:
+    # Position of every entry in the reference, -1 if missing
+    return np.array([reference.get(entry_id, -1) for entry_id in arrays.ids], dtype=np.int64)
+
+
+def _ids(arrays: ResidueArrays, selected: np.ndarray) -> List[str]:
+    return [arrays.ids[i] for i in np.flatnonzero(selected)]
+
+
+def validate_residue_split(sequences_file: str, labels_file: str, mask_file: Optional[str] = None,
+                           label_alphabet: Optional[str] = None) -> Dict[str, any]:
+    """
+    Checks that the per-residue labels and masks of a split line up with its sequences: every label and mask has
+    a sequence with the same length, sequences only have amino acids, masks only have 0 and 1 and labels only
+    have the characters of label_alphabet (if given). All the checks are done for the whole split at once.
+
+    :param sequences_file: path to sequences.fasta
+    :param labels_file: path to labels.fasta
+    :param mask_file: path to mask.fasta, or None if the split is not masked
+    :param label_alphabet: characters allowed in the labels. If None, any character is accepted
+    :return: a dictionary with the ids failing every check, the label alphabet found and the mask coverage.
+    """
+    sequences = read_residue_arrays(sequences_file)
+    labels = read_residue_arrays(labels_file)
+    sequence_positions = {entry_id: i for i, entry_id in enumerate(sequences.ids)}
+
+    # Labels: same ids and lengths as the sequences
+    label_positions = _align(labels, sequence_positions)
+    found = label_positions >= 0
+    length_mismatches = np.zeros(len(labels.ids), dtype=bool)
+    length_mismatches[found] = sequences.lengths[label_positions[found]] != labels.lengths[found]
+    labelled = np.zeros(len(sequences.ids), dtype=bool)
+    labelled[label_positions[found]] = True
+
+    report = {
+        'sequences': len(sequences.ids),
+        'residues': int(sequences.offsets[-1]),
+        'missing_sequences': _ids(labels, ~found),
+        'missing_labels': _ids(sequences, ~labelled),
+        'length_mismatches': _ids(labels, length_mismatches),
+        'invalid_sequences': _ids(sequences, _invalid_counts(sequences, SEQUENCE_ALPHABET) > 0),
+        'invalid_labels': _ids(labels, _invalid_counts(labels, label_alphabet) > 0) if label_alphabet else [],
+        'label_alphabet': bytes(np.unique(labels.data)).decode(errors='replace'),
+    }
+
+    # Masks: masks of the whole dataset may be provided, only the ones of the sequences are checked
+    if mask_file is not None:
+        masks = read_residue_arrays(mask_file)
+        mask_positions = _align(masks, sequence_positions)
+        in_split = mask_positions >= 0
+        masked = np.zeros(len(sequences.ids), dtype=bool)
+        masked[mask_positions[in_split]] = True
+        mask_mismatches = np.zeros(len(masks.ids), dtype=bool)
+        mask_mismatches[in_split] = sequences.lengths[mask_positions[in_split]] != masks.lengths[in_split]
+        used = _sum_by_entry(masks.data == ord('1'), masks.offsets)
+        split_residues = int(masks.lengths[in_split].sum())
+        report.update({
+            'missing_masks': _ids(sequences, ~masked),
+            'mask_length_mismatches': _ids(masks, mask_mismatches),
+            'invalid_masks': _ids(masks, in_split & (_invalid_counts(masks, MASK_ALPHABET) > 0)),
+            'empty_masks': _ids(masks, in_split & (used == 0)),
+            'mask_coverage': float(used[in_split].sum() / split_residues) if split_residues else 0.0,
+        })
+
+    return report
+
+
+def inconsistent_ids(report: Dict[str, any]) -> Set[str]:
+    """
+    :param report: a report of validate_residue_split
+    :return: the ids of the entries failing any check. Entries with empty masks are valid, they are just not used.
+    """
+    return set().union(*(report.get(check, ()) for check in
+                         ('missing_sequences', 'missing_labels', 'length_mismatches', 'invalid_sequences',
+                          'invalid_labels', 'missing_masks', 'mask_length_mismatches', 'invalid_masks')))
+
+
+def repair_residue_split(files: List[Optional[str]], ids: Set[str]):
+    """
+    Deletes the given entries from the files of a split. Files are written to a temporary file and renamed, so
+    files linked from the prepared data cache are never modified in place.
+
+    :param files: paths to the FASTA files of the split. None values are skipped
+    :param ids: ids of the entries to delete
+    """
+    for path in files:
+        if path is None:
+            continue
+        temporary_file = '{}.tmp-{}'.format(path, os.getpid())
+        filter_FASTA(path, temporary_file, {'inconsistent': lambda entry: entry.id not in ids})
+        os.replace(temporary_file, path)
+
+
+def validate_prepared_split(working_dir: Path, mask: bool, mode: str = 'report',
+                            label_alphabet: Optional[str] = None) -> Dict[str, any]:
+    """
+    Validates the residue-level split prepared in the working directory and handles its inconsistencies
+    depending on the mode: report logs them, repair also deletes the inconsistent entries from all the files
+    and strict raises an exception.
+
+    :param working_dir: path to the working directory with sequences.fasta, labels.fasta and mask.fasta
+    :param mask: whether the split is masked or not
+    :param mode: one of the validation_modes of the settings
+    :param label_alphabet: characters allowed in the labels, e.g. the label_alphabet of the FLIP dataset. If None,
+        any character is accepted
+    :return: the validation report, with the number of inconsistent entries.
+    """
+    sequences_file, labels_file = str(working_dir / 'sequences.fasta'), str(working_dir / 'labels.fasta')
+    mask_file = str(working_dir / 'mask.fasta') if mask else None
+    report = validate_residue_split(sequences_file, labels_file, mask_file, label_alphabet)
+    inconsistent = inconsistent_ids(report)
+    report['inconsistent'] = len(inconsistent)
+
+    for check, ids in report.items():
+        if isinstance(ids, list) and ids:
+            logger.warning('{} entries with {}: {}{}.'.format(len(ids), check.replace('_', ' '),
+                                                              ', '.join(ids[:10]), ', ...' if len(ids) > 10 else ''))
+    if 'mask_coverage' in report:
+        logger.info('Mask coverage: {:.1%} of the residues.'.format(report['mask_coverage']))
+
+    if inconsistent and mode == 'strict':
+        raise Exception(f"{len(inconsistent)} entries of the split are inconsistent.")
+    if inconsistent and mode == 'repair':
+        repair_residue_split([sequences_file, labels_file, mask_file], inconsistent)
+        logger.info('{} inconsistent entries deleted from the split.'.format(len(inconsistent)))
+
+    return report
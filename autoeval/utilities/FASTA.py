@@ -1,25 +1,46 @@
-from Bio import SeqIO
-from Bio.SeqRecord import SeqRecord
-from typing import List, Set, Union
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, NamedTuple, Set, TextIO, Tuple, Union
 
+# Biopython is only imported by the helpers using it, as the streaming helpers do not need it
+if TYPE_CHECKING:
+    from Bio.SeqRecord import SeqRecord
 
-def read_FASTA(path: str) -> List[SeqRecord]:
+
+# Line width used by Biopython when writing FASTA files. Kept so streamed files are identical to SeqIO.write output
+FASTA_LINE_WIDTH = 60
+
+# Characters removed from sequence lines while parsing, as done by Biopython
+_WHITESPACE_TABLE = str.maketrans('', '', ' \t\r\n')
+
+
+class FASTAEntry(NamedTuple):
+    """
+    Lightweight FASTA record used by the streaming helpers. It exposes the same id, description and seq attributes
+    as a Biopython SeqRecord, with the sequence kept as a plain string.
+    """
+    id: str
+    description: str
+    seq: str
+
+
+def read_FASTA(path: str) -> List['SeqRecord']:
     """
     Helper function to read FASTA file.
 
     :param path: path to a valid FASTA file
     :return: a list of SeqRecord objects.
     """
+    from Bio import SeqIO
     return list(SeqIO.parse(path, "fasta"))
 
 
-def overwrite_FASTA(sequences: List[SeqRecord], path: str):
+def overwrite_FASTA(sequences: List['SeqRecord'], path: str):
     """
     Helper function to overwrite FASTA file.
 
     :param path: path to a valid FASTA file
     :param sequences: a list of SeqRecord objects.
     """
+    from Bio import SeqIO
     SeqIO.write(sequences, path, "fasta")
 
 
@@ -33,3 +54,98 @@ def delete_entries_FASTA(ids: Union[Set[str], List[str]], path: str):
     sequences = read_FASTA(path)
     sequences = [sequence for sequence in sequences if sequence.id not in ids]
     overwrite_FASTA(sequences, path)
+
+
+def iterate_FASTA(path: str) -> Iterator[FASTAEntry]:
+    """
+    Helper function to stream a FASTA file one entry at a time. Headers and sequences are parsed as Biopython does.
+
+    :param path: path to a valid FASTA file
+    :return: an iterator of FASTAEntry objects.
+    """
+    with open(path, 'r') as handle:
+        title = None
+        lines = []
+        for line in handle:
+            if line[0] == '>':
+                if title is not None:
+                    yield _to_FASTA_entry(title, lines)
+                title = line[1:].rstrip()
+                lines = []
+            elif title is not None:
+                lines.append(line)
+        if title is not None:
+            yield _to_FASTA_entry(title, lines)
+
+
+def _to_FASTA_entry(title: str, lines: List[str]) -> FASTAEntry:
+    sequence = "".join(lines).translate(_WHITESPACE_TABLE)
+    words = title.split(None, 1)
+    return FASTAEntry(words[0] if words else "", title, sequence)
+
+
+def parse_FASTA_entry(record: str) -> FASTAEntry:
+    """
+    Helper function to parse the text of a single FASTA entry, header included.
+
+    :param record: text of the entry, starting with '>'
+    :return: the FASTAEntry.
+    """
+    header, _, sequence = record.partition('\n')
+    return _to_FASTA_entry(header[1:].rstrip(), [sequence])
+
+
+def read_FASTA_ids(path: str) -> Set[str]:
+    """
+    Helper function to collect the ids of a FASTA file without keeping its sequences in memory.
+
+    :param path: path to a valid FASTA file
+    :return: a set with the ids of the entries.
+    """
+    return set(entry.id for entry in iterate_FASTA(path))
+
+
+def write_FASTA_entry(handle: TextIO, entry: FASTAEntry):
+    """
+    Helper function to write a single entry to an open FASTA file, with the same layout as SeqIO.write.
+
+    :param handle: text handle open for writing
+    :param entry: the FASTA entry to write
+    """
+    # Same title rules as Biopython: the description is used as is when it already starts with the id
+    if entry.description and entry.description.split(None, 1)[0] == entry.id:
+        title = entry.description
+    elif entry.description:
+        title = '{} {}'.format(entry.id, entry.description)
+    else:
+        title = entry.id
+    handle.write('>{}\n'.format(title))
+    sequence = entry.seq
+    for i in range(0, len(sequence), FASTA_LINE_WIDTH):
+        handle.write(sequence[i:i + FASTA_LINE_WIDTH] + '\n')
+
+
+def filter_FASTA(source: Union[str, Iterable[FASTAEntry]], destination: str,
+                 predicates: Dict[str, Callable[[FASTAEntry], bool]]) -> Tuple[int, Dict[str, Set[str]]]:
+    """
+    Helper function to stream a FASTA file into a new one, keeping only the entries accepted by all predicates.
+    Predicates are evaluated in order and an entry is attributed to the first predicate that rejects it.
+
+    :param source: path to a valid FASTA file to read, or its entries if already parsed
+    :param destination: path to the FASTA file to write. It must be different from source
+    :param predicates: ordered mapping of predicate names to functions returning True for the entries to keep
+    :return: the number of entries kept and a dictionary with the ids rejected by each predicate.
+    """
+    kept = 0
+    rejected = {name: set() for name in predicates}
+    with open(destination, 'w') as handle:
+        for entry in iterate_FASTA(source) if isinstance(source, str) else source:
+            for name, predicate in predicates.items():
+                if not predicate(entry):
+                    rejected[name].add(entry.id)
+                    break
+            else:
+                write_FASTA_entry(handle, entry)
+                kept += 1
+
+    return kept, rejected
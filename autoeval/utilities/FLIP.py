@@ -24,7 +24,8 @@ FLIP_DATASETS = {
         ]
         ,
         "recommended_evaluation_metric": "macro-f1_score",
-        "protocol": "residue_to_class"
+        "protocol": "residue_to_class",
+        "label_alphabet": "01"
     },
     "conservation": {
         "splits": [
@@ -32,7 +33,8 @@ FLIP_DATASETS = {
         ]
         ,
         "recommended_evaluation_metric": "accuracy",
-        "protocol": "residue_to_class"
+        "protocol": "residue_to_class",
+        "label_alphabet": "0123456789"
     },
     "gb1": {
         "splits": [
@@ -85,6 +87,7 @@ FLIP_DATASETS = {
         ]
         ,
         "recommended_evaluation_metric": "accuracy",
-        "protocol": "residue_to_class"
+        "protocol": "residue_to_class",
+        "label_alphabet": "HGIEBTSC-"
     },
 }
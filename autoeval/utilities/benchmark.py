@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import logging
+
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+from unittest import mock
+
+from .settings import split_dict
+
+logger = logging.getLogger(__name__)
+
+# Synthetic datasets, with the same layout as the FLIP ones
+BENCHMARK_DATASETS = {
+    # split name: [dataset folder name, split name, protocol]
+    'benchmark_value': ['benchmark_value', 'sampled', 'sequence_to_value'],
+    'benchmark_residue': ['benchmark_residue', 'sampled', 'residue_to_class'],
+}
+
+_AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+# Entry point whose startup is measured, and the heavy packages it must not import before parsing the arguments
+STARTUP_MODULE = 'autoeval.utilities.cli'
+HEAVY_MODULES = ('Bio', 'numpy', 'yaml', 'h5py', 'asyncio', 'torch', 'biotrainer')
+
+
+def _random_length(rng: random.Random, mean_length: int) -> int:
+    return max(1, int(rng.lognormvariate(0, 0.5) * mean_length))
+
+
+def generate_splits(root: Path, sequences: int, mean_length: int, seed: int = 0):
+    """
+    Generates synthetic FLIP-shaped splits: a sequence_to_value split with the targets and sets in the headers,
+    and a residue_to_class split with sequences.fasta, per-residue labels for part of the sequences and a mask.
+    About 1% of the entries have SET=nan.
+
+    :param root: path to the folder to create the splits in, used in place of FLIP/splits
+    :param sequences: number of sequences of each split
+    :param mean_length: approximate mean length of the sequences
+    :param seed: seed of the random generator
+    """
+    rng = random.Random(seed)
+
+    def split_set() -> str:
+        value = rng.random()
+        return 'nan' if value < 0.01 else 'test' if value < 0.2 else 'train'
+
+    value_dir = root / 'benchmark_value' / 'splits'
+    os.makedirs(value_dir, exist_ok=True)
+    with open(value_dir / 'sampled.fasta', 'w') as split_file:
+        for i in range(sequences):
+            sequence = ''.join(rng.choices(_AMINO_ACIDS, k=_random_length(rng, mean_length)))
+            split_file.write('>Sequence{} TARGET={:.3f} SET={} VALIDATION={}\n{}\n'.format(
+                i, rng.random(), split_set(), rng.random() < 0.1, sequence))
+
+    residue_dir = root / 'benchmark_residue' / 'splits'
+    os.makedirs(residue_dir, exist_ok=True)
+    with open(residue_dir / 'sequences.fasta', 'w') as sequences_file, \
+            open(residue_dir / 'sampled.fasta', 'w') as labels_file, \
+            open(residue_dir / 'mask.fasta', 'w') as mask_file:
+        for i in range(sequences):
+            length = _random_length(rng, mean_length)
+            sequences_file.write('>Sequence{}\n{}\n'.format(i, ''.join(rng.choices(_AMINO_ACIDS, k=length))))
+            # Like in bind, not all the sequences of the dataset are part of the split
+            if rng.random() < 0.8:
+                labels_file.write('>Sequence{} SET={} VALIDATION={}\n{}\n'.format(
+                    i, split_set(), rng.random() < 0.1, ''.join(rng.choices('01', k=length))))
+                mask_file.write('>Sequence{}\n{}\n'.format(i, ''.join(rng.choices('01', weights=(1, 9), k=length))))
+
+
+@contextmanager
+def synthetic_flip(root: Path):
+    """
+    Context manager making the synthetic splits of root available to autoeval as FLIP splits.
+
+    :param root: path to the folder with the synthetic splits
+    """
+    from ..managers import data, splitindex
+
+    with mock.patch.object(data, 'splits', root), mock.patch.object(splitindex, 'splits', root), \
+            mock.patch.dict(split_dict, {name: values[:2] for name, values in BENCHMARK_DATASETS.items()}):
+        yield
+
+
+def measure(function: Callable, repeat: int) -> Dict[str, float]:
+    """
+    Measures the wall time, CPU time and peak of memory allocated by Python of a function. The best wall and CPU
+    times of all the repetitions are kept.
+
+    :param function: function to measure, without arguments
+    :param repeat: number of repetitions
+    :return: a dictionary with wall_time and cpu_time in seconds and peak_memory in bytes.
+    """
+    wall_times, cpu_times, peaks = [], [], []
+    for _ in range(repeat):
+        tracemalloc.start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        function()
+        wall_times.append(time.perf_counter() - wall_start)
+        cpu_times.append(time.process_time() - cpu_start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {'wall_time': min(wall_times), 'cpu_time': min(cpu_times), 'peak_memory': max(peaks)}
+
+
+def run_benchmarks(root: Path, repeat: int) -> Dict[str, Dict[str, float]]:
+    """
+    Runs the benchmarks of every stage of the data preparation and the config writing on the synthetic splits.
+
+    :param root: path to the folder with the synthetic splits
+    :param repeat: number of repetitions of each stage
+    :return: the measures of every benchmark, by name.
+    """
+    from ..managers import data
+    from ..managers.configfiles import prepare_configfile
+    from ..utilities.cli import create_parser
+    from ..utilities.FASTA import read_FASTA, overwrite_FASTA, delete_entries_FASTA
+    from ..utilities.settings import configs_bank
+
+    results = {}
+    with synthetic_flip(root):
+        for name, (dataset, split, protocol) in BENCHMARK_DATASETS.items():
+            working_dir = root / 'working_dir' / name
+            os.makedirs(working_dir, exist_ok=True)
+            cache_dir = root / 'cache'
+            mask = 'mask.fasta' if protocol == 'residue_to_class' else None
+            split_files = root / dataset / 'splits'
+            sequences_source = split_files / ('sequences.fasta' if mask else f'{split}.fasta')
+            labels_source = split_files / f'{split}.fasta' if mask else None
+
+            benchmarks = {
+                'prepare_data': lambda: data.prepare_data(name, protocol, working_dir, None, None, mask),
+                'prepare_data_sizes': lambda: data.prepare_data(name, protocol, working_dir, 50, 1000, mask),
+                'prepare_data_cache_miss': lambda: (shutil.rmtree(cache_dir, ignore_errors=True),
+                                                    data.prepare_data(name, protocol, working_dir, 50, 1000, mask,
+                                                                      cache_dir=cache_dir)),
+                'prepare_data_cache_hit': lambda: data.prepare_data(name, protocol, working_dir, 50, 1000, mask,
+                                                                    cache_dir=cache_dir),
+                'filter_split': lambda: data.filter_split(str(sequences_source),
+                                                          labels_source and str(labels_source),
+                                                          str(working_dir / 'sequences.fasta'),
+                                                          labels_source and str(working_dir / 'labels.fasta'),
+                                                          50, 1000),
+                'filter_fasta_enties_size': lambda: data.filter_fasta_enties_size(
+                    read_FASTA(str(sequences_source)), 50, 1000),
+                'filter_fasta_invalid_entries': lambda: data.filter_fasta_invalid_entries(
+                    read_FASTA(str(sequences_source))),
+                'read_overwrite_FASTA': lambda: overwrite_FASTA(read_FASTA(str(sequences_source)),
+                                                                str(working_dir / 'copy.fasta')),
+            }
+            if mask:
+                def equilibrate():
+                    shutil.copyfile(sequences_source, working_dir / 'sequences.fasta')
+                    data.equilibrate_sequences(str(working_dir / 'sequences.fasta'), str(labels_source))
+
+                def delete_entries():
+                    shutil.copyfile(labels_source, working_dir / 'labels.fasta')
+                    delete_entries_FASTA({f'Sequence{i}' for i in range(0, 1000, 3)},
+                                         str(working_dir / 'labels.fasta'))
+
+                benchmarks['equilibrate_sequences'] = equilibrate
+                benchmarks['delete_entries_FASTA'] = delete_entries
+
+            # Config writing, with the default configuration of a FLIP dataset with the same protocol
+            args = create_parser().parse_args([name, protocol, str(working_dir)] + (['--mask'] if mask else []))
+            config_file = configs_bank / ('bind.yml' if mask else 'aav.yml')
+            benchmarks['prepare_configfile'] = lambda: prepare_configfile(
+                working_dir, config_file, working_dir / 'sequences.fasta',
+                working_dir / 'labels.fasta' if mask else None, args)
+
+            for stage, function in benchmarks.items():
+                results[f'{name}.{stage}'] = measure(function, repeat)
+                logger.info('{}.{}: {:.3f}s'.format(name, stage, results[f'{name}.{stage}']['wall_time']))
+
+    return results
+
+
+def measure_startup(repeat: int) -> Tuple[Dict[str, Dict[str, float]], List[str]]:
+    """
+    Measures the startup of the command line interface in new interpreters: the cumulative import time of its
+    module as reported by python -X importtime, and the wall time of autoeval --help.
+
+    :param repeat: number of repetitions. The best times are kept
+    :return: the measures by name, as the ones of run_benchmarks, and the heavy packages imported at startup.
+    """
+    import_times, help_times, imported = [], [], set()
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {STARTUP_MODULE}'],
+                                 capture_output=True, text=True, check=True)
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:') or line.endswith('| package'):
+                continue
+            _, cumulative, module = line[len('import time:'):].split('|')
+            imported.add(module.strip().split('.')[0])
+            if module.strip() == STARTUP_MODULE:
+                import_times.append(int(cumulative) / 1e6)
+
+        wall_start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', f'import sys; from {STARTUP_MODULE} import main; sys.exit(main())',
+                        '--help'], capture_output=True, check=True)
+        help_times.append(time.perf_counter() - wall_start)
+
+    results = {'startup.cli_import': {'wall_time': min(import_times), 'cpu_time': 0.0, 'peak_memory': 0},
+               'startup.cli_help': {'wall_time': min(help_times), 'cpu_time': 0.0, 'peak_memory': 0}}
+    for name, measures in results.items():
+        logger.info('{}: {:.3f}s'.format(name, measures['wall_time']))
+
+    return results, sorted(imported.intersection(HEAVY_MODULES))
+
+
+def compare_results(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+                    tolerance: float) -> List[str]:
+    """
+    Compares benchmark results with the ones of a baseline.
+
+    :param results: measures of the current version
+    :param baseline: measures of the baseline version
+    :param tolerance: allowed relative increase of wall time and peak memory, e.g. 0.2 for 20%
+    :return: a description of every regression found.
+    """
+    regressions = []
+    for name, measures in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('wall_time', 'peak_memory'):
+            reference = baseline[name][metric]
+            if reference > 0 and measures[metric] > reference * (1 + tolerance):
+                regressions.append('{} {}: {:.4g} -> {:.4g} (+{:.0%})'.format(
+                    name, metric, reference, measures[metric], measures[metric] / reference - 1))
+
+    return regressions
+
+
+def main(args: Optional[List[str]] = None):
+    """
+    Entry point to the benchmarks of autoeval
+    """
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Benchmark the data preparation of autoeval on synthetic FLIP-shaped splits.")
+    parser.add_argument("-n", "--sequences", type=int, default=10000, help="Number of sequences of each synthetic split.")
+    parser.add_argument("-l", "--length", type=int, default=400, help="Approximate mean length of the sequences.")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of repetitions of each benchmark.")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Path to the JSON file to save the results to.")
+    parser.add_argument("--compare", type=str, default=None, help="Path to the JSON results of a baseline to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative increase over the baseline.")
+    arguments = parser.parse_args(args)
+
+    root = Path(tempfile.mkdtemp(prefix='autoeval-benchmark-'))
+    try:
+        generate_splits(root, arguments.sequences, arguments.length)
+        results = run_benchmarks(root, arguments.repeat)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    # The command line interface must parse its arguments without loading the pipeline
+    startup, heavy_modules = measure_startup(arguments.repeat)
+    results.update(startup)
+    regressions = ['{} imports {} at startup'.format(STARTUP_MODULE, ', '.join(heavy_modules))] if heavy_modules else []
+
+    try:
+        from importlib.metadata import version
+        autoeval_version = version('autoeval')
+    except Exception:
+        autoeval_version = 'unknown'
+
+    report = {
+        'version': autoeval_version,
+        'parameters': {'sequences': arguments.sequences, 'length': arguments.length, 'repeat': arguments.repeat},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'results': results,
+    }
+    if arguments.output:
+        with open(arguments.output, 'w') as ofile:
+            json.dump(report, ofile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if arguments.compare:
+        with open(arguments.compare, 'r') as bfile:
+            regressions += compare_results(results, json.load(bfile)['results'], arguments.tolerance)
+    for regression in regressions:
+        print('Regression: {}'.format(regression), file=sys.stderr)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
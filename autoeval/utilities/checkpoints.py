@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+import logging
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Folder of the working directory with the markers of the stages
+MARKERS_DIR = '.autoeval'
+
+
+def fingerprint(*values) -> str:
+    """
+    Computes the fingerprint of the inputs of a stage.
+
+    :param values: JSON-serializable inputs of the stage (parameters, fingerprints of previous stages, ...)
+    :return: the hexadecimal fingerprint.
+    """
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_stamp(path: Optional[str]) -> Optional[List[int]]:
+    """
+    :param path: path to a file
+    :return: the size and modification time of the file, or None if it does not exist.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class StageMarkers:
+    """
+    Persisted state of the stages of a run in a working directory. A stage is started with its input fingerprint
+    and completed with its output files and values. On a new run, a completed stage is skipped if its fingerprint
+    is the same and its output files were not modified, and a started stage can be resumed.
+    """
+
+    def __init__(self, working_dir: Path, enabled: bool = True):
+        self.directory = working_dir / MARKERS_DIR
+        self.enabled = enabled
+
+    def _read(self, name: str) -> Optional[Dict[str, any]]:
+        if not self.enabled or not os.path.exists(self.directory / f'{name}.json'):
+            return None
+        try:
+            with open(self.directory / f'{name}.json', 'r') as mfile:
+                return json.load(mfile)
+        except ValueError:
+            return None
+
+    def _write(self, name: str, marker: Dict[str, any]):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_file = self.directory / '{}.json.tmp-{}'.format(name, os.getpid())
+        with open(temporary_file, 'w') as mfile:
+            json.dump(marker, mfile, indent=2)
+        os.replace(temporary_file, self.directory / f'{name}.json')
+
+    def completed(self, name: str, stage_fingerprint: str) -> Optional[Dict[str, any]]:
+        """
+        Checks whether a stage was completed with the same inputs and its outputs are unchanged.
+
+        :param name: name of the stage
+        :param stage_fingerprint: fingerprint of the inputs of the stage
+        :return: the values recorded when the stage was completed, or None if it must be run.
+        """
+        marker = self._read(name)
+        if marker is None or marker['status'] != 'completed' or marker['fingerprint'] != stage_fingerprint:
+            return None
+        if any(file_stamp(path) != stamp for path, stamp in marker['outputs'].items()):
+            logger.info('Outputs of the stage {} were modified since it was completed.'.format(name))
+            return None
+
+        return marker['values']
+
+    def started(self, name: str, stage_fingerprint: str) -> bool:
+        """
+        :param name: name of the stage
+        :param stage_fingerprint: fingerprint of the inputs of the stage
+        :return: True if the stage was started with the same inputs but never completed.
+        """
+        marker = self._read(name)
+        return marker is not None and marker['status'] == 'started' and marker['fingerprint'] == stage_fingerprint
+
+    def start(self, name: str, stage_fingerprint: str):
+        """
+        Marks a stage as started, invalidating its previous completion.
+
+        :param name: name of the stage
+        :param stage_fingerprint: fingerprint of the inputs of the stage
+        """
+        self._write(name, {'status': 'started', 'fingerprint': stage_fingerprint})
+
+    def complete(self, name: str, stage_fingerprint: str, outputs: List[Optional[str]], **values):
+        """
+        Marks a stage as completed.
+
+        :param name: name of the stage
+        :param stage_fingerprint: fingerprint of the inputs of the stage
+        :param outputs: paths to the output files of the stage. None values are skipped
+        :param values: JSON-serializable values to restore when the stage is skipped
+        """
+        self._write(name, {'status': 'completed', 'fingerprint': stage_fingerprint,
+                           'outputs': {path: file_stamp(path) for path in outputs if path is not None},
+                           'values': values})
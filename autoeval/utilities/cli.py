@@ -1,8 +1,8 @@
+import sys
 import argparse
 import logging
 
-from .executer import execute
-from .settings import split_dict, protocols
+from .settings import split_dict, protocols, cache_dir, backends, embedding_strategies, validation_modes
 
 
 def create_parser():
@@ -22,6 +22,9 @@ def create_parser():
     - -f or --embeddingsfile: the path to the file containing the embeddings.
         Allows to use precomputed embeddings.
 
+    - -es or --embeddingstore: if set, embeddings are taken from the store of the dataset in the default or
+        provided folder, computing only the ones missing from it.
+
     - -mask or --mask: if set, use the masks in the file mask.fast or the provided one to filter the residues
     
     - -m or --model: the name of the model to use (from the available ones in biotrainer).
@@ -30,9 +33,45 @@ def create_parser():
     - -c or --config: the path to the configuration file to use.
         If not provided, the default one for the split in configsbank will be used.
 
+    - -b or --backend: how to run biotrainer, in a new python process (subprocess, default) or in the current
+        one (inprocess).
+
+    - -lb or --lengthbuckets: comma-separated length limits, e.g. 500,1000,2000. If set, the split is embedded by
+        autoeval in shards of similar lengths, and long proteins are embedded one at a time.
+
+    - -est or --embeddingstrategy: how autoeval groups the sequences to embed. length (default) uses the shards of
+        --lengthbuckets, if given. landscape detects the wild type of a mutational landscape (aav, gb1) and embeds the
+        variants in batches of the same length sorted by their mutations.
+
+    - --batchresidues: maximum number of residues per embedding batch when embedding in shards.
+
+    - --embeddingworkers: number of shards embedded at the same time, each in its own process.
+
     - -mins or --minsize: the minimum size of the proteins to use.
     
     - -maxs or --maxsize: the maximum size of the proteins to use.
+
+    - --cachedir: the path to the cache where prepared data is reused between runs.
+
+    - -nc or --nocache: if set, the data is prepared again without using the cache.
+
+    - -val or --validation: how to handle labels and masks of residue-level splits that do not line up with the
+        sequences: report them (default), repair the split deleting them, stop (strict) or skip the checks (off).
+
+    - --timeout: maximum time in seconds biotrainer can run before it is stopped.
+
+    - --memorylimit: maximum memory in GB biotrainer (and its subprocesses) can use before it is stopped.
+
+    - -cs or --columnarsplit: if set, the prepared split is also written in the columnar format to the
+        prepared_split folder of the working directory.
+
+    - -o or --override: a biotrainer option to override, as KEY=VALUE (e.g. learning_rate=1e-4 or
+        cross_validation_config.method=k_fold). It can be given many times. Overrides are validated for the protocol.
+
+    - -r or --restart: if set, all the stages are run again, even the ones completed by a previous run with the
+        same inputs in the working directory.
+
+    - --metricsfile: the path to a file to export the measures of the run to, in the Prometheus text format.
     """
     
     parser = argparse.ArgumentParser(description="Train and evaluate different bioembedding models using biotrainer.")
@@ -41,11 +80,26 @@ def create_parser():
     parser.add_argument("working_dir", type=str, help="The path to the folder to save the needed files and results.")
     parser.add_argument("-e", "--embedder", type=str, help="The embedder to use.")
     parser.add_argument("-f", "--embeddingsfile", type=str, help="The path to the file containing the embeddings.")
+    parser.add_argument("-es", "--embeddingstore", type=str, nargs='?', const=str(cache_dir / 'embeddings'), help="If set, reuse the embeddings of the dataset from the embedding store in the given folder")
     parser.add_argument("-mask", "--mask", type=str, nargs='?', const='mask.fasta', help="If set, use the masks in the file mask.fasta from the working directory to filter the residues")
     parser.add_argument("-m", "--model", type=str, help="The model to use.")
     parser.add_argument("-c", "--config", help="Config file different from the provided one in configsbank.", type=str, default=None)
+    parser.add_argument("-o", "--override", type=str, action="append", default=None, help="A biotrainer option to override, as KEY=VALUE (e.g. learning_rate=1e-4). It can be given many times.")
+    parser.add_argument("-b", "--backend", choices=backends, type=str, default='subprocess', help="How to run biotrainer: in a new python process or in the current one.")
+    parser.add_argument("-lb", "--lengthbuckets", type=str, default=None, help="Comma-separated length limits of the shards to embed the split in, e.g. 500,1000,2000.")
+    parser.add_argument("-est", "--embeddingstrategy", choices=embedding_strategies, type=str, default='length', help="How to group the sequences embedded by autoeval: by length or as variants of a mutational landscape.")
+    parser.add_argument("--batchresidues", type=int, default=4000, help="Maximum number of residues per embedding batch when embedding in shards.")
+    parser.add_argument("--embeddingworkers", type=int, default=1, help="Number of shards embedded at the same time.")
     parser.add_argument("-mins", "--minsize", help="Use proteins with more than minsize residues.", type=int, default=None)
     parser.add_argument("-maxs", "--maxsize", help="Use proteins with less than maxsize residues.", type=int, default=None)
+    parser.add_argument("--cachedir", help="Path to the cache of autoeval.", type=str, default=str(cache_dir))
+    parser.add_argument("-nc", "--nocache", help="If set, do not reuse prepared data from previous runs.", action="store_true")
+    parser.add_argument("-val", "--validation", choices=validation_modes, type=str, default='report', help="How to handle residue labels and masks not matching the sequences.")
+    parser.add_argument("--timeout", help="Maximum time in seconds biotrainer can run.", type=float, default=None)
+    parser.add_argument("--memorylimit", help="Maximum memory in GB biotrainer can use.", type=float, default=None)
+    parser.add_argument("-cs", "--columnarsplit", help="If set, also write the prepared split in the columnar format.", action="store_true")
+    parser.add_argument("-r", "--restart", help="If set, run all the stages again instead of skipping the ones completed by a previous run.", action="store_true")
+    parser.add_argument("--metricsfile", help="Path to export the measures of the run to, in the Prometheus text format.", type=str, default=None)
 
     return parser
 
@@ -60,7 +114,9 @@ def main(args=None):
     parser = create_parser()
     arguments = parser.parse_args()
 
-    execute(arguments)
-    
+    # Imported once the arguments are valid, so --help and invalid arguments do not load the pipeline
+    from .executer import execute
+    return execute(arguments)
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
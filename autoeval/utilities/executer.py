@@ -1,23 +1,88 @@
 import os
-import subprocess
+import argparse
 from pathlib import Path
 
-from typing import Dict
+from typing import Dict, List, Optional
 
 import logging
 
-from .settings import configs_bank, split_dict
+from .settings import configs_bank, split_dict, splits
+from .FLIP import FLIP_DATASETS
+from .checkpoints import StageMarkers, fingerprint, file_stamp
+from .instrumentation import MANIFEST_FILE, RunManifest
+from .runner import BiotrainerJob, run_biotrainer_job
+from ..managers.cache import file_digest
 from ..managers.data import prepare_data
-from ..managers.configfiles import prepare_configfile
+from ..managers.configfiles import prepare_configfile, read_configfile, write_configfile, load_configfile, \
+    config_fingerprint
+from ..managers.embeddings import ShardingOptions, prepare_embeddings, write_embeddings
+from ..managers.validation import validate_prepared_split
+from ..managers.prepared_split import PREPARED_SPLIT_DIR, write_prepared_split
+from ..managers.indexed_embeddings import is_indexed_embeddings, prepare_indexed_embeddings
 
 logger = logging.getLogger(__name__)
 
+# Keys of the biotrainer configuration with paths to input files
+_config_file_keys = ('sequence_file', 'labels_file', 'mask_file', 'embeddings_file')
 
-def execute(args: Dict[str, any]):
+
+def run_biotrainer_subprocess(working_dir: Path, timeout: Optional[float] = None,
+                              memory_limit: Optional[int] = None) -> Dict[str, any]:
+    """
+    Runs biotrainer in a new python process with the config.yml of the working directory. Its output is shown
+    and saved in the working directory, and the progress of the training is logged.
+
+    :param working_dir: path to the working directory
+    :param timeout: maximum time in seconds biotrainer can run
+    :param memory_limit: maximum memory in bytes biotrainer can use
+    :return: the result of the job, with its status and the exit code of biotrainer.
+    """
+    def log_progress(event: Dict[str, any]):
+        if event['event'] == 'loss':
+            logger.info('Epoch {}, {} loss: {}.'.format(event['epoch'], event['phase'] or 'current', event['loss']))
+
+    job = BiotrainerJob(working_dir.name, working_dir, (working_dir / 'config.yml').resolve(), timeout, memory_limit)
+    return run_biotrainer_job(job, log_progress)
+
+
+def run_biotrainer_inprocess(config: Dict[str, any], working_dir: Path) -> int:
+    """
+    Runs biotrainer in the current process with the given configuration, without reading config.yml again.
+    Modules imported by previous runs in the same process are reused. If the configuration uses an embedder,
+    the split is embedded with the embedder already loaded in this process (if any) before training.
+
+    :param config: biotrainer configuration
+    :param working_dir: path to the working directory
+    :return: 0 if biotrainer finished successfully, 1 otherwise.
+    """
+    from biotrainer.utilities.cli import headless_main
+
+    config = dict(config)
+    for key in _config_file_keys:
+        if config.get(key) not in (None, "None") and not os.path.isabs(config[key]):
+            config[key] = str(working_dir / config[key])
+    config.setdefault("output_dir", str(working_dir / 'output'))
+
+    try:
+        if config.get("embedder_name") is not None:
+            embeddings_file = str(working_dir / 'embeddings.h5')
+            write_embeddings(config["sequence_file"], embeddings_file, config["embedder_name"], config["protocol"])
+            del config["embedder_name"]
+            config["embeddings_file"] = embeddings_file
+        headless_main(config)
+    except Exception as e:
+        logger.exception('biotrainer failed: {}'.format(e))
+        return 1
+
+    return 0
+
+
+def execute(args: Dict[str, any]) -> int:
     """
     Main AutoEval function. It manages the entire execution.
 
     :param args: dictionary with the execution arguments.
+    :return: the exit code of biotrainer.
     """
 
     # Get path of the configuration file from configsbank or the provided one
@@ -27,23 +92,188 @@ def execute(args: Dict[str, any]):
         config_file = Path(args.config).resolve()
     logger.info('The selected configuration file to load is in {}.'.format(config_file))
 
+    # Precomputed embeddings are referenced from the working directory
+    if args.embeddingsfile is not None:
+        args = argparse.Namespace(**{**vars(args), "embeddingsfile": str(Path(args.embeddingsfile).resolve())})
+
     # Create and set path to the folder to place the needed files and results (working directory)
     working_dir = Path(f"{args.working_dir}/{args.split}/").resolve()
     print(f"WORKING DIR: {working_dir}")
-    if not os.path.isdir(working_dir):
-        os.makedirs(working_dir)
+    os.makedirs(working_dir, exist_ok=True)
     logger.info('Needed files and results will be saved in {}.'.format(working_dir))
 
+    # Every stage of the run is measured and recorded in the manifest of the working directory
+    manifest = RunManifest(split=args.split, protocol=args.protocol, working_dir=str(working_dir),
+                           config_file=str(config_file), args=vars(args))
+    try:
+        exit_code = _execute_stages(args, config_file, working_dir, manifest)
+        manifest.status = 'succeeded' if exit_code == 0 else 'failed'
+    except BaseException:
+        manifest.status = 'failed'
+        raise
+    finally:
+        manifest.save(working_dir / MANIFEST_FILE)
+        if args.metricsfile:
+            manifest.export_metrics(Path(args.metricsfile))
+        logger.info('Run manifest saved in {}.'.format(working_dir / MANIFEST_FILE))
+
+    return exit_code
+
+
+def _split_stamps(split: str) -> List[any]:
+    # Size and modification time of the source files of a split, to detect updated FLIP checkouts
+    dataset_dir = splits / split_dict[split][0]
+    if os.path.exists(dataset_dir / 'splits.zip'):
+        sources = [dataset_dir / 'splits.zip']
+    else:
+        sources = sorted((dataset_dir / 'splits').glob('*.fasta'))
+    return [(source.name, file_stamp(str(source))) for source in sources]
+
+
+def _skip_stage(manifest: RunManifest, name: str, **values):
+    logger.info('Stage {} already completed with the same inputs. Skipped.'.format(name))
+    with manifest.stage(name) as stage:
+        stage.record(skipped=True, **values)
+
+
+def _execute_stages(args: argparse.Namespace, config_file: Path, working_dir: Path, manifest: RunManifest) -> int:
+    # Stages completed by a previous run with the same inputs are skipped, unless a restart is requested
+    markers = StageMarkers(working_dir, enabled=not args.restart)
+
     # Prepare the data
-    sequences, labels = prepare_data(args.split, args.protocol, working_dir, args.minsize, args.maxsize, args.mask)
-    logger.info('Data prepared.')
+    label_alphabet = FLIP_DATASETS.get(split_dict[args.split][0], {}).get('label_alphabet')
+    prepare_fingerprint = fingerprint('prepare', args.split, args.protocol, args.minsize, args.maxsize, args.mask,
+                                      args.validation, label_alphabet, args.columnarsplit, _split_stamps(args.split))
+    prepared = markers.completed('prepare', prepare_fingerprint)
+    if prepared is not None:
+        _skip_stage(manifest, 'prepare')
+        sequences, labels = prepared['sequences'], prepared['labels']
+    else:
+        markers.start('prepare', prepare_fingerprint)
+        prepared_cache_dir = None if args.nocache else Path(args.cachedir).resolve() / 'prepared'
+        sequences, labels = prepare_data(args.split, args.protocol, working_dir, args.minsize, args.maxsize,
+                                         args.mask, cache_dir=prepared_cache_dir, manifest=manifest)
+        logger.info('Data prepared.')
+
+        # Check that the per-residue labels and masks line up with the sequences
+        if args.protocol == 'residue_to_class' and args.validation != 'off':
+            with manifest.stage('validate') as stage:
+                report = validate_prepared_split(working_dir, args.mask is not None, args.validation, label_alphabet)
+                stage.record(**{check: len(value) if isinstance(value, list) else value
+                                for check, value in report.items()})
+
+        # Columnar copy of the prepared split for faster downstream consumers
+        if args.columnarsplit:
+            with manifest.stage('columnar_split') as stage:
+                write_prepared_split(working_dir / PREPARED_SPLIT_DIR, sequences, labels,
+                                     str(working_dir / 'mask.fasta') if args.mask else None, args.protocol)
+                stage.record(bytes=sum(os.path.getsize(path) for path in (working_dir / PREPARED_SPLIT_DIR).iterdir()))
+        markers.complete('prepare', prepare_fingerprint,
+                         [sequences, labels, str(working_dir / 'mask.fasta') if args.mask else None,
+                          str(working_dir / PREPARED_SPLIT_DIR / 'metadata.json') if args.columnarsplit else None],
+                         sequences=sequences, labels=labels)
+
+    # Embed the split in shards by length, or grouping the variants of a mutational landscape, if requested
+    sharding = None
+    if args.embeddingstrategy == 'landscape':
+        sharding = ShardingOptions([], args.batchresidues, strategy='landscape')
+    elif args.lengthbuckets:
+        sharding = ShardingOptions([int(boundary) for boundary in args.lengthbuckets.split(',')],
+                                   args.batchresidues, args.embeddingworkers)
+
+    # Compute the embeddings missing from the store of the dataset and use them instead of embedding the split
+    embeddings_fingerprint = fingerprint('embeddings', prepare_fingerprint, args.embeddingsfile,
+                                         file_stamp(args.embeddingsfile))
+    if (args.embeddingstore or sharding) and not args.embeddingsfile:
+        embedder_name = args.embedder or load_configfile(config_file).get("embedder_name")
+        if embedder_name is None:
+            raise Exception("Embeddings must be computed by autoeval but no embedder is set.")
+        embeddings_fingerprint = fingerprint('embeddings', prepare_fingerprint, embedder_name, args.embeddingstore,
+                                             sharding)
+        computed = markers.completed('embeddings', embeddings_fingerprint)
+        if computed is not None:
+            _skip_stage(manifest, 'embeddings', embedder_name=embedder_name)
+            embeddings_file = computed['embeddings_file']
+        else:
+            markers.start('embeddings', embeddings_fingerprint)
+            with manifest.stage('embeddings') as stage:
+                if args.embeddingstore:
+                    embeddings_file = prepare_embeddings(sequences, working_dir, Path(args.embeddingstore).resolve(),
+                                                         split_dict[args.split][0], embedder_name, args.protocol,
+                                                         sharding)
+                else:
+                    embeddings_file = str(working_dir / 'embeddings.h5')
+                    stage.record(embedded=write_embeddings(sequences, embeddings_file, embedder_name, args.protocol,
+                                                           sharding))
+                stage.record(embedder_name=embedder_name)
+                stage.record_file('embeddings_bytes', embeddings_file)
+            markers.complete('embeddings', embeddings_fingerprint, [embeddings_file], embeddings_file=embeddings_file)
+        args = argparse.Namespace(**{**vars(args), "embedder": None, "embeddingsfile": embeddings_file})
+
+    # Slice the embeddings of the prepared sequences out of an indexed embeddings directory
+    if args.embeddingsfile and is_indexed_embeddings(args.embeddingsfile):
+        embeddings_fingerprint = fingerprint('indexed_embeddings', prepare_fingerprint, args.embeddingsfile,
+                                             file_stamp(os.path.join(args.embeddingsfile, 'metadata.json')))
+        sliced = markers.completed('indexed_embeddings', embeddings_fingerprint)
+        if sliced is not None:
+            _skip_stage(manifest, 'indexed_embeddings')
+            embeddings_file = sliced['embeddings_file']
+        else:
+            markers.start('indexed_embeddings', embeddings_fingerprint)
+            with manifest.stage('indexed_embeddings') as stage:
+                embeddings_file = prepare_indexed_embeddings(args.embeddingsfile, sequences, working_dir)
+                stage.record_file('embeddings_bytes', embeddings_file)
+            markers.complete('indexed_embeddings', embeddings_fingerprint, [embeddings_file],
+                             embeddings_file=embeddings_file)
+        args = argparse.Namespace(**{**vars(args), "embeddingsfile": embeddings_file})
 
     # Prepare configuration file with possible modifications (in args)
-    prepare_configfile(working_dir, config_file, sequences, labels, args)
+    config_stage_fingerprint = fingerprint('config', prepare_fingerprint, embeddings_fingerprint,
+                                           file_digest(str(config_file)), args.embedder, args.embeddingsfile,
+                                           args.model, args.mask, args.override)
+    if markers.completed('config', config_stage_fingerprint) is not None:
+        _skip_stage(manifest, 'config')
+        config = read_configfile(working_dir / 'config.yml')
+    else:
+        markers.start('config', config_stage_fingerprint)
+        with manifest.stage('config'):
+            config = prepare_configfile(working_dir, config_file, sequences, labels, args)
+        markers.complete('config', config_stage_fingerprint, [str(working_dir / 'config.yml')])
 
-    # Run biotrainer
-    logger.info('Executing biotrainer.')
-    os.chdir(working_dir)
-    subprocess.call(["python3", (Path(os.path.dirname(os.path.abspath(__file__))) / '../biotrainer/run-biotrainer.py').resolve(), (Path('') / 'config.yml').resolve()])
+    # Run biotrainer. A run with the same inputs that did not finish resumes from its last checkpoint
+    biotrainer_fingerprint = fingerprint('biotrainer', config_stage_fingerprint, config_fingerprint(config))
+    if markers.completed('biotrainer', biotrainer_fingerprint) is not None:
+        _skip_stage(manifest, 'biotrainer')
+        logger.info('Done.')
+        return 0
+    resume = markers.started('biotrainer', biotrainer_fingerprint)
+    if config.get('auto_resume', False) != resume:
+        config = {**config, 'auto_resume': resume}
+        write_configfile(working_dir, config)
+    if resume:
+        logger.info('Resuming biotrainer from its last checkpoint.')
+    markers.start('biotrainer', biotrainer_fingerprint)
+
+    # The configuration only has absolute paths, so the current directory of the process is never changed and
+    # many runs can share the process
+    logger.info('Executing biotrainer ({}).'.format(args.backend))
+    with manifest.stage('biotrainer') as stage:
+        if args.backend == 'inprocess':
+            exit_code = run_biotrainer_inprocess(config, working_dir)
+        else:
+            memory_limit = None if args.memorylimit is None else int(args.memorylimit * 1024 ** 3)
+            result = run_biotrainer_subprocess(working_dir, args.timeout, memory_limit)
+            stage.record(job_status=result['status'],
+                         **{key: result[key] for key in ('epoch', 'loss', 'log_file') if key in result})
+            if result['status'] == 'cancelled':
+                raise KeyboardInterrupt
+            # Jobs stopped for exceeding their limits have no exit code of their own
+            exit_code = result['exit_code'] if result['status'] in ('succeeded', 'failed') else 1
+        stage.record(backend=args.backend, exit_code=exit_code, resumed=resume)
+    if exit_code != 0:
+        logger.error('biotrainer finished with exit code {}.'.format(exit_code))
+    else:
+        markers.complete('biotrainer', biotrainer_fingerprint, [])
     logger.info('Done.')
 
+    return exit_code
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import resource
+import logging
+
+from pathlib import Path
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Name of the manifest written to the working directory
+MANIFEST_FILE = 'run_manifest.json'
+
+# Peaks of the stages being measured in this process, updated before the peak of the process is reset
+_open_peaks: List[List[int]] = []
+
+
+def _peak_rss(who: int) -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def _reset_peak_rss() -> bool:
+    # Resets the peak resident memory of the process (Linux 4.0+), so the next ru_maxrss is the peak since now.
+    # The peaks of the enclosing stages are saved first. Returns False if the peak cannot be reset
+    current = _peak_rss(resource.RUSAGE_SELF)
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    for peak in _open_peaks:
+        peak[0] = max(peak[0], current)
+    return True
+
+
+def _cpu_time() -> float:
+    usage_self, usage_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+class Stage:
+    """
+    Measures of one stage of a run. Besides the times and peak memory measured automatically, stages can record
+    any other value (number of records, file sizes, exit codes, ...).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.values = {}
+
+    def record(self, **values):
+        """
+        Records values of the stage, e.g. stage.record(records=100).
+        """
+        self.values.update(values)
+
+    def record_file(self, key: str, path: Optional[str]):
+        """
+        Records the size in bytes of a file, if it exists.
+
+        :param key: name of the value to record
+        :param path: path to the file
+        """
+        if path is not None and os.path.exists(path):
+            self.values[key] = os.path.getsize(path)
+
+
+class RunManifest:
+    """
+    Structured record of an execution: its parameters and the measures of every stage, in order. Stages measure
+    wall time, CPU time (of autoeval and its subprocesses) and peak resident memory. The peak of autoeval is the
+    one of the stage where the peak of the process can be reset (Linux), and the peak of the whole process so far
+    otherwise, as told by peak_rss_scope. The peak of the subprocesses is always the largest one of the process
+    so far (children_max_peak_rss), as it cannot be reset.
+    """
+
+    def __init__(self, **run):
+        self.run = run
+        self.stages: List[Dict[str, any]] = []
+        self.status = 'running'
+        self._start = time.perf_counter()
+        self._started_at = datetime.now(timezone.utc).isoformat()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Context manager measuring a stage of the run. It yields the Stage to record values on.
+
+        :param name: name of the stage
+        """
+        stage = Stage(name)
+        started_at = datetime.now(timezone.utc).isoformat()
+        peak = [0]
+        per_stage = _reset_peak_rss()
+        _open_peaks.append(peak)
+        wall_start, cpu_start = time.perf_counter(), _cpu_time()
+        status = 'failed'
+        try:
+            yield stage
+            status = 'succeeded'
+        finally:
+            _open_peaks.remove(peak)
+            self.stages.append({
+                'name': name,
+                'status': status,
+                'started_at': started_at,
+                'wall_time': time.perf_counter() - wall_start,
+                'cpu_time': _cpu_time() - cpu_start,
+                'peak_rss': max(peak[0], _peak_rss(resource.RUSAGE_SELF)),
+                'peak_rss_scope': 'stage' if per_stage else 'process',
+                'children_max_peak_rss': _peak_rss(resource.RUSAGE_CHILDREN),
+                **stage.values
+            })
+
+    def to_dict(self) -> Dict[str, any]:
+        """
+        :return: the manifest as a JSON-serializable dictionary.
+        """
+        return {
+            'run': self.run,
+            'status': self.status,
+            'started_at': self._started_at,
+            'wall_time': time.perf_counter() - self._start,
+            'stages': self.stages
+        }
+
+    def save(self, path: Path):
+        """
+        Writes the manifest as JSON.
+
+        :param path: path to the JSON file
+        """
+        with open(path, 'w') as mfile:
+            json.dump(self.to_dict(), mfile, indent=2, default=str)
+
+    def export_metrics(self, path: Path):
+        """
+        Writes the measures of the stages in the Prometheus text format, e.g. for the textfile collector of the
+        node exporter.
+
+        :param path: path to the metrics file
+        """
+        labels = 'split="{}"'.format(self.run.get('split', ''))
+        lines = []
+        for metric, key, description in (('autoeval_stage_wall_seconds', 'wall_time', 'Wall time of the stage.'),
+                                         ('autoeval_stage_cpu_seconds', 'cpu_time', 'CPU time of the stage.'),
+                                         ('autoeval_stage_peak_rss_bytes', 'peak_rss', 'Peak RSS of the stage.')):
+            lines += ['# HELP {} {}'.format(metric, description), '# TYPE {} gauge'.format(metric)]
+            lines += ['{}{{{},stage="{}"}} {}'.format(metric, labels, stage['name'], stage[key])
+                      for stage in self.stages]
+        lines += ['# HELP autoeval_run_succeeded 1 if the run succeeded.', '# TYPE autoeval_run_succeeded gauge',
+                  'autoeval_run_succeeded{{{}}} {}'.format(labels, int(self.status == 'succeeded'))]
+
+        # Written to a temporary file and renamed, so collectors never read a partial file
+        temporary_file = '{}.tmp-{}'.format(path, os.getpid())
+        with open(temporary_file, 'w') as mfile:
+            mfile.write('\n'.join(lines) + '\n')
+        os.replace(temporary_file, path)
@@ -0,0 +1,33 @@
+import os
+import fcntl
+import threading
+
+from pathlib import Path
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(path: Path):
+    """
+    Context manager holding an exclusive lock on a lock file, shared by all the processes of the host.
+
+    :param path: path to the lock file. It is created if it does not exist
+    """
+    os.makedirs(Path(path).parent, exist_ok=True)
+    with open(path, 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def temporary_name(name: str) -> str:
+    """
+    Name to write a file or directory shared by concurrent runs to before renaming it, unique to the process and
+    thread writing it.
+
+    :param name: name or path of the file or directory
+    :return: the temporary name.
+    """
+    return '{}.tmp-{}-{}'.format(name, os.getpid(), threading.get_ident())
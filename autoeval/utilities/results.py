@@ -0,0 +1,428 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import logging
+
+from pathlib import Path
+from contextlib import closing
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from .FLIP import FLIP_DATASETS
+from .settings import split_dict, cache_dir
+from .checkpoints import fingerprint, file_stamp
+from .instrumentation import MANIFEST_FILE
+
+logger = logging.getLogger(__name__)
+
+# Default database of the collected results, shared by all the runs of the host
+RESULTS_DATABASE = cache_dir / 'results.sqlite'
+
+# Bump when the schema of the database changes, so runs are collected again
+RESULTS_SCHEMA_VERSION = 3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    working_dir TEXT PRIMARY KEY,
+    stamp TEXT NOT NULL,
+    output_file TEXT,
+    split TEXT,
+    dataset TEXT,
+    protocol TEXT,
+    embedder TEXT,
+    model TEXT,
+    overrides TEXT,
+    status TEXT,
+    metric TEXT,
+    value REAL,
+    metrics TEXT,
+    wall_time REAL,
+    finished_at REAL,
+    collected_at REAL
+);
+CREATE INDEX IF NOT EXISTS runs_by_split ON runs (dataset, split);
+CREATE INDEX IF NOT EXISTS runs_by_model ON runs (embedder, model);
+'''
+
+_COLUMNS = ('working_dir', 'stamp', 'output_file', 'split', 'dataset', 'protocol', 'embedder', 'model', 'overrides',
+            'status', 'metric', 'value', 'metrics', 'wall_time', 'finished_at', 'collected_at')
+
+
+def connect(database: Path) -> sqlite3.Connection:
+    """
+    Opens the results database, creating it if needed. Databases of an older schema are emptied, so their runs
+    are collected again.
+
+    :param database: path to the SQLite database
+    :return: the connection.
+    """
+    os.makedirs(Path(database).parent, exist_ok=True)
+    connection = sqlite3.connect(str(database), timeout=60)
+    # Readers are not blocked by the runs being collected by other processes
+    connection.execute('PRAGMA journal_mode=WAL')
+    if connection.execute('PRAGMA user_version').fetchone()[0] != RESULTS_SCHEMA_VERSION:
+        connection.execute('DROP TABLE IF EXISTS runs')
+        connection.execute(f'PRAGMA user_version = {RESULTS_SCHEMA_VERSION}')
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def find_runs(roots: Iterable[str]) -> Iterator[Path]:
+    """
+    Finds the working directories of the runs under the given folders: the ones with a run manifest or a
+    config.yml. The folders inside a working directory are not searched.
+
+    :param roots: paths to working directories or folders with working directories, e.g. the one of a sweep
+    :return: an iterator of the absolute paths to the working directories.
+    """
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(Path(root).resolve()):
+            if MANIFEST_FILE in filenames or 'config.yml' in filenames:
+                dirnames[:] = []
+                yield Path(dirpath)
+            else:
+                dirnames.sort()
+
+
+def _loader():
+    import yaml
+
+    # Values of unknown types (e.g. numpy scalars) are read as plain YAML instead of failing
+    class Loader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+        pass
+
+    def construct_unknown(loader, suffix, node):
+        if isinstance(node, yaml.MappingNode):
+            return loader.construct_mapping(node, deep=True)
+        if isinstance(node, yaml.SequenceNode):
+            return loader.construct_sequence(node, deep=True)
+        return loader.construct_scalar(node)
+
+    Loader.add_multi_constructor('', construct_unknown)
+    return Loader
+
+
+def _load_yaml(path: Path) -> Dict[str, any]:
+    import yaml
+
+    with open(path, 'r') as yfile:
+        return yaml.load(yfile, Loader=_loader()) or {}
+
+
+def _find_metrics(node: any) -> Optional[Dict[str, float]]:
+    # First dictionary of numeric values stored under a metrics key
+    if isinstance(node, dict):
+        metrics = node.get('metrics')
+        if isinstance(metrics, dict) and metrics:
+            values = {}
+            for name, value in metrics.items():
+                try:
+                    values[str(name)] = float(value)
+                except (TypeError, ValueError):
+                    continue
+            if values:
+                return values
+        children = node.values()
+    elif isinstance(node, list):
+        children = node
+    else:
+        return None
+    for child in children:
+        metrics = _find_metrics(child)
+        if metrics is not None:
+            return metrics
+    return None
+
+
+def test_metrics(output: Dict[str, any]) -> Dict[str, float]:
+    """
+    Extracts the test metrics of a biotrainer output, for the layouts of the different biotrainer versions
+    (test_iterations_results with metrics, or with a metrics entry per test set).
+
+    :param output: content of the out.yml written by biotrainer
+    :return: the metrics by name, empty if the output has no test results.
+    """
+    for key in ('test_iterations_results', 'test_results'):
+        if key in output:
+            return _find_metrics(output[key]) or {}
+    return {}
+
+
+def read_test_metrics(output_file: Path) -> Dict[str, float]:
+    """
+    Reads the test metrics of the out.yml written by biotrainer. Outputs can be large, as they have the predictions
+    of every protein, so only the metrics blocks of the test results are parsed. The whole file is only loaded if
+    no metrics block is found in the layout written by biotrainer.
+
+    :param output_file: path to the out.yml
+    :return: the metrics by name, empty if the output has no test results.
+    """
+    import yaml
+
+    blocks, block, indent, in_test = [], None, 0, False
+    with open(output_file, 'r') as ofile:
+        for line in ofile:
+            stripped = line.lstrip(' ')
+            if not stripped.strip():
+                continue
+            level = len(line) - len(stripped)
+            if level == 0:
+                in_test = stripped.split(':', 1)[0] in ('test_iterations_results', 'test_results')
+                block = None
+                continue
+            if block is not None and level > indent:
+                block.append(line[indent:])
+                continue
+            block = None
+            if in_test and stripped.rstrip() == 'metrics:':
+                block, indent = [], level
+                blocks.append(block)
+
+    for lines in blocks:
+        try:
+            metrics = _find_metrics({'metrics': yaml.load(''.join(lines), Loader=_loader())})
+        except yaml.YAMLError:
+            continue
+        if metrics:
+            return metrics
+
+    return test_metrics(_load_yaml(output_file))
+
+
+def metric_value(metrics: Dict[str, float], metric: str) -> Optional[float]:
+    """
+    :param metrics: metrics by name, as returned by test_metrics
+    :param metric: name of the metric, e.g. the recommended_evaluation_metric of a FLIP dataset
+    :return: the value of the metric, ignoring the case, dashes and underscores of the names, or None if missing.
+    """
+    if metric in metrics:
+        return metrics[metric]
+    normalized = metric.lower().replace('-', '').replace('_', '')
+    for name, value in metrics.items():
+        if name.lower().replace('-', '').replace('_', '') == normalized:
+            return value
+    return None
+
+
+def _run_files(working_dir: Path, config: Optional[Dict[str, any]]) -> Dict[str, Path]:
+    output_dir = Path((config or {}).get('output_dir') or 'output')
+    return {'manifest': working_dir / MANIFEST_FILE, 'config': working_dir / 'config.yml',
+            'output': output_dir / 'out.yml' if output_dir.is_absolute() else working_dir / output_dir / 'out.yml'}
+
+
+def _run_stamp(working_dir: Path, output_file: Path) -> str:
+    # Changes whenever one of the files a run is read from changes
+    return fingerprint(file_stamp(str(working_dir / MANIFEST_FILE)), file_stamp(str(working_dir / 'config.yml')),
+                       file_stamp(str(output_file)))
+
+
+def _run_embedder(manifest: Dict[str, any], config: Dict[str, any]) -> Optional[str]:
+    # Runs embedding the split themselves (embedding store, length buckets, landscape) give biotrainer an embeddings
+    # file, so the embedder is taken from the manifest first: the one stamped by the embeddings stage, then the one
+    # of the arguments. The name of the embeddings file is only used for precomputed embeddings
+    for stage in manifest.get('stages', []):
+        if stage.get('name') == 'embeddings' and stage.get('embedder_name'):
+            return stage['embedder_name']
+    embedder = manifest.get('run', {}).get('args', {}).get('embedder') or config.get('embedder_name')
+    if embedder is None and config.get('embeddings_file') not in (None, 'None'):
+        embedder = 'file:{}'.format(Path(config['embeddings_file']).name)
+    return embedder
+
+
+def _run_overrides(manifest: Dict[str, any], config: Dict[str, any]) -> str:
+    # Options overridden for the run (e.g. the values of a sweep grid), with the values written to config.yml, so
+    # overrides resulting in the same configuration (e.g. 1e-3 and 0.001) are the same
+    values = set()
+    for override in manifest.get('run', {}).get('args', {}).get('override') or []:
+        option = override.partition('=')[0].strip()
+        value = config
+        for key in option.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        values.add('{}={}'.format(option, value))
+    return ', '.join(sorted(values))
+
+
+def read_run(working_dir: Path) -> Dict[str, any]:
+    """
+    Reads the results of a run from its working directory: the split, status, embedder and overrides from the run
+    manifest, the model (and the embedder, if not in the manifest) and the overridden values from config.yml and
+    the test metrics from the out.yml of biotrainer.
+
+    :param working_dir: path to the working directory of the run
+    :return: the row of the run, with the value of the recommended metric of its dataset.
+    """
+    config = _load_yaml(working_dir / 'config.yml') if os.path.exists(working_dir / 'config.yml') else {}
+    files = _run_files(working_dir, config)
+    manifest = {}
+    if os.path.exists(files['manifest']):
+        with open(files['manifest'], 'r') as mfile:
+            manifest = json.load(mfile)
+
+    split = manifest.get('run', {}).get('split') or working_dir.name
+    dataset = split_dict[split][0] if split in split_dict else None
+    metric = FLIP_DATASETS[dataset]['recommended_evaluation_metric'] if dataset in FLIP_DATASETS else None
+    metrics = read_test_metrics(files['output']) if os.path.exists(files['output']) else {}
+    status = manifest.get('status') or ('succeeded' if metrics else 'unknown')
+
+    return {
+        'working_dir': str(working_dir),
+        'stamp': _run_stamp(working_dir, files['output']),
+        'output_file': str(files['output']),
+        'split': split,
+        'dataset': dataset,
+        'protocol': manifest.get('run', {}).get('protocol') or config.get('protocol'),
+        'embedder': _run_embedder(manifest, config),
+        'model': config.get('model_choice'),
+        'overrides': _run_overrides(manifest, config),
+        'status': status,
+        'metric': metric,
+        'value': metric_value(metrics, metric) if metric else None,
+        'metrics': json.dumps(metrics, sort_keys=True),
+        'wall_time': manifest.get('wall_time'),
+        'finished_at': max((os.path.getmtime(path) for path in files.values() if os.path.exists(path)),
+                           default=None),
+        'collected_at': time.time(),
+    }
+
+
+def collect_results(roots: Iterable[str], database: Path = RESULTS_DATABASE) -> Dict[str, int]:
+    """
+    Collects the results of the runs under the given folders into the database. Only the runs that are new or
+    whose files changed since they were collected are read again.
+
+    :param roots: paths to working directories or folders with working directories
+    :param database: path to the SQLite database
+    :return: the number of runs found, read and skipped because they did not change.
+    """
+    counts = {'found': 0, 'collected': 0, 'unchanged': 0, 'failed': 0}
+    with closing(connect(database)) as connection:
+        collected = {working_dir: (stamp, Path(output_file)) for working_dir, stamp, output_file in
+                     connection.execute('SELECT working_dir, stamp, output_file FROM runs')}
+        rows = []
+        for working_dir in find_runs(roots):
+            counts['found'] += 1
+            stamp, output_file = collected.get(str(working_dir), (None, None))
+            if stamp is not None and stamp == _run_stamp(working_dir, output_file):
+                counts['unchanged'] += 1
+                continue
+            try:
+                rows.append(read_run(working_dir))
+                counts['collected'] += 1
+            except Exception as e:
+                logger.warning('The results of {} could not be read: {}'.format(working_dir, e))
+                counts['failed'] += 1
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO runs ({}) VALUES ({})'.format(
+                ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))), [[row[column] for column in _COLUMNS]
+                                                                      for row in rows])
+    logger.info('{found} runs found: {collected} collected, {unchanged} unchanged, {failed} failed.'.format(**counts))
+
+    return counts
+
+
+def leaderboard(database: Path = RESULTS_DATABASE, datasets: Optional[List[str]] = None,
+                under: Optional[str] = None) -> List[Dict[str, any]]:
+    """
+    Builds the FLIP leaderboard from the collected runs: the value of the recommended metric of every split for
+    every embedder, model and overrides (e.g. the values of a sweep grid). When a combination was run more than
+    once, the latest run is used.
+
+    :param database: path to the SQLite database
+    :param datasets: if set, only the splits of these datasets are included
+    :param under: if set, only the runs with a working directory under this folder are included
+    :return: one row per embedder, model and overrides, with the values by split name.
+    """
+    query = 'SELECT dataset, split, embedder, model, overrides, metric, value, MAX(finished_at) FROM runs ' \
+            'WHERE value IS NOT NULL'
+    parameters = []
+    if datasets:
+        query += ' AND dataset IN ({})'.format(', '.join('?' * len(datasets)))
+        parameters += datasets
+    if under:
+        # Compared as a prefix: LIKE would read _ and % in the path as wildcards and ignore the case
+        prefix = str(Path(under).resolve()).rstrip(os.sep) + os.sep
+        query += ' AND substr(working_dir, 1, ?) = ?'
+        parameters += [len(prefix), prefix]
+    query += ' GROUP BY split, embedder, model, overrides'
+
+    with closing(connect(database)) as connection:
+        rows = connection.execute(query, parameters).fetchall()
+
+    board = {}
+    for dataset, split, embedder, model, overrides, metric, value, _ in rows:
+        key = (embedder or '-', model or '-', overrides or '')
+        entry = board.setdefault(key, {'embedder': key[0], 'model': key[1], 'overrides': key[2], 'values': {},
+                                       'metrics': {}})
+        entry['values'][split] = value
+        entry['metrics'][split] = metric
+
+    return [board[key] for key in sorted(board)]
+
+
+def format_leaderboard(board: List[Dict[str, any]], output_format: str = 'markdown') -> str:
+    """
+    Formats a leaderboard as a table with one column per split, in the order of the FLIP splits. Markdown tables
+    only have a column with the overrides if some run has them.
+
+    :param board: rows returned by leaderboard
+    :param output_format: markdown or csv
+    :return: the table.
+    """
+    order = {split: i for i, split in enumerate(split_dict)}
+    columns = sorted({split for entry in board for split in entry['values']},
+                     key=lambda split: (order.get(split, len(order)), split))
+    metrics = {split: metric for entry in board for split, metric in entry['metrics'].items()}
+    with_overrides = output_format == 'csv' or any(entry.get('overrides') for entry in board)
+    cells = [[entry['embedder'], entry['model']] + ([entry.get('overrides') or '-'] if with_overrides else []) +
+             ['{:.4f}'.format(entry['values'][split]) if split in entry['values'] else '-' for split in columns]
+             for entry in board]
+
+    if output_format == 'csv':
+        header = ['embedder', 'model', 'overrides'] + columns
+        return '\n'.join(','.join('"{}"'.format(cell) if ',' in cell else cell for cell in row)
+                         for row in [header] + cells) + '\n'
+
+    header = ['Embedder', 'Model'] + (['Overrides'] if with_overrides else []) + \
+        ['{} ({})'.format(split, metrics[split]) for split in columns]
+    fixed = 3 if with_overrides else 2
+    lines = ['| ' + ' | '.join(header) + ' |', '| ' + ' | '.join(['---'] * fixed + [':---:'] * len(columns)) + ' |']
+    lines += ['| ' + ' | '.join(row) + ' |' for row in cells]
+    return '\n'.join(lines) + '\n'
+
+
+def main(args: Optional[List[str]] = None):
+    """
+    Entry point to collect the results of autoeval runs and build the FLIP leaderboard
+    """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Collect the results of AutoEval runs and build the FLIP leaderboard.")
+    parser.add_argument("--database", type=str, default=str(RESULTS_DATABASE), help="The path to the SQLite database of the results.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    collect = subparsers.add_parser("collect", help="Collect the results of the runs under the given folders.")
+    collect.add_argument("roots", nargs="+", type=str, help="The working directories or folders with working directories (e.g. of a sweep).")
+    board = subparsers.add_parser("leaderboard", help="Print the leaderboard of the collected runs.")
+    board.add_argument("-d", "--dataset", type=str, nargs="+", default=None, help="Only include the splits of these datasets.")
+    board.add_argument("--under", type=str, default=None, help="Only include the runs under this folder.")
+    board.add_argument("-f", "--format", choices=['markdown', 'csv'], type=str, default='markdown', help="The format of the table.")
+    board.add_argument("-o", "--output", type=str, default=None, help="The path to save the table to. By default, it is printed.")
+    arguments = parser.parse_args(args)
+
+    if arguments.command == "collect":
+        counts = collect_results(arguments.roots, Path(arguments.database))
+        return 1 if counts['failed'] else 0
+
+    table = format_leaderboard(leaderboard(Path(arguments.database), arguments.dataset, arguments.under),
+                               arguments.format)
+    if arguments.output:
+        with open(arguments.output, 'w') as tfile:
+            tfile.write(table)
+    else:
+        print(table, end='')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
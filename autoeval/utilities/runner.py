@@ -0,0 +1,276 @@
+import os
+import re
+import sys
+import time
+import codecs
+import signal
+import asyncio
+import logging
+
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, TextIO
+
+logger = logging.getLogger(__name__)
+
+# Script running biotrainer with a config file
+BIOTRAINER_SCRIPT = (Path(os.path.dirname(os.path.abspath(__file__))) / '../biotrainer/run-biotrainer.py').resolve()
+
+# Name of the log of biotrainer written to the working directory
+LOG_FILE = 'biotrainer.log'
+
+# Seconds between two checks of the memory used by a job
+MEMORY_POLL_INTERVAL = 1.0
+
+# Seconds given to a job to stop after SIGTERM before it is killed
+TERMINATION_GRACE = 10.0
+
+_LINE_END_PATTERN = re.compile(r'[\r\n]')
+_EPOCH_PATTERN = re.compile(r'\bEpoch\s+(\d+)', re.IGNORECASE)
+_PHASE_PATTERN = re.compile(r'\b(Training|Validation|Test) results', re.IGNORECASE)
+_LOSS_PATTERN = re.compile(r'\bloss\b[\s:=]+([-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)', re.IGNORECASE)
+
+
+class BiotrainerJob(NamedTuple):
+    """
+    A biotrainer run: the config file to run and the limits of the run.
+    """
+    name: str
+    working_dir: Path
+    config_file: Path
+    timeout: Optional[float] = None         # seconds
+    memory_limit: Optional[int] = None      # bytes, of the process and all its children
+
+
+class ProgressParser:
+    """
+    Turns the output lines of biotrainer into progress events: a new epoch, or a loss of the training, validation
+    or test phase of the current epoch.
+    """
+
+    def __init__(self, job: str):
+        self.job = job
+        self.epoch = None
+        self.phase = None
+        self.loss = None
+
+    def parse(self, line: str) -> Optional[Dict[str, any]]:
+        """
+        :param line: output line of biotrainer
+        :return: the progress event of the line, or None if the line has no progress information.
+        """
+        epoch = _EPOCH_PATTERN.search(line)
+        if epoch:
+            self.epoch, self.phase = int(epoch.group(1)), None
+            return {'job': self.job, 'event': 'epoch', 'epoch': self.epoch, 'time': time.time()}
+        phase = _PHASE_PATTERN.search(line)
+        if phase:
+            self.phase = phase.group(1).lower()
+        loss = _LOSS_PATTERN.search(line)
+        if loss:
+            self.loss = float(loss.group(1))
+            return {'job': self.job, 'event': 'loss', 'epoch': self.epoch, 'phase': self.phase, 'loss': self.loss,
+                    'time': time.time()}
+
+        return None
+
+
+def _tree_rss(pid: int) -> Optional[int]:
+    # Resident memory in bytes of a process and all its descendants, from /proc. None if /proc is not available
+    if not os.path.isdir('/proc'):
+        return None
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/statm', 'r') as sfile:
+                total += int(sfile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children', 'r') as cfile:
+                    pending.extend(int(child) for child in cfile.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+async def _tee(stream: asyncio.StreamReader, log: TextIO, echo: Optional[TextIO], parser: ProgressParser,
+               on_event: Optional[Callable[[Dict[str, any]], None]]):
+    # Copies the stream to the log (and to echo) as it arrives, parsing its lines into progress events.
+    # Progress bars rewrite their line with carriage returns, so they are also line ends
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    while True:
+        chunk = await stream.read(64 * 1024)
+        text = decoder.decode(chunk, final=not chunk)
+        log.write(text)
+        log.flush()
+        if echo is not None:
+            echo.write(text)
+            echo.flush()
+        *lines, pending = _LINE_END_PATTERN.split(pending + text)
+        if not chunk:
+            lines.append(pending)
+        for line in lines:
+            event = parser.parse(line)
+            if event is not None and on_event is not None:
+                on_event(event)
+        if not chunk:
+            return
+
+
+async def _watch_memory(process: asyncio.subprocess.Process, limit: int) -> bool:
+    # Returns True once the job uses more than limit bytes
+    while process.returncode is None:
+        rss = _tree_rss(process.pid)
+        if rss is None:
+            logger.warning('Memory limits are not supported on this platform.')
+            return False
+        if rss > limit:
+            return True
+        await asyncio.sleep(MEMORY_POLL_INTERVAL)
+    return False
+
+
+async def _terminate(process: asyncio.subprocess.Process):
+    # Stops the job and all the processes it started: SIGTERM first, SIGKILL if they do not stop in time
+    if process.returncode is not None:
+        return
+    for sig, wait in ((signal.SIGTERM, TERMINATION_GRACE), (signal.SIGKILL, None)):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(process.wait(), wait)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+
+async def run_job(job: BiotrainerJob, on_event: Optional[Callable[[Dict[str, any]], None]] = None,
+                  echo: bool = False) -> Dict[str, any]:
+    """
+    Runs biotrainer for a job in a new process group, teeing its stdout and stderr to LOG_FILE in the working
+    directory. The job is stopped when it exceeds its timeout or memory limit, or when the task is cancelled.
+
+    :param job: the job to run
+    :param on_event: function called with every progress event (epoch, loss) of the job
+    :param echo: if True, the output of biotrainer is also written to the stdout and stderr of autoeval
+    :return: a dictionary with the name, status, exit code, wall time, log file and last epoch and loss of the job.
+    """
+    parser = ProgressParser(job.name)
+    log_file = job.working_dir / LOG_FILE
+    start = time.time()
+    status = 'failed'
+    with open(log_file, 'a') as log:
+        process = await asyncio.create_subprocess_exec(
+            "python3", str(BIOTRAINER_SCRIPT), str(job.config_file), cwd=str(job.working_dir),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        logger.info('Job {} started (pid {}).'.format(job.name, process.pid))
+        streams = asyncio.gather(_tee(process.stdout, log, sys.stdout if echo else None, parser, on_event),
+                                 _tee(process.stderr, log, sys.stderr if echo else None, parser, on_event))
+        finished = asyncio.ensure_future(asyncio.gather(process.wait(), streams))
+        watchers = {finished}
+        if job.memory_limit is not None:
+            memory = asyncio.ensure_future(_watch_memory(process, job.memory_limit))
+            watchers.add(memory)
+        try:
+            while True:
+                done, _ = await asyncio.wait(watchers, timeout=None if job.timeout is None else
+                                             max(0.0, job.timeout - (time.time() - start)),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if finished in done:
+                    status = 'succeeded' if process.returncode == 0 else 'failed'
+                    break
+                if not done:
+                    status = 'timeout'
+                    logger.error('Job {} exceeded its timeout of {}s.'.format(job.name, job.timeout))
+                    break
+                watchers.discard(memory)
+                if memory.result():
+                    status = 'memory'
+                    logger.error('Job {} exceeded its memory limit of {} bytes.'.format(job.name, job.memory_limit))
+                    break
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            logger.warning('Job {} cancelled.'.format(job.name))
+            raise
+        finally:
+            await asyncio.shield(_terminate(process))
+            for watcher in watchers:
+                watcher.cancel()
+            await asyncio.gather(*watchers, return_exceptions=True)
+            result = {'name': job.name, 'status': status, 'exit_code': process.returncode,
+                      'wall_time': time.time() - start, 'log_file': str(log_file),
+                      'epoch': parser.epoch, 'loss': parser.loss}
+
+    return result
+
+
+async def run_jobs(jobs: List[BiotrainerJob], concurrency: int,
+                   on_event: Optional[Callable[[Dict[str, any]], None]] = None,
+                   on_result: Optional[Callable[[Dict[str, any]], None]] = None) -> List[Dict[str, any]]:
+    """
+    Runs many jobs from the same event loop, with at most concurrency jobs at the same time. On SIGINT, the
+    running jobs are stopped and the pending ones are not started.
+
+    :param jobs: the jobs to run
+    :param concurrency: maximum number of jobs running at the same time
+    :param on_event: function called with every progress event of the jobs
+    :param on_result: function called with the result of every job as soon as it finishes
+    :return: the results of the jobs, in the same order. Jobs not run have the status cancelled.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(job: BiotrainerJob) -> Dict[str, any]:
+        async with semaphore:
+            result = await run_job(job, on_event)
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    tasks = [asyncio.ensure_future(run(job)) for job in jobs]
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, lambda: [task.cancel() for task in tasks])
+    except (NotImplementedError, RuntimeError):
+        pass
+    try:
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    results = []
+    for job, outcome in zip(jobs, outcomes):
+        if isinstance(outcome, BaseException):
+            outcome = {'name': job.name, 'status': 'cancelled' if isinstance(outcome, asyncio.CancelledError)
+                       else 'failed', 'exit_code': None, 'error': repr(outcome)}
+        results.append(outcome)
+
+    return results
+
+
+def run_biotrainer_job(job: BiotrainerJob, on_event: Optional[Callable[[Dict[str, any]], None]] = None) -> \
+        Dict[str, any]:
+    """
+    Runs a single job until it finishes, echoing its output. SIGINT stops biotrainer before returning.
+
+    :param job: the job to run
+    :param on_event: function called with every progress event of the job
+    :return: the result of the job, as returned by run_job.
+    """
+    async def run() -> Dict[str, any]:
+        task = asyncio.ensure_future(run_job(job, on_event, echo=True))
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, task.cancel)
+        except (NotImplementedError, RuntimeError):
+            pass
+        try:
+            return await task
+        except asyncio.CancelledError:
+            return {'name': job.name, 'status': 'cancelled', 'exit_code': None}
+
+    return asyncio.run(run())
@@ -43,10 +43,30 @@ split_dict = {
 global protocols
 protocols = ['residue_to_class', 'sequence_to_class', 'sequence_to_value', 'residue_to_value', 'residues_to_class']
 
+# Ways of running biotrainer
+global backends
+backends = ['subprocess', 'inprocess']
+
+# Ways of grouping the sequences embedded by autoeval: shards by length, or variants of a mutational landscape
+global embedding_strategies
+embedding_strategies = ['length', 'landscape']
+
+# Ways of handling the inconsistencies found in residue-level splits
+global validation_modes
+validation_modes = ['report', 'repair', 'strict', 'off']
+
 # Path to the configurations bank
 global configs_bank
 configs_bank = (Path(os.path.dirname(os.path.abspath(__file__))) / '..' / 'configsbank').resolve()
 
 # Path to the splits
 global splits
-splits = (Path(os.path.dirname(os.path.abspath(__file__))) / '..' / 'FLIP' / 'splits').resolve()
\ No newline at end of file
+splits = (Path(os.path.dirname(os.path.abspath(__file__))) / '..' / 'FLIP' / 'splits').resolve()
+
+# Path to the cache of autoeval (prepared splits, indexes, ...). It can be changed with AUTOEVAL_CACHE_DIR
+global cache_dir
+cache_dir = Path(os.environ.get('AUTOEVAL_CACHE_DIR', Path.home() / '.cache' / 'autoeval')).resolve()
+
+# Maximum size in bytes of the prepared data cache before the least recently used entries are evicted
+global prepared_cache_max_size
+prepared_cache_max_size = int(os.environ.get('AUTOEVAL_CACHE_MAX_SIZE', 10 * 1024 ** 3))
@@ -0,0 +1,282 @@
+import re
+import sys
+import json
+import time
+import fnmatch
+import argparse
+import logging
+
+from pathlib import Path
+from typing import Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .cli import create_parser
+from .FLIP import FLIP_DATASETS
+from .settings import split_dict, protocols, cache_dir, configs_bank, backends, embedding_strategies, validation_modes
+
+logger = logging.getLogger(__name__)
+
+
+def create_sweep_parser():
+    """
+    Creates the parser for the sweep command line interface. The included arguments are:
+    - splits: names or glob patterns of the splits to use, e.g. scl_* (from the available ones in FLIP).
+
+    - working_dir: the path to the folder where the needed files and results of all the jobs will be saved.
+
+    - -e or --embedder: the names of the embedders to use. Every split is evaluated with every embedder.
+
+    - -m or --model: the names of the models to use. Every split is evaluated with every model.
+
+    - -p or --protocol: the protocol to use for all the splits.
+        If not provided, the protocol of the dataset of each split is used.
+
+    - -g or --grid: biotrainer options to sweep, as KEY=VALUE1,VALUE2,... (e.g. learning_rate=1e-3,1e-4).
+        Every combination of values is a job for every split, embedder and model. Identical configurations are
+        only run once.
+
+    - -w or --workers: the maximum number of jobs running at the same time.
+        Before running the jobs, the data of all the splits is prepared at once with the same number of workers.
+
+    - -b, -lb, -est, --batchresidues, --embeddingworkers, -mins, -maxs, -mask, -es, --cachedir, -nc, -r, -val, --timeout and --memorylimit: passed to every job, as in the single split interface.
+    """
+
+    parser = argparse.ArgumentParser(description="Train and evaluate many splits, embedders and models using biotrainer.")
+    parser.add_argument("splits", nargs="+", type=str, help="The splits to train and evaluate. Glob patterns (e.g. scl_*) are accepted.")
+    parser.add_argument("working_dir", type=str, help="The path to the folder to save the needed files and results.")
+    parser.add_argument("-e", "--embedder", type=str, nargs="+", default=[None], help="The embedders to use.")
+    parser.add_argument("-m", "--model", type=str, nargs="+", default=[None], help="The models to use.")
+    parser.add_argument("-p", "--protocol", choices=protocols, type=str, default=None, help="The protocol to use. By default, the one of the dataset of each split.")
+    parser.add_argument("-g", "--grid", type=str, nargs="+", default=None, help="Biotrainer options to sweep, as KEY=VALUE1,VALUE2,... (e.g. learning_rate=1e-3,1e-4).")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Maximum number of jobs running at the same time.")
+    parser.add_argument("-mask", "--mask", type=str, nargs='?', const='mask.fasta', help="If set, use the masks in the file mask.fasta from the working directory to filter the residues")
+    parser.add_argument("-es", "--embeddingstore", type=str, nargs='?', const=str(cache_dir / 'embeddings'), help="If set, reuse the embeddings of the dataset from the embedding store in the given folder")
+    parser.add_argument("-b", "--backend", choices=backends, type=str, default=None, help="How to run biotrainer: in a new python process or in the current one.")
+    parser.add_argument("-lb", "--lengthbuckets", type=str, default=None, help="Comma-separated length limits of the shards to embed the split in, e.g. 500,1000,2000.")
+    parser.add_argument("-est", "--embeddingstrategy", choices=embedding_strategies, type=str, default='length', help="How to group the sequences embedded by autoeval: by length or as variants of a mutational landscape.")
+    parser.add_argument("--batchresidues", type=int, default=4000, help="Maximum number of residues per embedding batch when embedding in shards.")
+    parser.add_argument("--embeddingworkers", type=int, default=1, help="Number of shards embedded at the same time.")
+    parser.add_argument("-mins", "--minsize", help="Use proteins with more than minsize residues.", type=int, default=None)
+    parser.add_argument("-maxs", "--maxsize", help="Use proteins with less than maxsize residues.", type=int, default=None)
+    parser.add_argument("--cachedir", help="Path to the cache of autoeval.", type=str, default=str(cache_dir))
+    parser.add_argument("-nc", "--nocache", help="If set, do not reuse prepared data from previous runs.", action="store_true")
+    parser.add_argument("--timeout", help="Maximum time in seconds biotrainer can run in every job.", type=float, default=None)
+    parser.add_argument("--memorylimit", help="Maximum memory in GB biotrainer can use in every job.", type=float, default=None)
+    parser.add_argument("-r", "--restart", help="If set, run all the stages again instead of skipping the ones completed by a previous run.", action="store_true")
+    parser.add_argument("-val", "--validation", choices=validation_modes, type=str, default='report', help="How to handle residue labels and masks not matching the sequences.")
+
+    return parser
+
+
+def expand_splits(patterns: List[str]) -> List[str]:
+    """
+    Expands names and glob patterns of splits into the matching split names, keeping the order of split_dict.
+
+    :param patterns: split names or glob patterns
+    :return: the list of matching split names.
+    """
+    selected = []
+    for pattern in patterns:
+        matches = [split for split in split_dict if fnmatch.fnmatchcase(split, pattern)]
+        if not matches:
+            raise Exception(f"No split matches {pattern}.")
+        selected.extend(split for split in matches if split not in selected)
+
+    return selected
+
+
+def _tag(name: Optional[str]) -> str:
+    return 'default' if name is None else re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+
+
+def grid_overrides(split: str, embedder: Optional[str], model: Optional[str],
+                   grid: Dict[str, List[any]]) -> List[Dict[str, any]]:
+    """
+    Expands the grid of options for a job into the overrides of every configuration, validated with the default
+    configuration of the dataset of the split. Combinations giving the same configuration are skipped.
+
+    :param split: name of the split
+    :param embedder: embedder of the job, or None for the one of the configuration
+    :param model: model of the job, or None for the one of the configuration
+    :param grid: values of every option, as returned by parse_grid
+    :return: the overrides of every distinct configuration, with their values as in the configuration.
+    """
+    from ..managers.configfiles import load_configfile, apply_overrides, config_grid
+
+    config = load_configfile(configs_bank / (split_dict[split][0] + '.yml'))
+    config = apply_overrides(config, {option: value for option, value in (('embedder_name', embedder),
+                                                                          ('model_choice', model))
+                                      if value is not None})
+    variants = []
+    for _, variant in config_grid(config, grid):
+        overrides = {}
+        for option in grid:
+            value = variant
+            for key in option.split('.'):
+                value = value[key]
+            overrides[option] = value
+        variants.append(overrides)
+
+    return variants
+
+
+def create_jobs(args: argparse.Namespace) -> List[Dict[str, any]]:
+    """
+    Creates one job for every combination of split, embedder, model and values of the grid. Each job gets its own
+    working directory (WORKING_DIR/EMBEDDER__MODEL[__GRID VALUES]/SPLIT) and the command line arguments of the
+    single split interface.
+
+    :param args: sweep execution arguments
+    :return: a list of jobs, as dictionaries with the name and the arguments of the job.
+    """
+    from ..managers.configfiles import parse_grid
+
+    grid = parse_grid(args.grid) if args.grid else {}
+    jobs = []
+    for split in expand_splits(args.splits):
+        protocol = args.protocol or FLIP_DATASETS[split_dict[split][0]]["protocol"]
+        for embedder in args.embedder:
+            for model in args.model:
+                for overrides in grid_overrides(split, embedder, model, grid) if grid else [{}]:
+                    jobs.append(_create_job(args, split, protocol, embedder, model, overrides))
+
+    return jobs
+
+
+def _create_job(args: argparse.Namespace, split: str, protocol: str, embedder: Optional[str], model: Optional[str],
+                overrides: Dict[str, any]) -> Dict[str, any]:
+    tag = f"{_tag(embedder)}__{_tag(model)}"
+    if overrides:
+        tag += '__' + _tag(','.join(f'{option}={value}' for option, value in overrides.items()))
+    job_dir = Path(args.working_dir) / tag
+    argv = [split, protocol, str(job_dir), "--cachedir", args.cachedir]
+    if embedder is not None:
+        argv += ["--embedder", embedder]
+    if model is not None:
+        argv += ["--model", model]
+    if args.mask:
+        argv += ["--mask", args.mask]
+    if args.embeddingstore:
+        argv += ["--embeddingstore", args.embeddingstore]
+    if args.minsize is not None:
+        argv += ["--minsize", str(args.minsize)]
+    if args.maxsize is not None:
+        argv += ["--maxsize", str(args.maxsize)]
+    if args.backend is not None:
+        argv += ["--backend", args.backend]
+    if args.embeddingstrategy == 'landscape':
+        argv += ["--embeddingstrategy", args.embeddingstrategy, "--batchresidues", str(args.batchresidues)]
+    elif args.lengthbuckets:
+        argv += ["--lengthbuckets", args.lengthbuckets, "--batchresidues", str(args.batchresidues),
+                 "--embeddingworkers", str(args.embeddingworkers)]
+    if args.nocache:
+        argv += ["--nocache"]
+    if args.restart:
+        argv += ["--restart"]
+    if args.timeout is not None:
+        argv += ["--timeout", str(args.timeout)]
+    if args.memorylimit is not None:
+        argv += ["--memorylimit", str(args.memorylimit)]
+    argv += ["--validation", args.validation]
+    for option, value in overrides.items():
+        argv += ["--override", f"{option}={value}"]
+
+    return {"name": f"{split}/{tag.replace('__', '/')}", "argv": argv, "working_dir": str(job_dir / split)}
+
+def prepare_sweep_data(jobs: List[Dict[str, any]], args: argparse.Namespace):
+    """
+    Prepares the data of all the splits of the sweep at once, parsing the files shared by the splits of a dataset
+    only once, and stores it in the prepared data cache. The jobs then link their data from the cache.
+
+    :param jobs: jobs created with create_jobs
+    :param args: sweep execution arguments
+    """
+    from ..managers.data import prepare_splits
+
+    working_dirs = {}
+    for job in jobs:
+        working_dirs.setdefault(job["argv"][0], Path(job["working_dir"]))
+    start = time.time()
+    try:
+        prepare_splits(working_dirs, args.protocol, args.minsize, args.maxsize, args.mask,
+                       cache_dir=Path(args.cachedir).resolve() / 'prepared', workers=args.workers)
+    except Exception as e:
+        # The jobs prepare the data of their split again and report the error of the failing ones
+        logger.warning('The data of the splits could not be prepared at once: {}'.format(e))
+        return
+    logger.info('Data of {} splits prepared in {:.1f}s.'.format(len(working_dirs), time.time() - start))
+
+
+def _run_job(argv: List[str]) -> Dict[str, any]:
+    from .executer import execute
+
+    start = time.time()
+    exit_code = execute(create_parser().parse_args(argv))
+    return {"exit_code": exit_code, "wall_time": time.time() - start}
+
+
+def run_sweep(jobs: List[Dict[str, any]], workers: int) -> List[Dict[str, any]]:
+    """
+    Runs the jobs on a pool of processes, with at most workers jobs at the same time.
+
+    :param jobs: jobs created with create_jobs
+    :param workers: maximum number of jobs running at the same time
+    :return: the jobs with their status, exit code and wall time.
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_run_job, job["argv"]): job for job in jobs}
+        for future in as_completed(futures):
+            job = dict(futures[future])
+            try:
+                job.update(future.result())
+                job["status"] = "succeeded" if job["exit_code"] == 0 else "failed"
+            except Exception as e:
+                job.update({"status": "failed", "error": repr(e)})
+            results.append(job)
+            logger.info('[{}/{}] Job {} {}{}.'.format(
+                len(results), len(jobs), job["name"], job["status"],
+                ' in {:.1f}s'.format(job["wall_time"]) if "wall_time" in job else ': ' + job.get("error", "")))
+
+    return results
+
+
+def main(args=None):
+    """
+    Entry point to AutoEval sweeps
+    """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logging.captureWarnings(True)
+
+    arguments = create_sweep_parser().parse_args(args)
+    jobs = create_jobs(arguments)
+    logger.info('Running {} jobs with {} workers.'.format(len(jobs), arguments.workers))
+
+    start = time.time()
+    # Without the cache, every job prepares its own data
+    if not arguments.nocache:
+        prepare_sweep_data(jobs, arguments)
+    results = run_sweep(jobs, arguments.workers)
+    failed = [job for job in results if job["status"] != "succeeded"]
+
+    # Save a summary of the sweep in the working directory
+    Path(arguments.working_dir).mkdir(parents=True, exist_ok=True)
+    with open(Path(arguments.working_dir) / 'sweep.json', 'w') as sfile:
+        json.dump({"wall_time": time.time() - start, "jobs": results}, sfile, indent=2)
+    logger.info('Sweep done: {} jobs succeeded, {} failed.'.format(len(results) - len(failed), len(failed)))
+
+    # Collect the results of the jobs and save the leaderboard of the sweep
+    from .results import collect_results, leaderboard, format_leaderboard
+    database = Path(arguments.cachedir) / 'results.sqlite'
+    try:
+        collect_results([arguments.working_dir], database)
+        with open(Path(arguments.working_dir) / 'leaderboard.md', 'w') as lfile:
+            lfile.write(format_leaderboard(leaderboard(database, under=arguments.working_dir)))
+    except Exception as e:
+        logger.warning('The results of the sweep could not be collected: {}'.format(e))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from pathlib import Path
+
+from autoeval.managers import data, splitindex
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def _wrap(sequence: str, width: int) -> str:
+    return '\n'.join(sequence[i:i + width] for i in range(0, len(sequence), width))
+
+
+@pytest.fixture
+def flip_splits(tmp_path: Path, monkeypatch) -> Path:
+    """
+    Synthetic FLIP checkout with an extracted sequence-level dataset (seqs, split s1) and an extracted
+    residue-level dataset (res, splits s1 and s2 sharing sequences.fasta and mask.fasta). Headers and line widths
+    vary between entries, as in the real FLIP files.
+    """
+    generator = random.Random(0)
+    root = tmp_path / 'splits'
+    sets = ['train', 'test', 'nan']
+
+    sequence_dir = root / 'seqs' / 'splits'
+    sequence_dir.mkdir(parents=True)
+    with open(sequence_dir / 's1.fasta', 'w') as handle:
+        for i in range(200):
+            sequence = ''.join(generator.choice(AMINO_ACIDS) for _ in range(generator.randint(5, 200)))
+            handle.write('>P{} TARGET={:.2f} SET={} VALIDATION={}\n{}\n'.format(
+                i, generator.random(), generator.choice(sets), generator.random() < 0.2, _wrap(sequence, 50)))
+
+    residue_dir = root / 'res' / 'splits'
+    residue_dir.mkdir(parents=True)
+    sequences = {f'R{i}': ''.join(generator.choice(AMINO_ACIDS) for _ in range(generator.randint(5, 200)))
+                 for i in range(200)}
+    with open(residue_dir / 'sequences.fasta', 'w') as handle:
+        for entry_id, sequence in sequences.items():
+            handle.write('>{} extra\n{}\n'.format(entry_id, _wrap(sequence, 80)))
+    for split_name, split_ids in (('s1', list(sequences)[::2]), ('s2', list(sequences)[::3])):
+        with open(residue_dir / f'{split_name}.fasta', 'w') as handle:
+            for entry_id in split_ids:
+                labels = ''.join(generator.choice('01') for _ in sequences[entry_id])
+                handle.write('>{} SET={} VALIDATION=False\n{}\n'.format(entry_id, generator.choice(sets),
+                                                                       _wrap(labels, 70)))
+    with open(residue_dir / 'mask.fasta', 'w') as handle:
+        for entry_id, sequence in sequences.items():
+            handle.write('>{}\n{}\n'.format(entry_id, ''.join(generator.choice('01') for _ in sequence)))
+
+    monkeypatch.setattr(data, 'splits', root)
+    monkeypatch.setattr(splitindex, 'splits', root)
+    monkeypatch.setattr(data, 'split_dict',
+                        {'seqs_s1': ['seqs', 's1'], 'res_s1': ['res', 's1'], 'res_s2': ['res', 's2']})
+    monkeypatch.setattr(splitindex, 'cache_dir', tmp_path / 'cache')
+
+    return root
@@ -0,0 +1,162 @@
+import os
+import time
+import filecmp
+
+import pytest
+
+from pathlib import Path
+from Bio import SeqIO
+
+from autoeval.managers import data
+from autoeval.managers.cache import evict_prepared_data
+from autoeval.managers.splitindex import build_split_index
+from autoeval.utilities.FASTA import filter_FASTA
+from autoeval.utilities.instrumentation import RunManifest
+
+
+def _baseline_prepare(split_files: Path, split_name: str, residue_level: bool, destination: Path, min_size: int,
+                      max_size: int, mask: str):
+    # Preparation as done by the original implementation: copy, then filter with Biopython in several passes
+    def keep_size(record):
+        return (min_size is not None and len(record.seq) > min_size) or \
+            (max_size is not None and len(record.seq) < max_size)
+
+    source = split_files / ('sequences.fasta' if residue_level else f'{split_name}.fasta')
+    sequences = list(SeqIO.parse(source, 'fasta'))
+    labels = list(SeqIO.parse(split_files / f'{split_name}.fasta', 'fasta')) if residue_level else None
+    if min_size is not None or max_size is not None:
+        deleted = {record.id for record in sequences if not keep_size(record)}
+        sequences = [record for record in sequences if record.id not in deleted]
+        if labels is not None:
+            labels = [record for record in labels if record.id not in deleted]
+    if labels is not None:
+        label_ids = {record.id for record in labels}
+        sequences = [record for record in sequences if record.id in label_ids]
+    deleted = {record.id for record in sequences if "SET=nan" in record.description}
+    sequences = [record for record in sequences if record.id not in deleted]
+    SeqIO.write(sequences, destination / 'sequences.fasta', 'fasta')
+    if labels is not None:
+        labels = [record for record in labels if record.id not in deleted]
+        SeqIO.write(labels, destination / 'labels.fasta', 'fasta')
+    if mask:
+        with open(split_files / mask, 'rb') as source_mask, open(destination / 'mask.fasta', 'wb') as mask_file:
+            mask_file.write(source_mask.read())
+
+
+def test_filter_FASTA_matches_biopython(tmp_path):
+    source = tmp_path / 'source.fasta'
+    with open(source, 'wb') as handle:
+        handle.write(b'>crlf SET=train\r\nACDE\r\nFGHI\r\n'
+                     b'>wrapped description with words\n' + b'A' * 7 + b'\n' + b'C' * 150 + b'\n' + b'D' * 3 + b'\n'
+                     b'>empty\n'
+                     b'>tab\tseparated\theader\nMKV\n'
+                     b'>spaces inside  sequence\nMK V\tL\n'
+                     b'> leading_space\nAA\n'
+                     b'>' + b'L' * 10 + b' ' + b'W' * 130 + b'\n' + b'W' * 121 + b'\n')
+    expected, streamed = tmp_path / 'expected.fasta', tmp_path / 'streamed.fasta'
+    SeqIO.write(SeqIO.parse(source, 'fasta'), expected, 'fasta')
+
+    kept, rejected = filter_FASTA(str(source), str(streamed), {'all': lambda entry: True})
+
+    assert kept == 7 and rejected == {'all': set()}
+    assert streamed.read_bytes() == expected.read_bytes()
+
+
+@pytest.mark.parametrize('split, residue_level, mask', [('seqs_s1', False, None), ('res_s1', True, None),
+                                                      ('res_s1', True, 'mask.fasta')])
+@pytest.mark.parametrize('min_size, max_size', [(None, None), (50, None), (None, 100), (50, 100)])
+def test_prepare_data_matches_baseline(flip_splits, tmp_path, split, residue_level, min_size, max_size, mask):
+    dataset, split_name = data.split_dict[split]
+    protocol = 'residue_to_class' if residue_level else 'sequence_to_value'
+    working_dir, expected_dir = tmp_path / 'working', tmp_path / 'expected'
+    working_dir.mkdir()
+    expected_dir.mkdir()
+
+    data.prepare_data(split, protocol, working_dir, min_size, max_size, mask)
+    _baseline_prepare(flip_splits / dataset / 'splits', split_name, residue_level, expected_dir, min_size, max_size,
+                      mask)
+
+    expected_files = sorted(os.listdir(expected_dir))
+    assert sorted(os.listdir(working_dir)) == expected_files
+    _, mismatch, errors = filecmp.cmpfiles(working_dir, expected_dir, expected_files, shallow=False)
+    assert not mismatch and not errors
+
+
+@pytest.mark.parametrize('min_size, max_size', [(None, None), (50, 100)])
+def test_prepare_data_reads_indexed_sequences(flip_splits, tmp_path, min_size, max_size):
+    streamed, indexed = tmp_path / 'streamed', tmp_path / 'indexed'
+    streamed.mkdir()
+    indexed.mkdir()
+
+    data.prepare_data('res_s1', 'residue_to_class', streamed, min_size, max_size, 'mask.fasta')
+    build_split_index('res')
+    manifest = RunManifest()
+    data.prepare_data('res_s1', 'residue_to_class', indexed, min_size, max_size, 'mask.fasta', manifest=manifest)
+
+    assert next(stage for stage in manifest.stages if stage['name'] == 'filter')['indexed']
+    _, mismatch, errors = filecmp.cmpfiles(streamed, indexed, ['sequences.fasta', 'labels.fasta', 'mask.fasta'],
+                                           shallow=False)
+    assert not mismatch and not errors
+
+
+def test_prepare_splits_parses_shared_sequences_only_on_cache_misses(flip_splits, tmp_path):
+    cache_dir = tmp_path / 'prepared'
+    working_dirs = {split: tmp_path / 'working' / split for split in ('res_s1', 'res_s2')}
+
+    manifest = RunManifest()
+    data.prepare_splits(working_dirs, 'residue_to_class', 50, None, 'mask.fasta', cache_dir, manifest=manifest)
+    parse = next(stage for stage in manifest.stages if stage['name'] == 'parse')
+    assert (parse['files'], parse['cached']) == (1, 0)
+    for split, working_dir in working_dirs.items():
+        expected_dir = tmp_path / 'expected' / split
+        expected_dir.mkdir(parents=True)
+        data.prepare_data(split, 'residue_to_class', expected_dir, 50, None, 'mask.fasta')
+        _, mismatch, errors = filecmp.cmpfiles(working_dir, expected_dir,
+                                               ['sequences.fasta', 'labels.fasta', 'mask.fasta'], shallow=False)
+        assert not mismatch and not errors
+
+    # All the splits are in the cache: the sequences of the dataset are not read again
+    manifest = RunManifest()
+    data.prepare_splits(working_dirs, 'residue_to_class', 50, None, 'mask.fasta', cache_dir, manifest=manifest)
+    parse = next(stage for stage in manifest.stages if stage['name'] == 'parse')
+    assert (parse['files'], parse['cached']) == (0, 2)
+
+
+def test_prepare_data_cache_hit(flip_splits, tmp_path):
+    cache_dir = tmp_path / 'prepared'
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    first.mkdir()
+    second.mkdir()
+
+    data.prepare_data('res_s1', 'residue_to_class', first, 50, None, 'mask.fasta', cache_dir=cache_dir)
+    manifest = RunManifest()
+    data.prepare_data('res_s1', 'residue_to_class', second, 50, None, 'mask.fasta', cache_dir=cache_dir,
+                      manifest=manifest)
+
+    lookup = next(stage for stage in manifest.stages if stage['name'] == 'cache_lookup')
+    assert lookup['hit']
+    assert not any(stage['name'] == 'filter' for stage in manifest.stages)
+    for file_name in ('sequences.fasta', 'labels.fasta', 'mask.fasta'):
+        assert filecmp.cmp(first / file_name, second / file_name, shallow=False)
+
+    # Preparing the split again with other parameters must not change the files shared with the cache
+    expected = (first / 'sequences.fasta').read_bytes()
+    data.prepare_data('res_s1', 'residue_to_class', second, 100, None, 'mask.fasta', cache_dir=cache_dir)
+    assert (first / 'sequences.fasta').read_bytes() == expected
+    assert len(list(cache_dir.iterdir())) == 2
+
+
+def test_prepared_data_eviction(flip_splits, tmp_path):
+    cache_dir = tmp_path / 'prepared'
+    for i, min_size in enumerate((10, 50, 100)):
+        working_dir = tmp_path / f'working{i}'
+        working_dir.mkdir()
+        data.prepare_data('seqs_s1', 'sequence_to_value', working_dir, min_size, None, None, cache_dir=cache_dir)
+    entries = sorted(cache_dir.iterdir(), key=lambda entry: (entry / 'manifest.json').stat().st_mtime)
+    # Make the first entry the most recently used one
+    os.utime(entries[0] / 'manifest.json', (time.time() + 10,) * 2)
+    size = sum(f.stat().st_size for f in entries[0].iterdir())
+
+    evict_prepared_data(cache_dir, size)
+
+    assert list(cache_dir.iterdir()) == [entries[0]]
@@ -0,0 +1,53 @@
+import os
+import random
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from autoeval.managers import embeddings
+
+h5py = pytest.importorskip('h5py')
+
+
+class _Embedder:
+    # Stand-in for a biotrainer embedder: one value per residue, the code of the amino acid
+    def embed_many(self, sequences, batch_size):
+        for sequence in sequences:
+            yield np.array([[ord(residue)] for residue in sequence], dtype=np.float32)
+
+    def reduce_per_protein(self, embedding):
+        return embedding.mean(axis=0)
+
+
+class _EmbeddingService:
+    _embedder = _Embedder()
+
+
+def _embed_splits(worker: int, store_dir: str, working_dir: str, rounds: int):
+    # Every round embeds new sequences into the shared store and reads the ones of the split back from it
+    embeddings._embedding_services['fake'] = _EmbeddingService()
+    generator = random.Random(worker)
+    for i in range(rounds):
+        split_dir = '{}/{}-{}'.format(working_dir, worker, i)
+        os.makedirs(split_dir)
+        with open(split_dir + '/sequences.fasta', 'w') as handle:
+            for j in range(20):
+                handle.write('>P{}\n{}\n'.format(j, ''.join(generator.choice('ACDEFGHIKLMNPQRSTVWY')
+                                                            for _ in range(generator.randint(50, 300)))))
+        embeddings.prepare_embeddings(split_dir + '/sequences.fasta', split_dir, store_dir, 'dataset', 'fake',
+                                      'sequence_to_value')
+
+
+def test_concurrent_runs_share_an_embedding_store(tmp_path):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_embed_splits, args=(worker, str(tmp_path / 'store'), str(tmp_path), 15))
+                 for worker in range(2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [process.exitcode for process in processes] == [0, 0]
+    with h5py.File(tmp_path / '1-14' / 'embeddings.h5', 'r') as split_embeddings:
+        assert len(split_embeddings) == 20
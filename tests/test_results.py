@@ -0,0 +1,76 @@
+import json
+
+from pathlib import Path
+
+from autoeval.utilities import results
+
+
+def _write_run(working_dir: Path, manifest: dict, config: dict, metrics: dict):
+    # Files of a finished run as written by autoeval and biotrainer
+    import yaml
+
+    (working_dir / 'output').mkdir(parents=True)
+    with open(working_dir / 'run_manifest.json', 'w') as mfile:
+        json.dump({'status': 'succeeded', 'wall_time': 1.0, **manifest}, mfile)
+    with open(working_dir / 'config.yml', 'w') as cfile:
+        yaml.safe_dump(config, cfile)
+    with open(working_dir / 'output' / 'out.yml', 'w') as ofile:
+        yaml.safe_dump({'test_iterations_results': {'metrics': metrics}}, ofile)
+
+
+def test_leaderboard_keeps_embedders_of_embedded_runs(tmp_path):
+    # Runs embedding the split themselves hand biotrainer an embeddings file, not the embedder
+    for embedder, value in (('Rostlab/prot_t5_xl_uniref50', 0.8), ('esm1b', 0.6)):
+        working_dir = tmp_path / 'runs' / embedder.replace('/', '_') / 'bind_one_vs_many'
+        _write_run(working_dir,
+                   {'run': {'split': 'bind_one_vs_many', 'args': {'embedder': None}},
+                    'stages': [{'name': 'embeddings', 'embedder_name': embedder}]},
+                   {'embeddings_file': str(working_dir / 'embeddings.h5'), 'model_choice': 'CNN'},
+                   {'macro-f1_score': value})
+    database = tmp_path / 'results.sqlite'
+
+    results.collect_results([tmp_path / 'runs'], database)
+    board = results.leaderboard(database)
+
+    assert {(entry['embedder'], entry['values']['bind_one_vs_many']) for entry in board} == \
+        {('Rostlab/prot_t5_xl_uniref50', 0.8), ('esm1b', 0.6)}
+
+
+def test_run_embedder_falls_back_to_embeddings_file(tmp_path):
+    working_dir = tmp_path / 'bind_one_vs_many'
+    _write_run(working_dir, {'run': {'split': 'bind_one_vs_many', 'args': {'embedder': None}}},
+               {'embeddings_file': '/data/precomputed.h5', 'model_choice': 'CNN'}, {'macro-f1_score': 0.5})
+
+    assert results.read_run(working_dir)['embedder'] == 'file:precomputed.h5'
+
+
+def test_leaderboard_keeps_grid_variants(tmp_path):
+    for name, override, learning_rate, value in (('a', 'learning_rate=1e-3', 0.001, 0.7),
+                                                 ('b', 'learning_rate=1e-4', 0.0001, 0.9)):
+        working_dir = tmp_path / 'runs' / name / 'bind_one_vs_many'
+        _write_run(working_dir,
+                   {'run': {'split': 'bind_one_vs_many', 'args': {'embedder': 'esm1b', 'override': [override]}}},
+                   {'embedder_name': 'esm1b', 'model_choice': 'CNN', 'learning_rate': learning_rate},
+                   {'macro-f1_score': value})
+    database = tmp_path / 'results.sqlite'
+
+    results.collect_results([tmp_path / 'runs'], database)
+    board = results.leaderboard(database)
+
+    assert {(entry['overrides'], entry['values']['bind_one_vs_many']) for entry in board} == \
+        {('learning_rate=0.001', 0.7), ('learning_rate=0.0001', 0.9)}
+    assert '| Overrides |' in results.format_leaderboard(board)
+
+
+def test_leaderboard_under_excludes_sibling_folders(tmp_path):
+    # With LIKE, runs_1 would also match runsA1 (_ is a wildcard) and Runs_1 (LIKE ignores the case)
+    for folder, value in (('runs_1', 0.1), ('runsA1', 0.2), ('Runs_1', 0.3), ('runs_10', 0.4)):
+        _write_run(tmp_path / folder / 'bind_one_vs_many',
+                   {'run': {'split': 'bind_one_vs_many', 'args': {'embedder': folder}}},
+                   {'embedder_name': folder, 'model_choice': 'CNN'}, {'macro-f1_score': value})
+    database = tmp_path / 'results.sqlite'
+    results.collect_results([tmp_path], database)
+
+    board = results.leaderboard(database, under=str(tmp_path / 'runs_1'))
+
+    assert [(entry['embedder'], entry['values']['bind_one_vs_many']) for entry in board] == [('runs_1', 0.1)]
@@ -0,0 +1,14 @@
+from autoeval.utilities.benchmark import STARTUP_MODULE, measure_startup
+
+# Time budgets in seconds of the startup of the command line interface. They are far above the usual times
+# (a few tens of milliseconds) to avoid flaky failures, and far below the import time of torch or biotrainer
+IMPORT_BUDGET = 0.5
+HELP_BUDGET = 1.0
+
+
+def test_cli_startup():
+    results, heavy_modules = measure_startup(repeat=3)
+
+    assert not heavy_modules, f"{STARTUP_MODULE} imports {', '.join(heavy_modules)} at startup."
+    assert results['startup.cli_import']['wall_time'] < IMPORT_BUDGET
+    assert results['startup.cli_help']['wall_time'] < HELP_BUDGET